@@ -14,12 +14,14 @@ import hashlib
 import hmac
 import base64
 import json
-import re
 import logging
-import threading
-from pathlib import Path
+import signal
+import sys
 from flask import Flask, request, jsonify
-import requests
+
+from kb_engine import EMPTY_SCOPE, NO_RESULTS, ReplyStream, RetrievalEngine, answer, build_context, load_config, question_key
+from kb_http import get_client
+from kb_sched import BUSY_REPLY, QueueFull, SingleFlight, WorkerPool
 
 # 配置日志
 logging.basicConfig(
@@ -35,13 +37,22 @@ CONFIG = {
     "app_key": "",           # 钉钉应用AppKey
     "app_secret": "",        # 钉钉应用AppSecret
     "agent_id": "",          # 钉钉机器人AgentID
-    "kb_path": "",           # 知识库JSON文件目录
+    "kb_path": "",           # 知识库目录（knowledge_base.pack 等生成文件放在它旁边）
     "llm_provider": "zhipu",
     "llm_api_key": "",       # 大模型API密钥
     "llm_base_url": "https://open.bigmodel.cn/api/paas/v4",
     "llm_model": "glm-4.7",
     "claude_api_key": "",    # 兼容旧配置
     "claude_base_url": "",   # 兼容旧配置
+    "rank_engine": "legacy", # 排序引擎：legacy（原有计分规则，默认）/ bm25（BM25F）/ vector（本地向量，需numpy）/ hybrid（bm25+vector融合）
+    "kb_reload_interval": 10,  # 知识库热更新检查间隔（秒），0 为关闭
+    "llm_stream": False,       # 流式生成回答，按句子攒批逐段发出（不必等完整回答），见 README
+    "http_pool_maxsize": 8,    # 每个主机（大模型、钉钉）保持的 keep-alive 连接数
+    "http_connect_timeout": 5, # 建立连接超时（秒）
+    "http_read_timeout": 30,   # 读取超时（秒）
+    "worker_threads": 8,       # 处理消息的工作线程数
+    "queue_limit": 20,         # 排队等待的消息上限，超出时回复稍后再试
+    "task_timeout": 60,        # 消息从接收起算的处理时限（秒），也是停止时等待的上限
 }
 
 # ============== 用户身份识别 ==============
@@ -55,317 +66,28 @@ def get_user_info(data: dict) -> dict:
     }
 
 
-# ============== 知识库加载与搜索 ==============
-
-def load_config():
-    """加载配置文件"""
-    config_path = Path(__file__).parent / "config.json"
-    if config_path.exists():
-        with open(config_path, "r", encoding="utf-8") as f:
-            loaded = json.load(f)
-            CONFIG.update(loaded)
-
-    if not CONFIG["kb_path"]:
-        CONFIG["kb_path"] = str(Path(__file__).parent / "knowledge_base")
-
-
-def build_content_from_sections(sections: list) -> str:
-    """将sections合并为可检索的正文内容"""
-    parts = []
-    for sec in sections or []:
-        if not isinstance(sec, dict):
-            continue
-        title = (sec.get("title") or "").strip()
-        content = (sec.get("content") or "").strip()
-        if not title and not content:
-            continue
-        if title:
-            parts.append(f"## {title}\n{content}".strip())
-        else:
-            parts.append(content)
-    return "\n\n".join([p for p in parts if p])
-
-
-def load_knowledge_base():
-    """加载知识库所有文档"""
-    kb_dir = Path(CONFIG["kb_path"])
-    documents = []
-
-    if not kb_dir.exists():
-        logger.error(f"知识库目录不存在: {kb_dir}")
-        return []
-
-    for json_file in kb_dir.glob("*.json"):
-        if json_file.name == "_index.json":
-            continue
-
-        try:
-            with open(json_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-
-            # entries列表格式
-            if "entries" in data:
-                for entry in data["entries"]:
-                    documents.append({
-                        "title": entry.get("title", ""),
-                        "source": json_file.name,
-                        "content": entry.get("content", {}).get("raw", ""),
-                        "sections": []
-                    })
-            # md转换的JSON格式（full_content或sections）
-            elif "title" in data:
-                sections = data.get("sections", [])
-                content = data.get("full_content") or build_content_from_sections(sections) or data.get("content", "")
-                if content:
-                    documents.append({
-                        "title": data.get("title", ""),
-                        "source": data.get("source", json_file.name),
-                        "content": content,
-                        "sections": sections
-                    })
-        except Exception as e:
-            logger.warning(f"无法加载 {json_file.name}: {e}")
-
-    logger.info(f"已加载 {len(documents)} 个文档")
-    return documents
-
-
-def extract_query_terms(query: str) -> list[str]:
-    """提取查询关键词（支持中文、数字、课程编号）"""
-    query_lower = query.lower()
-    terms = set()
-
-    # 英文/数字连续片段
-    for token in re.findall(r"[a-z0-9]+", query_lower):
-        terms.add(token)
-
-    # 课程编号（如 1-1-2）
-    for token in re.findall(r"\d+(?:-\d+)+", query_lower):
-        terms.add(token)
-        parts = token.split("-")
-        if len(parts) >= 2:
-            terms.add("-".join(parts[:2]))
-
-    # 中文连续片段与二字切分
-    for token in re.findall(r"[\u4e00-\u9fff]+", query_lower):
-        terms.add(token)
-        if len(token) >= 2:
-            for i in range(len(token) - 1):
-                terms.add(token[i:i + 2])
-
-    if not terms:
-        terms.add(query_lower.strip())
-
-    return list(terms)
-
-
-def extract_snippet(content: str, terms: list[str], before: int = 400, after: int = 1200) -> str | None:
-    """从内容中截取包含关键词的片段"""
-    if not content or not terms:
-        return None
-    content_lower = content.lower()
-    best = None  # (count, pos)
-    best_pos = None
-    for term in terms:
-        if not term:
-            continue
-        if len(term) < 2:
-            continue
-        pos = content_lower.find(term)
-        if pos == -1:
-            continue
-        count = content_lower.count(term)
-        candidate = (count, pos)
-        if best is None or candidate < best:
-            best = candidate
-            best_pos = pos
-    if best_pos is None:
-        return None
-    start = max(best_pos - before, 0)
-    end = min(best_pos + after, len(content))
-    return content[start:end]
-
-
-def search_documents(query: str, documents: list, max_results: int = 5) -> list:
-    """搜索相关文档"""
-    query_lower = query.lower()
-    query_terms = extract_query_terms(query)
-    results = []
-
-    for doc in documents:
-        score = 0
-        title_raw = doc.get("title", "")
-        content_raw = doc.get("content", "")
-        sections = doc.get("sections", [])
-        section_text = []
-        if sections:
-            for sec in sections:
-                if isinstance(sec, dict):
-                    section_text.append(sec.get("title", ""))
-                    section_text.append(sec.get("content", ""))
-        content_raw_combined = content_raw
-        if section_text:
-            content_raw_combined = content_raw + "\n" + "\n".join(section_text)
-
-        title = title_raw.lower()
-        content = content_raw_combined.lower()
-
-        for term in query_terms:
-            if term in title:
-                score += 10
-            if term in content:
-                score += 3 + content.count(term)
-
-        # 斯坦星球专用关键词加权
-        keywords = {
-            # STEM相关
-            "stem": ["stem", "幼儿", "科创", "机械", "建筑", "物理"],
-            "小班": ["小班", "3-4岁", "认识我自己", "动物", "植物"],
-            "中班": ["中班", "4-5岁", "机械", "建筑", "智能"],
-            "大班": ["大班", "5-6岁", "复杂机械", "能源", "空间", "智能硬件"],
-            # CODE相关
-            "code": ["code", "scratch", "编程", "少儿编程", "游戏开发"],
-            "code1": ["code1", "机械结构", "智能硬件", "编程启蒙"],
-            "code2": ["code2", "智能应用", "智能交互", "算法逻辑"],
-            "code3": ["code3", "智能系统", "游戏开发", "高级工程"],
-            # Python相关
-            "python": ["python", "pythonai", "人工智能", "ai"],
-            "l1": ["l1", "函数", "算法", "数据结构"],
-            "l2": ["l2", "数据科学", "计算机视觉", "cv", "仿生"],
-            # C++信奥
-            "信奥": ["信奥", "c++", "noi", "csp", "竞赛"],
-            # 销售相关
-            "销售": ["销售", "话术", "咨询", "异议", "促单"],
-            "家长": ["家长", "沟通", "续费", "转介绍"],
-        }
-
-        for key, terms in keywords.items():
-            if any(t in query_lower for t in terms):
-                if any(t in title or t in content for t in terms):
-                    score += 5
-
-        if score > 0:
-            doc["_score"] = score
-            snippet = extract_snippet(content_raw_combined, query_terms)
-            if snippet:
-                doc["_snippet"] = snippet
-            results.append(doc)
-
-    results.sort(key=lambda x: x.get("_score", 0), reverse=True)
-    return results[:max_results]
-
-
-# ============== Claude RAG ==============
-
-def build_context(documents: list, max_chars: int = 8000) -> str:
-    """构建上下文，控制长度"""
-    context_parts = []
-    total_chars = 0
-
-    for doc in documents:
-        title = doc.get("title", "未知")
-        content = doc.get("_snippet") or doc.get("content", "")
-
-        if total_chars + len(content) > max_chars:
-            remaining = max_chars - total_chars
-            if remaining > 500:
-                content = content[:remaining] + "\n...(内容截断)"
-            else:
-                break
-
-        context_parts.append(f"### {title}\n\n{content}")
-        total_chars += len(content)
-
-    return "\n\n---\n\n".join(context_parts)
-
-
-def get_llm_config():
-    """获取大模型配置（优先读取llm_*, 兼容claude_*）"""
-    api_key = CONFIG.get("llm_api_key") or CONFIG.get("claude_api_key") or ""
-    base_url = CONFIG.get("llm_base_url") or CONFIG.get("claude_base_url") or "https://open.bigmodel.cn/api/paas/v4"
-    model = CONFIG.get("llm_model") or "glm-4.7"
-    return api_key, base_url, model
-
-
-def ask_llm(question: str, context: str) -> str:
-    """调用大模型生成回答（智谱OpenAI兼容接口）"""
-    api_key, base_url, model = get_llm_config()
-    if not api_key:
-        return "错误：未配置大模型API密钥"
-
-    system_prompt = """你是斯坦星球的知识库助手，专门回答老师和销售顾问关于课程、教学、销售的问题。
-
-斯坦星球简介：
-- 专注于STEM科创和编程教育
-- 课程体系：STEM幼儿科创（3-6岁）→ CODE少儿编程（6-12岁）→ PythonAI（10岁+）→ C++信奥
-- 教学理念：项目制学习(PBL)、八大能力培养、做中学
-
-重要规则：
-1. 只能基于提供的知识库内容回答，不要编造任何信息
-2. 如果知识库中没有相关内容，明确说"这个问题我在知识库中没有找到相关资料，建议咨询教学主管"
-3. 回答要简洁实用，直接给出答案
-4. 涉及具体课程、年龄、级别时，必须严格按照知识库内容
-5. 用口语化的方式回答，像同事之间的对话
-
-课程体系要点（必须严格遵守）：
-- STEM：小班(3-4岁)→中班(4-5岁)→大班(5-6岁)，每阶段4个主题
-- CODE：CODE1(6-8岁)→CODE2(8-10岁)→CODE3(10-12岁)，机械+编程结合
-- PythonAI：L1(10-12岁)→L2(12岁+)，人工智能方向
-- C++信奥：面向竞赛的专业课程"""
-
-    user_message = f"""请基于以下知识库内容回答问题。
-
-【知识库内容】
-{context}
-
-【用户问题】
-{question}
-
-请直接回答，不要说"根据知识库"之类的开场白。"""
-
-    url = base_url.rstrip("/") + "/chat/completions"
-    payload = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message},
-        ],
-        "temperature": 0.2,
-        "max_tokens": 1200,
-        "thinking": {"type": "disabled"},
-    }
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
+# ============== 知识库与问答 ==============
+# 配置加载、知识库加载/热更新、检索、上下文与大模型调用都在 kb_engine（与 Stream 模式共用）
 
-    try:
-        resp = requests.post(url, json=payload, headers=headers, timeout=30)
-        if resp.status_code != 200:
-            logger.error(f"LLM错误: {resp.status_code} {resp.text[:300]}")
-            return "抱歉，AI服务暂时不可用，请稍后再试。"
-        data = resp.json()
-        content = data.get("choices", [{}])[0].get("message", {}).get("content", "")
-        if not content:
-            logger.error(f"LLM返回空内容: {data}")
-            return "抱歉，AI服务暂时不可用，请稍后再试。"
-        return content.strip()
-    except Exception as e:
-        logger.error(f"LLM调用异常: {e}")
-        return "抱歉，处理您的问题时出错了。"
+ENGINE = RetrievalEngine(CONFIG)
+POOL = WorkerPool(CONFIG)
+FLIGHTS = SingleFlight()  # 同时进行的相同问题只调用一次大模型
 
 
-def process_question(question: str, documents: list) -> str:
-    """处理用户问题：搜索+生成"""
-    relevant_docs = search_documents(question, documents, max_results=5)
+def process_question(question: str, documents: list, stream: ReplyStream | None = None,
+                     scope: dict | None = None) -> str:
+    """处理用户问题：搜索+生成（scope 为 documents 对应的显式检索范围，如 {"level": "CODE2"}；
+    给出 stream 时回答边生成边逐段送出；相同问题在相同范围内正在回答时等它的结果，此时不经 stream）"""
+    relevant_docs = ENGINE.search(question, documents, max_results=5)
 
     if not relevant_docs:
-        return "抱歉，没有找到与您问题相关的内容。请尝试换个关键词，或咨询教学主管。"
+        return NO_RESULTS
 
     context = build_context(relevant_docs)
-    answer = ask_llm(question, context)
-
-    return answer
+    index = ENGINE.index
+    key = question_key(question, index.version if index is not None else None,
+                       tuple(sorted(scope.items())) if scope else None)
+    return FLIGHTS.do(key, answer, CONFIG, question, context, stream)
 
 
 # ============== 钉钉接口 ==============
@@ -395,16 +117,29 @@ def send_message(webhook_url: str, content: str):
     }
 
     try:
-        resp = requests.post(webhook_url, json=data, headers=headers, timeout=30)
+        resp = get_client(CONFIG).post(webhook_url, json=data, headers=headers)
         logger.info(f"消息发送结果: {resp.status_code}")
     except Exception as e:
         logger.error(f"发送消息失败: {e}")
 
 
+class WebhookReply(ReplyStream):
+    """流式回答的每一段作为一条后续消息发到会话Webhook"""
+
+    def __init__(self, webhook_url: str):
+        super().__init__()
+        self.webhook_url = webhook_url
+
+    def send(self, segment: str):
+        send_message(self.webhook_url, segment)
+
+
 def handle_text_message(content: str, session_webhook: str):
     """后台处理消息并发送回复，避免回调超时"""
+    index = ENGINE.acquire()  # 整个请求只取一次并持有租约，中途热更新不影响、也不会关闭本次用的索引
     try:
         reply = None
+        stream = WebhookReply(session_webhook) if session_webhook else None
 
         # 帮助命令
         if content in ["帮助", "help", "?"]:
@@ -423,12 +158,23 @@ def handle_text_message(content: str, session_webhook: str):
 • 教学方法与课堂管理
 • 家长沟通技巧
 
+⚡ 指定范围提问：/code2 问题（stem/小班/code1/l1/cpp等）
+
 💡 提示：您也可以私聊我，获得更专注的服务"""
 
         # 快捷命令
         elif content.startswith("/"):
             cmd = content[1:].lower()
-            if cmd == "stem":
+            # 带问题的范围命令：/code2 升班规则是什么，只在该分面的文档内检索
+            scope_token, _, scoped_question = content[1:].partition(" ")
+            scope = index.parse_scope(scope_token) if index and scoped_question.strip() else None
+            view = index.facet_view(**scope) if scope else None
+            if scope and not view:
+                logger.info(f"指定检索范围 {scope} 内没有文档")
+                reply = EMPTY_SCOPE
+            elif scope:
+                reply = process_question(scoped_question.strip(), view, stream, scope)
+            elif cmd == "stem":
                 reply = """📘 STEM幼儿科创课程（3-6岁）
 
 【小班 3-4岁】
@@ -513,35 +259,40 @@ def handle_text_message(content: str, session_webhook: str):
 
         # 普通问答
         if reply is None:
-            reply = process_question(content, KB_DOCUMENTS)
+            reply = process_question(content, index.documents if index is not None else [], stream)
 
-        if session_webhook:
+        if session_webhook and not stream.segments:  # 流式回答已经逐段发出
             send_message(session_webhook, reply)
     except Exception as e:
         logger.exception(f"后台处理消息失败: {e}")
+    finally:
+        ENGINE.release(index)
 
 
 # ============== 路由 ==============
 
-KB_DOCUMENTS = []
-
-
 @app.before_request
 def ensure_kb_loaded():
     """确保知识库已加载"""
-    global KB_DOCUMENTS
-    if not KB_DOCUMENTS:
-        load_config()
-        KB_DOCUMENTS = load_knowledge_base()
+    if ENGINE.index is None:
+        load_config(CONFIG)
+        ENGINE.start_watcher()
+        ENGINE.load()
 
 
 @app.route("/", methods=["GET"])
 def health_check():
     """健康检查"""
+    index = ENGINE.index
     return jsonify({
         "status": "ok",
         "service": "斯坦星球知识库钉钉机器人(RAG+Claude)",
-        "documents": len(KB_DOCUMENTS)
+        "documents": len(index.documents) if index else 0,
+        "kb_version": index.version if index else None,
+        "kb_reloads": ENGINE.watcher.reloads if ENGINE.watcher else 0,
+        "http": get_client(CONFIG).stats(),
+        "workers": POOL.stats(),
+        "single_flight": FLIGHTS.stats(),
     })
 
 
@@ -570,13 +321,14 @@ def dingtalk_callback():
             # 获取用户信息
             user_info = get_user_info(data)
             logger.info(f"用户: {user_info['sender_nick']}, StaffID: {user_info['staff_id']}")
-            # 后台处理，避免回调超时
+            # 交给工作线程池处理，避免回调超时
             if session_webhook:
-                threading.Thread(
-                    target=handle_text_message,
-                    args=(content, session_webhook),
-                    daemon=True
-                ).start()
+                try:
+                    POOL.submit(handle_text_message, content, session_webhook,
+                                on_expired=lambda: send_message(session_webhook, BUSY_REPLY))
+                except QueueFull as e:
+                    logger.warning(f"{e}，拒绝消息: {content[:50]}")
+                    send_message(session_webhook, BUSY_REPLY)
 
         return jsonify({"errcode": 0, "errmsg": "ok"})
 
@@ -588,12 +340,16 @@ def dingtalk_callback():
 # ============== 启动 ==============
 
 if __name__ == "__main__":
-    load_config()
-    KB_DOCUMENTS = load_knowledge_base()
+    load_config(CONFIG)
+    ENGINE.start_watcher()
+    ENGINE.load()
 
     print("=" * 50)
     print("斯坦星球知识库钉钉机器人 (RAG + Claude)")
-    print(f"已加载 {len(KB_DOCUMENTS)} 个文档")
+    print(f"已加载 {len(ENGINE.documents())} 个文档（知识库版本 {ENGINE.index.version if ENGINE.index else '无'}）")
     print("=" * 50)
 
+    # SIGTERM 时正常退出，退出前等已接收的问题答完（见 kb_sched.WorkerPool.shutdown）
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     app.run(host="0.0.0.0", port=8081, debug=True)
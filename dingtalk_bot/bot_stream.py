@@ -4,17 +4,21 @@
 使用钉钉Stream SDK，无需公网IP
 """
 
-import json
 import logging
 import re
-import asyncio
 from pathlib import Path
 
-import requests
 import dingtalk_stream
 from dingtalk_stream import AckMessage
 from dingtalk_stream.chatbot import ChatbotHandler, ChatbotMessage
 
+from kb_engine import (
+    CARD_SEGMENT_CHARS, EMPTY_SCOPE, MESSAGE_SEGMENT_CHARS, NO_RESULTS, PendingAnswer, ReplyStream, RetrievalEngine,
+    build_context, load_config,
+)
+from kb_keywords import course_type_of_query, scan_keywords
+from kb_sched import BUSY_REPLY, QUEUED_REPLY, MessageScheduler, QueueFull
+
 # 配置日志 - 输出到文件
 log_file = Path(__file__).parent / "bot.log"
 logging.basicConfig(
@@ -38,10 +42,22 @@ CONFIG = {
     "llm_model": "glm-4.7",
     "claude_api_key": "",
     "claude_base_url": "",
+    "rank_engine": "legacy",
+    "kb_reload_interval": 10,
+    "llm_stream": False,       # 流式生成回答，边生成边送出（不必等完整回答），见 README
+    "stream_card": False,      # 流式时用AI卡片原地更新回答（需要互动卡片权限）；关闭或卡片创建失败时按句子攒批逐段回复
+    "retrieval_workers": 2,    # 检索线程数
+    "llm_concurrency": 4,      # 同时进行的大模型调用数
+    "queue_limit": 20,         # 排队等待的消息上限，超出时回复稍后再试
+    "http_pool_maxsize": 8,
+    "http_connect_timeout": 5,
+    "http_read_timeout": 30,
 }
 
 # ============== 知识库 ==============
-KB_DOCUMENTS = []
+# 配置加载、知识库加载/热更新、检索、上下文与大模型调用都在 kb_engine（与 Webhook 模式共用）
+ENGINE = RetrievalEngine(CONFIG)
+SCHEDULER = MessageScheduler(CONFIG)
 
 # ============== 消息去重 ==============
 # 存储已处理的消息ID（最多保留1000条）
@@ -153,135 +169,8 @@ def extract_topic_from_content(content: str, course_id: str = None) -> str:
     return None
 
 
-def load_config():
-    """加载配置文件"""
-    config_path = Path(__file__).parent / "config.json"
-    if config_path.exists():
-        with open(config_path, "r", encoding="utf-8") as f:
-            loaded = json.load(f)
-            CONFIG.update(loaded)
-
-    if not CONFIG["kb_path"]:
-        CONFIG["kb_path"] = str(Path(__file__).parent / "knowledge_base")
-
-
-def build_content_from_sections(sections: list) -> str:
-    """将sections合并为可检索的正文内容"""
-    parts = []
-    for sec in sections or []:
-        if not isinstance(sec, dict):
-            continue
-        title = (sec.get("title") or "").strip()
-        content = (sec.get("content") or "").strip()
-        if not title and not content:
-            continue
-        if title:
-            parts.append(f"## {title}\n{content}".strip())
-        else:
-            parts.append(content)
-    return "\n\n".join([p for p in parts if p])
-
-
-def load_knowledge_base():
-    """加载知识库所有文档"""
-    kb_dir = Path(CONFIG["kb_path"])
-    documents = []
-
-    if not kb_dir.exists():
-        logger.error(f"知识库目录不存在: {kb_dir}")
-        return []
-
-    for json_file in kb_dir.glob("*.json"):
-        if json_file.name == "_index.json":
-            continue
-
-        try:
-            with open(json_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-
-            if "entries" in data:
-                for entry in data["entries"]:
-                    documents.append({
-                        "title": entry.get("title", ""),
-                        "source": json_file.name,
-                        "content": entry.get("content", {}).get("raw", ""),
-                        "sections": []
-                    })
-            elif "title" in data:
-                sections = data.get("sections", [])
-                content = data.get("full_content") or build_content_from_sections(sections) or data.get("content", "")
-                if content:
-                    documents.append({
-                        "title": data.get("title", ""),
-                        "source": data.get("source", json_file.name),
-                        "content": content,
-                        "sections": sections
-                    })
-        except Exception as e:
-            logger.warning(f"无法加载 {json_file.name}: {e}")
-
-    logger.info(f"已加载 {len(documents)} 个文档")
-    return documents
-
-
 # ============== 知识库搜索 ==============
 
-def extract_query_terms(query: str) -> list[str]:
-    """提取查询关键词（支持中文、数字、课程编号）"""
-    query_lower = query.lower()
-    terms = set()
-
-    # 英文/数字连续片段
-    for token in re.findall(r"[a-z0-9]+", query_lower):
-        terms.add(token)
-
-    # 课程编号（如 1-1-2）
-    for token in re.findall(r"\d+(?:-\d+)+", query_lower):
-        terms.add(token)
-        parts = token.split("-")
-        if len(parts) >= 2:
-            terms.add("-".join(parts[:2]))
-
-    # 中文连续片段与二字切分
-    for token in re.findall(r"[\u4e00-\u9fff]+", query_lower):
-        terms.add(token)
-        if len(token) >= 2:
-            for i in range(len(token) - 1):
-                terms.add(token[i:i + 2])
-
-    if not terms:
-        terms.add(query_lower.strip())
-
-    return list(terms)
-
-
-def extract_snippet(content: str, terms: list[str], before: int = 400, after: int = 1200) -> str | None:
-    """从内容中截取包含关键词的片段"""
-    if not content or not terms:
-        return None
-    content_lower = content.lower()
-    best = None  # (count, pos)
-    best_pos = None
-    for term in terms:
-        if not term:
-            continue
-        if len(term) < 2:
-            continue
-        pos = content_lower.find(term)
-        if pos == -1:
-            continue
-        count = content_lower.count(term)
-        candidate = (count, pos)
-        if best is None or candidate < best:
-            best = candidate
-            best_pos = pos
-    if best_pos is None:
-        return None
-    start = max(best_pos - before, 0)
-    end = min(best_pos + after, len(content))
-    return content[start:end]
-
-
 def extract_course_id(query: str) -> str | None:
     """提取课程编号（如 1-1-2）"""
     match = re.search(r"\d+(?:-\d+)+", query)
@@ -290,370 +179,30 @@ def extract_course_id(query: str) -> str | None:
     return None
 
 
-def normalize_course_id(course_id: str) -> list[str]:
-    """生成课程编号的所有可能变体（处理前导零）
-    例如 '1-1-2' -> ['1-1-2', '1-1-02', '1-01-2', '1-01-02', '01-1-2', ...]
-    """
-    if not course_id:
-        return []
-    
-    parts = course_id.split("-")
-    variants = set()
-    
-    # 原始版本
-    variants.add(course_id)
-    
-    # 生成带前导零和不带前导零的变体
-    def generate_variants(parts_list, index=0, current=[]):
-        if index == len(parts_list):
-            variants.add("-".join(current))
-            return
-        
-        part = parts_list[index]
-        # 不带前导零
-        current.append(part.lstrip("0") or "0")
-        generate_variants(parts_list, index + 1, current)
-        current.pop()
-        
-        # 带前导零（两位数格式）
-        if len(part) == 1:
-            current.append("0" + part)
-            generate_variants(parts_list, index + 1, current)
-            current.pop()
-    
-    generate_variants(parts)
-    return list(variants)
-
-
 def detect_course_type(query: str) -> str | None:
-    """检测查询中的课程类型"""
-    query_lower = query.lower()
-    
-    # STEM幼儿课程关键词
-    if any(kw in query_lower for kw in ["小班", "中班", "大班", "幼儿", "stem", "3岁", "4岁", "5岁", "6岁", "认识我自己", "动物王国", "植物奥秘", "数理物理", "机械与工具", "建筑与结构", "智能机械", "物理科学", "复杂机械", "地球与空间", "能源科学", "智能硬件"]):
-        return "STEM"
-    
-    # PythonAI课程关键词
-    if any(kw in query_lower for kw in ["python", "pythonai", "人工智能", "ai课", "l1", "l2", "函数", "算法", "数据结构", "计算机视觉", "仿生"]):
-        return "PythonAI"
-    
-    # CODE少儿编程关键词
-    if any(kw in query_lower for kw in ["code1", "code2", "code3", "scratch", "少儿编程", "编程启蒙", "游戏开发"]):
-        return "CODE"
-    
-    # C++信奥关键词
-    if any(kw in query_lower for kw in ["信奥", "c++", "noi", "csp", "竞赛"]):
-        return "CPP"
-    
-    return None
+    """检测查询中的课程类型（STEM > PythonAI > CODE > CPP）"""
+    return course_type_of_query(scan_keywords(query.lower()))
 
 
 def filter_documents_by_type(documents: list, course_type: str) -> list:
-    """根据课程类型过滤文档"""
+    """根据课程类型过滤文档（类型在加载时已标记为位图）"""
     if not course_type:
         return documents
-    
-    filtered = []
-    for doc in documents:
-        title = doc.get("title", "").upper()
-        source = doc.get("source", "").upper()
-        
-        if course_type == "STEM":
-            # STEM文档：标题或来源包含STEM/小班/中班/大班
-            if any(kw in title or kw in source for kw in ["STEM", "小班", "中班", "大班"]):
-                filtered.append(doc)
-        elif course_type == "PythonAI":
-            if "PYTHON" in title or "PYTHON" in source:
-                filtered.append(doc)
-        elif course_type == "CODE":
-            if "CODE" in title or "CODE" in source:
-                filtered.append(doc)
-        elif course_type == "CPP":
-            if any(kw in title or kw in source for kw in ["C++", "信奥", "NOI", "CSP"]):
-                filtered.append(doc)
-    
+
+    filtered = ENGINE.search_index(documents).filter_by_course_type(documents, course_type)
     return filtered if filtered else documents  # 如果过滤后为空，返回全部
 
 
 def find_course_matches(course_id: str, documents: list, course_type: str = None) -> list[dict]:
-    """按课程编号精确匹配文档，生成包含片段的上下文"""
-    matches = []
-    
-    # 生成课程编号的所有变体（处理前导零问题）
-    course_id_variants = normalize_course_id(course_id)
-    
-    # 创建匹配所有变体的正则表达式
-    pattern_str = "|".join(re.escape(v) for v in course_id_variants)
-    pattern = re.compile(pattern_str)
-    
-    for doc in documents:
-        found = False
-        
-        # 1. 先尝试在content中匹配
-        content = doc.get("content", "")
-        if content:
-            hit = pattern.search(content)
-            if hit:
-                start = max(hit.start() - 600, 0)
-                end = min(hit.end() + 1200, len(content))
-                snippet = content[start:end]
-                matches.append({
-                    "title": doc.get("title", "未知"),
-                    "source": doc.get("source", ""),
-                    "content": snippet
-                })
-                found = True
-
-        # 2. 在 sections 中匹配（无论content是否有内容）
-        if not found:
-            sections = doc.get("sections", [])
-            for sec in sections:
-                if not isinstance(sec, dict):
-                    continue
-                sec_content = sec.get("content", "")
-                hit = pattern.search(sec_content)
-                if hit:
-                    # 提取匹配点附近的内容
-                    start = max(hit.start() - 300, 0)
-                    end = min(hit.end() + 1500, len(sec_content))
-                    snippet = sec_content[start:end]
-                    matches.append({
-                        "title": f"{doc.get('title', '未知')} - {sec.get('title', '')}",
-                        "source": doc.get("source", ""),
-                        "content": snippet
-                    })
-                    break
-        
-        # 3. 也检查 full_content 字段
-        if not found:
-            full_content = doc.get("full_content", "")
-            if full_content:
-                hit = pattern.search(full_content)
-                if hit:
-                    start = max(hit.start() - 600, 0)
-                    end = min(hit.end() + 1500, len(full_content))
-                    snippet = full_content[start:end]
-                    matches.append({
-                        "title": doc.get("title", "未知"),
-                        "source": doc.get("source", ""),
-                        "content": snippet
-                    })
-
-    return matches
-
-
-def search_documents(query: str, documents: list, max_results: int = 5) -> list:
-    """搜索相关文档"""
-    query_lower = query.lower()
-    query_terms = extract_query_terms(query)
-    results = []
-
-    for doc in documents:
-        score = 0
-        title_raw = doc.get("title", "")
-        content_raw = doc.get("content", "")
-        sections = doc.get("sections", [])
-        section_text = []
-        if sections:
-            for sec in sections:
-                if isinstance(sec, dict):
-                    section_text.append(sec.get("title", ""))
-                    section_text.append(sec.get("content", ""))
-        content_raw_combined = content_raw
-        if section_text:
-            content_raw_combined = content_raw + "\n" + "\n".join(section_text)
-
-        title = title_raw.lower()
-        content = content_raw_combined.lower()
-
-        for term in query_terms:
-            if term in title:
-                score += 10
-            if term in content:
-                score += 3 + content.count(term)
-
-        # 斯坦星球专用关键词加权
-        keywords = {
-            "stem": ["stem", "幼儿", "科创", "机械", "建筑", "物理"],
-            "小班": ["小班", "3-4岁", "认识我自己", "动物", "植物"],
-            "中班": ["中班", "4-5岁", "机械", "建筑", "智能"],
-            "大班": ["大班", "5-6岁", "复杂机械", "能源", "空间", "智能硬件"],
-            "code": ["code", "scratch", "编程", "少儿编程", "游戏开发"],
-            "code1": ["code1", "机械结构", "智能硬件", "编程启蒙"],
-            "code2": ["code2", "智能应用", "智能交互", "算法逻辑"],
-            "code3": ["code3", "智能系统", "游戏开发", "高级工程"],
-            "python": ["python", "pythonai", "人工智能", "ai"],
-            "l1": ["l1", "函数", "算法", "数据结构"],
-            "l2": ["l2", "数据科学", "计算机视觉", "cv", "仿生"],
-            "信奥": ["信奥", "c++", "noi", "csp", "竞赛"],
-            "销售": ["销售", "话术", "咨询", "异议", "促单"],
-            "家长": ["家长", "沟通", "续费", "转介绍"],
-        }
-
-        for key, terms in keywords.items():
-            if any(t in query_lower for t in terms):
-                if any(t in title or t in content for t in terms):
-                    score += 5
-
-        if score > 0:
-            doc["_score"] = score
-            snippet = extract_snippet(content_raw_combined, query_terms)
-            if snippet:
-                doc["_snippet"] = snippet
-            results.append(doc)
-
-    results.sort(key=lambda x: x.get("_score", 0), reverse=True)
-    return results[:max_results]
-
-
-def build_context(documents: list, max_chars: int = 8000) -> str:
-    """构建上下文"""
-    context_parts = []
-    total_chars = 0
-
-    for doc in documents:
-        title = doc.get("title", "未知")
-        content = doc.get("_snippet") or doc.get("content", "")
-
-        if total_chars + len(content) > max_chars:
-            remaining = max_chars - total_chars
-            if remaining > 500:
-                content = content[:remaining] + "\n...(内容截断)"
-            else:
-                break
-
-        context_parts.append(f"### {title}\n\n{content}")
-        total_chars += len(content)
-
-    return "\n\n---\n\n".join(context_parts)
-
-
-# ============== LLM API ==============
-
-def get_llm_config():
-    """获取大模型配置（优先读取llm_*, 兼容claude_*）"""
-    api_key = CONFIG.get("llm_api_key") or CONFIG.get("claude_api_key") or ""
-    base_url = CONFIG.get("llm_base_url") or CONFIG.get("claude_base_url") or "https://open.bigmodel.cn/api/paas/v4"
-    model = CONFIG.get("llm_model") or "glm-4.7"
-    return api_key, base_url, model
+    """按课程编号精确匹配文档，生成包含片段的上下文
 
+    编号在加载时已规范化（去前导零）建表，这里只做一次哈希查找。
+    """
+    index = ENGINE.search_index(documents)
+    return index.find_course(course_id, index.doc_ids_of(documents))
 
-def clean_markdown(text: str) -> str:
-    """清理Markdown格式符号，转为纯文本"""
-    if not text:
-        return text
-    
-    # 移除代码块
-    text = re.sub(r'```[\s\S]*?```', lambda m: m.group(0).replace('```', '').strip(), text)
-    
-    # 移除行内代码
-    text = re.sub(r'`([^`]+)`', r'\1', text)
-    
-    # 移除加粗
-    text = re.sub(r'\*\*([^*]+)\*\*', r'【\1】', text)
-    text = re.sub(r'__([^_]+)__', r'【\1】', text)
-    
-    # 移除斜体
-    text = re.sub(r'\*([^*]+)\*', r'\1', text)
-    text = re.sub(r'_([^_]+)_', r'\1', text)
-    
-    # 移除标题符号
-    text = re.sub(r'^#{1,6}\s*', '', text, flags=re.MULTILINE)
-    
-    # 移除分隔线
-    text = re.sub(r'^-{3,}$', '', text, flags=re.MULTILINE)
-    text = re.sub(r'^\*{3,}$', '', text, flags=re.MULTILINE)
-    text = re.sub(r'^_{3,}$', '', text, flags=re.MULTILINE)
-    
-    # 将Markdown列表符号替换为更友好的符号
-    text = re.sub(r'^[-*+]\s+', '· ', text, flags=re.MULTILINE)
-    
-    # 移除链接格式，保留文字
-    text = re.sub(r'\[([^\]]+)\]\([^)]+\)', r'\1', text)
-    
-    # 清理多余空行
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    
-    return text.strip()
-
-
-def ask_llm(question: str, context: str) -> str:
-    """调用大模型生成回答（智谱OpenAI兼容接口）"""
-    api_key, base_url, model = get_llm_config()
-    if not api_key:
-        return "错误：未配置大模型API密钥"
-
-    system_prompt = """你是斯坦星球的知识库助手，专门回答老师和销售顾问关于课程、教学、销售的问题。
-
-斯坦星球简介：
-- 专注于STEM科创和编程教育
-- 课程体系：STEM幼儿科创（3-6岁）→ CODE少儿编程（6-12岁）→ PythonAI（10岁+）→ C++信奥
-- 教学理念：项目制学习(PBL)、八大能力培养、做中学
-
-重要规则：
-1. 只能基于提供的知识库内容回答，不要编造任何信息
-2. 如果知识库中没有相关内容，明确说"这个问题我在知识库中没有找到相关资料，建议咨询教学主管"
-3. 回答要简洁实用，直接给出答案
-4. 涉及具体课程、年龄、级别时，必须严格按照知识库内容
-5. 用口语化的方式回答，像同事之间的对话
-
-格式要求（非常重要！）：
-- 输出纯文本，不要使用任何Markdown格式
-- 不要用 **加粗** 或 *斜体*
-- 不要用 ## 标题 或 ### 小标题
-- 不要用 ``` 代码块
-- 不要用 --- 分隔线
-- 不要用 | 表格 |
-- 用【】或「」来强调重点，用空行分段
-- 用数字1. 2. 3.或符号•来列举，不要用-
-
-课程体系要点（必须严格遵守）：
-- STEM：小班(3-4岁)→中班(4-5岁)→大班(5-6岁)，每阶段4个主题
-- CODE：CODE1(6-8岁)→CODE2(8-10岁)→CODE3(10-12岁)，机械+编程结合
-- PythonAI：L1(10-12岁)→L2(12岁+)，人工智能方向
-- C++信奥：面向竞赛的专业课程"""
-
-    user_message = f"""请基于以下知识库内容回答问题。
-
-【知识库内容】
-{context}
-
-【用户问题】
-{question}
-
-请直接回答，不要说"根据知识库"之类的开场白。"""
-
-    url = base_url.rstrip("/") + "/chat/completions"
-    payload = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message},
-        ],
-        "temperature": 0.2,
-        "max_tokens": 1200,
-        "thinking": {"type": "disabled"},
-    }
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-
-    try:
-        resp = requests.post(url, json=payload, headers=headers, timeout=30)
-        if resp.status_code != 200:
-            logger.error(f"LLM错误: {resp.status_code} {resp.text[:300]}")
-            return "抱歉，AI服务暂时不可用，请稍后再试。"
-        data = resp.json()
-        content = data.get("choices", [{}])[0].get("message", {}).get("content", "")
-        if not content:
-            logger.error(f"LLM返回空内容: {data}")
-            return "抱歉，AI服务暂时不可用，请稍后再试。"
-        return clean_markdown(content)
-    except Exception as e:
-        logger.exception(f"LLM调用异常: {type(e).__name__}: {e}")
-        return f"抱歉，AI服务暂时不可用，请稍后再试。(错误: {type(e).__name__})"
 
+# ============== 问答 ==============
 
 def is_follow_up_query(question: str) -> bool:
     """检测是否是跟进性问题（需要上下文的模糊查询）"""
@@ -673,8 +222,13 @@ def is_follow_up_query(question: str) -> bool:
     return False
 
 
-def process_question(question: str, sender_id: str = "") -> str:
-    """处理用户问题"""
+def process_question(question: str, sender_id: str = "", scope: dict | None = None,
+                     stream: ReplyStream | None = None) -> str | PendingAnswer:
+    """处理用户问题（scope为显式指定的检索范围，如 {"level": "CODE2"}）
+
+    需要大模型回答时返回 PendingAnswer（检索已完成），由调度器在大模型线程池中生成；
+    给出 stream 时回答边生成边逐段送出。
+    """
     
     # 0. 获取用户会话上下文
     session = get_user_session(sender_id) if sender_id else {}
@@ -700,38 +254,50 @@ def process_question(question: str, sender_id: str = "") -> str:
                 elif course_id:
                     question = f"关于课程{course_id}，{question}"
     
-    # 3. 根据课程类型预先过滤文档范围
-    filtered_docs = filter_documents_by_type(KB_DOCUMENTS, course_type)
-    
-    # 4. 提取课程编号并在过滤后的范围内搜索
-    if course_id:
-        course_docs = find_course_matches(course_id, filtered_docs, course_type)
-        if course_docs:
-            context = build_context(course_docs, max_chars=8000)
+    # 3. 根据显式范围或课程类型预先过滤文档范围（分面在加载时已分好）
+    #    整个检索过程持有同一个索引的租约，中途热更新既不影响本次回答，也不会关闭它
+    with ENGINE.lease() as index:
+        documents = index.documents if index is not None else []
+        if scope and index is not None:
+            filtered_docs = index.facet_view(**scope)
+            logger.info(f"指定检索范围: {scope}，共 {len(filtered_docs)} 个文档")
+            if not filtered_docs:
+                return EMPTY_SCOPE  # 不悄悄放宽到全部资料
+        else:
+            filtered_docs = filter_documents_by_type(documents, course_type)
+        # 相同问题合并回答的检索范围（问题本身已含跟进时补充的主题）
+        answer_scope = (index.version if index is not None else None,
+                        tuple(sorted(scope.items())) if scope else None, course_type, course_id)
+    
+        # 4. 提取课程编号并在过滤后的范围内搜索
+        if course_id:
+            course_docs = find_course_matches(course_id, filtered_docs, course_type)
+            if course_docs:
+                context = build_context(course_docs, max_chars=8000)
             
-            # 尝试从上下文中提取主题
-            topic = extract_topic_from_content(context, course_id)
+                # 尝试从上下文中提取主题
+                topic = extract_topic_from_content(context, course_id)
             
-            # 更新会话
-            if sender_id:
-                update_user_session(sender_id, course_type, course_id, topic, question)
+                # 更新会话
+                if sender_id:
+                    update_user_session(sender_id, course_type, course_id, topic, question)
             
-            return ask_llm(question, context)
+                return PendingAnswer(CONFIG, question, context, stream, scope=answer_scope)
 
-    # 5. 如果没有课程编号匹配，用关键词搜索
-    relevant_docs = search_documents(question, filtered_docs, max_results=5)
+        # 5. 如果没有课程编号匹配，用关键词搜索
+        relevant_docs = ENGINE.search(question, filtered_docs, max_results=5)
 
-    if not relevant_docs:
-        return "抱歉，没有找到与您问题相关的内容。请尝试换个关键词，或咨询教学主管。"
+        if not relevant_docs:
+            return NO_RESULTS
 
-    context = build_context(relevant_docs)
+        context = build_context(relevant_docs)
     
-    # 更新会话
-    if sender_id:
-        topic = extract_topic_from_content(context)
-        update_user_session(sender_id, course_type, course_id, topic, question)
+        # 更新会话
+        if sender_id:
+            topic = extract_topic_from_content(context)
+            update_user_session(sender_id, course_type, course_id, topic, question)
     
-    return ask_llm(question, context)
+        return PendingAnswer(CONFIG, question, context, stream, scope=answer_scope)
 
 
 # ============== 快捷命令 ==============
@@ -828,7 +394,8 @@ def handle_shortcut(cmd: str) -> str:
 
 # ============== 处理单条消息 ==============
 
-def handle_message(content: str, sender_nick: str, sender_id: str = "") -> str:
+def handle_message(content: str, sender_nick: str, sender_id: str = "",
+                   stream: ReplyStream | None = None) -> str | PendingAnswer:
     """处理用户消息并返回回复"""
     content = content.strip()
     
@@ -857,22 +424,70 @@ def handle_message(content: str, sender_nick: str, sender_id: str = "") -> str:
 • /code - CODE编程课程
 • /python - PythonAI课程
 • /价格 - 价格异议处理
+• /code2 问题 - 只在指定范围内检索（stem/小班/code1/l1/cpp等）
 
 💡 提示：您也可以私聊我，获得更专注的服务"""
 
     # 快捷命令
     if content.startswith("/"):
         cmd = content[1:].strip()
+        # 带问题的范围命令：/code2 升班规则是什么
+        scope_token, _, scoped_question = cmd.partition(" ")
+        index = ENGINE.index
+        scope = index.parse_scope(scope_token) if index and scoped_question.strip() else None
+        if scope:
+            return process_question(scoped_question.strip(), sender_id, scope=scope, stream=stream)
+
         shortcut_reply = handle_shortcut(cmd)
         if shortcut_reply:
             return shortcut_reply
 
     # 普通问答（传入sender_id用于会话管理）
-    return process_question(content, sender_id)
+    return process_question(content, sender_id, stream=stream)
 
 
 # ============== 钉钉消息处理器 ==============
 
+class DingTalkReply(ReplyStream):
+    """把流式回答送回钉钉：优先用 SDK 自带的 AI Markdown 卡片原地更新，
+    卡片创建失败（应用缺少互动卡片权限等）时改为逐段回复消息"""
+
+    def __init__(self, handler: ChatbotHandler, message: ChatbotMessage, use_card: bool = True):
+        super().__init__()
+        self.handler = handler
+        self.message = message
+        self.use_card = use_card
+        self.card = None
+        self.pending = []  # 逐段回复时尚未发出的片段（卡片的片段较短，改发消息时再攒一攒）
+        self.segment_chars = CARD_SEGMENT_CHARS if use_card else MESSAGE_SEGMENT_CHARS
+
+    def send(self, segment: str):
+        if self.use_card and self.card is None and len(self.segments) == 1:
+            card = self.handler.ai_markdown_card_start(self.message)
+            if card.card_instance_id:
+                self.card = card
+            else:
+                logger.warning("AI卡片创建失败（检查应用的互动卡片权限），改为逐段回复消息")
+        if self.card is not None:
+            self.card.ai_streaming(markdown="\n\n".join(self.segments), append=False)
+        else:
+            self.pending.append(segment)
+            if not self.use_card or sum(len(s) for s in self.pending) >= MESSAGE_SEGMENT_CHARS:
+                self._flush()
+
+    def _flush(self):
+        self.handler.reply_text("\n\n".join(self.pending), self.message)
+        self.pending = []
+
+    def finish(self, reply: str):
+        """回答结束：卡片定稿；没有流式发出过内容时（快捷回复、未检索到等）整条回复"""
+        if self.card is not None:
+            self.card.ai_finish(markdown=reply)
+        elif self.pending:
+            self._flush()
+        elif not self.segments:
+            self.handler.reply_text(reply, self.message)
+
 class StarplanetKnowledgeHandler(ChatbotHandler):
     """斯坦星球知识库机器人消息处理器"""
 
@@ -920,17 +535,27 @@ class StarplanetKnowledgeHandler(ChatbotHandler):
                 logger.info("消息内容为空，跳过")
                 return AckMessage.STATUS_OK, "OK"
             
-            # 处理消息（传入sender_id用于会话管理）
-            reply = await asyncio.to_thread(handle_message, content, sender_nick, sender_id)
+            # 根据消息类型准备回复对象（字典格式转为ChatbotMessage）
+            if isinstance(incoming_message, dict):
+                message = ChatbotMessage.from_dict(incoming_message)
+            else:
+                message = incoming_message
+            reply_stream = DingTalkReply(self, message, CONFIG["stream_card"])
+            
+            # 处理消息（传入sender_id用于会话管理；检索与大模型调用分别排队，回答边生成边送出）
+            try:
+                reply = await SCHEDULER.submit(
+                    handle_message, content, sender_nick, sender_id, reply_stream,
+                    on_queued=lambda position: self.reply_text(QUEUED_REPLY.format(position=position), message),
+                )
+            except QueueFull as e:
+                logger.warning(f"{e}，拒绝消息: {content[:50]}（{SCHEDULER.summary()}）")
+                self.reply_text(BUSY_REPLY, message)
+                return AckMessage.STATUS_OK, "OK"
+            logger.info(f"调度: {SCHEDULER.summary()}")
             
             if reply:
-                # 根据消息类型选择回复方式
-                if isinstance(incoming_message, dict):
-                    # 使用ChatbotMessage对象回复
-                    message = ChatbotMessage.from_dict(incoming_message)
-                    self.reply_text(reply, message)
-                else:
-                    self.reply_text(reply, incoming_message)
+                reply_stream.finish(reply)
                 logger.info(f"已回复: {reply[:50]}...")
             
             return AckMessage.STATUS_OK, "OK"
@@ -985,17 +610,16 @@ def check_single_instance():
 
 
 def main():
-    global KB_DOCUMENTS
-
     # 确保单实例运行
     check_single_instance()
     
-    load_config()
-    KB_DOCUMENTS = load_knowledge_base()
+    load_config(CONFIG)
+    ENGINE.start_watcher()
+    ENGINE.load()
 
     print("=" * 50)
     print("斯坦星球知识库钉钉机器人 (Stream模式)")
-    print(f"已加载 {len(KB_DOCUMENTS)} 个文档")
+    print(f"已加载 {len(ENGINE.documents())} 个文档（知识库版本 {ENGINE.index.version if ENGINE.index else '无'}）")
     print(f"进程PID: {__import__('os').getpid()}")
     print("=" * 50)
     print("\n支持私聊和群聊")
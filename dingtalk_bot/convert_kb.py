@@ -1,124 +1,110 @@
 #!/usr/bin/env python3
 """
-将斯坦星球知识库md文件转换为JSON格式，供钉钉机器人使用
+将斯坦星球知识库md文件转换为紧凑格式知识库文件，供钉钉机器人使用
 
 使用方法：
-python convert_kb.py
+python convert_kb.py          # 增量转换：只转换新增/改动的md，删除已移除源文件的输出
+python convert_kb.py --full   # 全量重建
+python convert_kb.py -j 4     # 指定并行进程数（默认CPU核数，-j 1 为串行）
+python convert_kb.py --keep 5 # 保留的快照个数（默认3）
 
-输出目录：dingtalk_bot/knowledge_base/
+输出：每次转换写入一个新快照 dingtalk_bot/kb_snapshots/<版本>/（见 kb_snapshot），内含
+      knowledge_base.pack（全部文档，正文只存一份，按块gzip压缩，格式见 kb_store）、
+      knowledge_base/_总索引.json、预建索引文件与段落向量；全部写完并生成校验清单后
+      才原子切换 kb_snapshots/CURRENT，不改动机器人正在读取的任何文件。
+
+增量转换依据 kb_snapshots/convert_manifest.json 中记录的每个源文件的路径、mtime、大小与
+内容哈希；转换器版本变化、没有清单或当前快照不是清单对应的版本时自动全量重建。
+改动过的源文件转换失败时沿用上一版本的文档（清单不更新，下次运行重试），失败记入转换报告。
+预建索引文件与段落向量在当前快照的基础上增量生成。
+
+预建索引中同时保存每个段落交给大模型的精简文本（表格改为“键：值”行、去掉排版符号，
+见 kb_chunker.lean_text），机器人回答时直接使用，不再逐次处理。
+
+每次转换都对全部段落做一次 MinHash/LSH 近似去重（见 kb_dedup），重复分组写入预建索引，
+机器人检索与构建上下文时合并同组段落；签名随预建索引保存，增量转换时只为新段落计算。
+
+发布前生成转换报告 knowledge_base.report.json（随快照保存，见 kb_report）：按来源目录与
+逐篇文档统计源文件大小、段落数、估算 token、最大的小节、重复占比与转换耗时，生成文件的
+大小与预建索引加载耗时，以及与上一版本相比的增长；控制台打印摘要。正文未变的文档沿用
+上一版本报告中的统计。
+
+md转换、全量建索引时的切词、近似去重的签名与向量特征提取分发到进程池，结果按原顺序合并，
+输出与串行运行逐字节相同；结束时打印各阶段耗时。
 
 更新日期：2026-02-10
-版本：V2.0 - 支持500+课程文件（单节课拆分版）
+版本：V2.7 - 转换报告
 """
 import os
+import sys
 import json
-import re
+import time
+import hashlib
+import argparse
+import gc
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-def md_to_json(md_path):
-    """将单个md文件转换为JSON格式"""
+from kb_chunker import CHUNKER_VERSION, RENDER_VERSION, iter_blocks, iter_lines
+from kb_dedup import duplicate_stats, find_duplicates, minhash_all, pack_signatures, unpack_signatures
+from kb_report import build_report, estimate_tokens, load_report, print_report, save_report
+from kb_store import build_index, index_path, load_index, load_pack, pack_path, patch_index, save_index, save_pack, section_spans
+from kb_snapshot import KEEP_SNAPSHOTS, new_snapshot, publish, resolve_snapshot, snapshot_root
+from kb_vectors import VECTORS_AVAILABLE, build_vectors, patch_vectors, vector_paths
+
+CONVERTER_VERSION = 'V2.7'
+# 分块与精简文本规则的版本：变了时预建索引、报告都要重新生成，按全量重建处理
+RULE_VERSIONS = {'chunker': CHUNKER_VERSION, 'render': RENDER_VERSION}
+MANIFEST_NAME = 'convert_manifest.json'  # 放在快照根目录，不属于任何快照
+
+# 跳过的文件模式
+SKIP_PATTERNS = ['_索引', '_总索引', 'README', 'QUICKSTART', 'NotebookLM',
+                 '交付文档', '协议库', '_备份', '进度报告']
+
+
+def md_to_document(md_path, file_name):
+    """将单个md文件转换为知识库文档：正文只保留一份，章节记为正文中的 (标题, 起, 止) 偏移"""
     with open(md_path, 'r', encoding='utf-8') as f:
         content = f.read()
 
-    # 提取标题
-    title_match = re.search(r'^#\s+(.+)$', content, re.MULTILINE)
-    title = title_match.group(1) if title_match else Path(md_path).stem
-
-    # 提取章节
-    sections = []
-    current_section = None
-    current_content = []
-
-    for line in content.split('\n'):
-        if line.startswith('## '):
-            if current_section:
-                sections.append({
-                    'title': current_section,
-                    'content': '\n'.join(current_content).strip()
-                })
-            current_section = line[3:].strip()
-            current_content = []
-        elif current_section:
-            current_content.append(line)
-
-    if current_section:
-        sections.append({
-            'title': current_section,
-            'content': '\n'.join(current_content).strip()
-        })
+    # 标题：第一个一级标题（代码块里的 # 注释不算）
+    title = next((heading for kind, _, _, level, heading in iter_blocks(iter_lines(content))
+                  if kind == 'heading' and level == 1), None) or Path(md_path).stem
 
     return {
         'title': title,
         'source': str(md_path),
-        'sections': sections,
-        'full_content': content
+        'file': file_name,  # 文件名带有 来源_级别_模块 分面信息（见 kb_index.document_facets）
+        'content': content,
+        'sections': section_spans(content),
     }
 
-def process_directory(input_dir, output_dir, prefix=""):
-    """处理目录下所有md文件"""
-    input_path = Path(input_dir)
-    output_path = Path(output_dir)
-    output_path.mkdir(parents=True, exist_ok=True)
 
-    index = []
+def list_directory(input_dir, prefix=""):
+    """列出目录下需要转换的md文件：返回 ([(md路径, 输出文件名, 总索引中的source)], 跳过的文件)"""
+    input_path = Path(input_dir)
+    sources = []
     skipped = []
 
-    # 跳过的文件模式
-    skip_patterns = ['_索引', '_总索引', 'README', 'QUICKSTART', 'NotebookLM',
-                     '交付文档', '协议库', '_备份', '进度报告']
-
     for md_file in input_path.rglob('*.md'):
         # 跳过某些文件
-        if any(p in str(md_file) for p in skip_patterns):
+        if any(p in str(md_file) for p in SKIP_PATTERNS):
             skipped.append(str(md_file))
             continue
 
-        try:
-            data = md_to_json(md_file)
-
-            # 生成输出文件名
-            relative_path = md_file.relative_to(input_path)
-            json_name = str(relative_path).replace('/', '_').replace('\\', '_').replace('.md', '.json')
-            if prefix:
-                json_name = f"{prefix}_{json_name}"
-            json_path = output_path / json_name
+        # 生成输出文件名
+        relative_path = md_file.relative_to(input_path)
+        json_name = str(relative_path).replace('/', '_').replace('\\', '_').replace('.md', '.json')
+        if prefix:
+            json_name = f"{prefix}_{json_name}"
+        sources.append((md_file, json_name, str(relative_path)))
 
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+    return sources, skipped
 
-            index.append({
-                'title': data['title'],
-                'file': json_name,
-                'source': str(relative_path)
-            })
-            print(f"[OK] {relative_path}")
-        except Exception as e:
-            print(f"[ERR] {md_file}: {e}")
 
-    return index, skipped
-
-def main():
-    """主函数"""
-    # 输出目录
-    output_dir = Path(__file__).parent / 'knowledge_base'
-
-    # 清空旧文件（保留_总索引.json）
-    if output_dir.exists():
-        for f in output_dir.glob('*.json'):
-            if f.name != '_总索引.json':
-                f.unlink()
-
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    # 知识库根目录
-    kb_root = Path(__file__).parent.parent / '知识库'
-
-    print("=" * 60)
-    print("斯坦星球知识库转换工具 V2.0")
-    print("=" * 60)
-
-    all_index = []
-    total_converted = 0
+def collect_sources(kb_root, shared_kb):
+    """按优先级收集全部源文件，顺序即总索引中的顺序"""
+    sources = []
     total_skipped = 0
 
     # 需要转换的目录（按优先级排序）
@@ -147,43 +133,22 @@ def main():
     for subdir, prefix, priority in dirs_to_process:
         full_path = kb_root / subdir
         if full_path.exists():
-            print(f"\n=== [{priority}] {subdir} ===")
-
             # 特殊处理：萃取报告根目录只处理素材文件
             if subdir == '萃取报告' and prefix == '素材':
                 # 只处理根目录的md文件，不递归
-                index = []
                 for md_file in full_path.glob('*.md'):
                     if '素材' in md_file.name:
-                        try:
-                            data = md_to_json(md_file)
-                            json_name = f"{prefix}_{md_file.name.replace('.md', '.json')}"
-                            json_path = output_dir / json_name
-                            with open(json_path, 'w', encoding='utf-8') as f:
-                                json.dump(data, f, ensure_ascii=False, indent=2)
-                            index.append({
-                                'title': data['title'],
-                                'file': json_name,
-                                'source': md_file.name
-                            })
-                            print(f"[OK] {md_file.name}")
-                        except Exception as e:
-                            print(f"[ERR] {md_file}: {e}")
-                all_index.extend(index)
-                total_converted += len(index)
+                        json_name = f"{prefix}_{md_file.name.replace('.md', '.json')}"
+                        sources.append((md_file, json_name, md_file.name))
             else:
-                index, skipped = process_directory(full_path, output_dir, prefix)
-                all_index.extend(index)
-                total_converted += len(index)
+                found, skipped = list_directory(full_path, prefix)
+                sources.extend(found)
                 total_skipped += len(skipped)
         else:
             print(f"[SKIP] 目录不存在: {subdir}")
 
     # 检查shared/knowledge_base目录（兼容旧结构）
-    shared_kb = Path(__file__).parent.parent / 'shared' / 'knowledge_base'
     if shared_kb.exists():
-        print(f"\n=== [LEGACY] shared/knowledge_base ===")
-
         legacy_dirs = [
             ('执行层专区', '执行层'),
             ('管理层专区', '管理层'),
@@ -194,28 +159,330 @@ def main():
         for subdir, prefix in legacy_dirs:
             full_path = shared_kb / subdir
             if full_path.exists():
-                index, skipped = process_directory(full_path, output_dir, prefix)
-                all_index.extend(index)
-                total_converted += len(index)
+                found, skipped = list_directory(full_path, prefix)
+                sources.extend(found)
                 total_skipped += len(skipped)
 
-    # 写入总索引
-    with open(output_dir / '_总索引.json', 'w', encoding='utf-8') as f:
-        json.dump({
-            'total': len(all_index),
-            'updated': '2026-02-10',
-            'version': 'V2.0',
-            'documents': all_index
-        }, f, ensure_ascii=False, indent=2)
+    return sources, total_skipped
+
+
+def load_manifest(manifest_path):
+    """读取转换清单；转换器或分块/精简文本规则的版本不同、没有清单时返回None（需要全量重建）"""
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('converter_version') != CONVERTER_VERSION or manifest.get('rules') != RULE_VERSIONS:
+        return None
+    return manifest
+
+
+def convert_source(md_file, file_name):
+    """转换单个源文件，返回 (文档, 内容哈希)"""
+    raw = md_file.read_bytes()
+    return md_to_document(md_file, file_name), hashlib.sha256(raw).hexdigest()
+
+
+def convert_task(task):
+    """进程池任务：转换一个文件，返回 ((文档, 内容哈希, 耗时ms), None)；
+    出错时返回错误信息而不是抛出（不影响其他文件）"""
+    md_file, file_name = task
+    started = time.perf_counter()
+    try:
+        doc, digest = convert_source(md_file, file_name)
+        return (doc, digest, round((time.perf_counter() - started) * 1000, 1)), None
+    except Exception as e:
+        return None, str(e)
+
+
+def load_previous(output_dir):
+    """上次转换的文档（文件名 -> 文档），没有或无法读取紧凑格式文件时返回None"""
+    try:
+        return {doc['file']: doc for doc in load_pack(output_dir, sections=True)}
+    except (OSError, ValueError):
+        return None
+
+
+def merge_converted(plan, results, previous, old_docs):
+    """按 plan 顺序合并沿用的与新转换的文档（results 依次对应 plan 中需要转换的条目）
+
+    返回 (新清单条目, 文件名 -> 文档, 总索引条目, 计数, 转换失败列表)。改动过的源文件转换
+    失败时沿用上一版本的文档与清单条目（清单中仍是旧的 mtime/哈希，下次运行会重试），
+    不会因为一次偶发的解析错误把原本能回答的文档从快照中删掉。
+    """
+    current = {}
+    docs = {}
+    all_index = []
+    counts = {'added': 0, 'changed': 0, 'unchanged': 0}
+    failures = []
+    for key, md_file, json_name, index_source, stat, entry in plan:
+        if entry:
+            entry = dict(entry, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            docs[json_name] = old_docs[json_name]
+            counts['unchanged'] += 1
+        else:
+            converted, error = next(results)
+            if error:
+                entry = previous.get(key)
+                retained = bool(entry) and entry['output'] == json_name and json_name in old_docs
+                failures.append({'file': json_name, 'source': index_source, 'error': error, 'retained': retained})
+                if not retained:
+                    print(f"[ERR] {md_file}: {error}")
+                    continue
+                print(f"[ERR] {md_file}: {error}（沿用上一版本）")
+                docs[json_name] = old_docs[json_name]
+            else:
+                doc, digest, convert_ms = converted
+                docs[json_name] = doc
+                entry = {
+                    'output': json_name,
+                    'title': doc['title'],
+                    'index_source': index_source,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'size': stat.st_size,
+                    'sha256': digest,
+                    'convert_ms': convert_ms,
+                }
+                counts['changed' if key in previous else 'added'] += 1
+                print(f"[OK] {index_source}")
+
+        current[key] = entry
+        all_index.append({
+            'title': entry['title'],
+            'file': json_name,
+            'source': entry['index_source']
+        })
+    return current, docs, all_index, counts, failures
+
+
+def update_derived(previous_dir, output_dir, documents, full, executor=None, workers=1, timings=None):
+    """生成预建索引文件与段落向量：增量时在上一版本（previous_dir）基础上只对改动的文档
+    重新切词/嵌入，全量时可并行；结果写到 output_dir"""
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+
+    old_index = None
+    known = {}  # 上一版本段落正文 -> MinHash 签名
+    if not full:
+        try:
+            old_index = load_index(previous_dir, check_source=False)
+        except (OSError, ValueError) as e:
+            print(f"[INFO] 无法增量更新预建索引，改为全量生成: {e}")
+    if old_index is not None:
+        if old_index.signatures is not None:
+            known = unpack_signatures([chunk['content'] for chunk in old_index.chunks], old_index.signatures)
+        index, retokenized = patch_index(old_index, documents)
+        del old_index  # 尽早释放对上一版本索引文件的映射
+        print(f"[OK] 预建索引增量更新：重新切词 {retokenized} 篇文档")
+    else:
+        index = build_index(documents, executor, workers)
+    raw_tokens = sum(estimate_tokens(chunk['content']) for chunk in index.chunks)
+    lean_tokens = sum(map(estimate_tokens, index.lean))
+    print(f"[OK] 精简文本约 {lean_tokens} token，比原文少 {1 - lean_tokens / max(raw_tokens, 1):.1%}")
+    timings['预建索引'] = time.perf_counter() - started
+
+    # 近似重复段落：未改动段落复用上一版本的签名，全部段落重新分组（重复关系跨文档，
+    # 改动一篇也可能影响别的组）
+    started = time.perf_counter()
+    texts = [chunk['content'] for chunk in index.chunks]
+    signatures = minhash_all(texts, executor, known)
+    index.canonical = find_duplicates(texts, signatures=signatures)
+    index.signatures = pack_signatures(signatures)
+    duplicates, groups = duplicate_stats(index.canonical)
+    reused = sum(text in known for text in texts)
+    print(f"[OK] 近似重复段落 {duplicates} 个（{groups} 组），检索时合并；复用签名 {reused}/{len(texts)} 个段落")
+    timings['去重'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    index_file = save_index(index, output_dir)
+    print(f"[OK] 已生成预建索引 {index_file.name}（{index_file.stat().st_size // 1024} KB）")
+    timings['预建索引'] += time.perf_counter() - started
+
+    # 段落向量（可选，供 rank_engine=vector 使用）
+    started = time.perf_counter()
+    if VECTORS_AVAILABLE:
+        patched = None if full else patch_vectors(documents, output_dir, previous_dir)
+        if patched is None:
+            chunk_count = build_vectors(documents, output_dir, executor=executor)
+            print(f"[OK] 已生成 {chunk_count} 个段落的向量")
+        else:
+            print(f"[OK] 段落向量增量更新：新嵌入 {patched} 个段落")
+        timings['段落向量'] = time.perf_counter() - started
+    else:
+        print("[SKIP] 未安装numpy，跳过向量生成")
+    return index
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='将知识库md转换为机器人使用的紧凑格式知识库文件')
+    parser.add_argument('--full', action='store_true', help='全量重建')
+    parser.add_argument('--compress', choices=['gzip', 'none'], default='gzip', help='正文压缩方式（默认gzip）')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='并行进程数（默认CPU核数，1为串行）')
+    parser.add_argument('--keep', type=int, default=KEEP_SNAPSHOTS,
+                        help=f'保留的快照个数（默认{KEEP_SNAPSHOTS}）')
+    parser.add_argument('--time-load', action='store_true',
+                        help='增量转换时也加载一次新的预建索引计时（全量转换总是计时）')
+    args = parser.parse_args()
+    full = args.full
+    workers = max(1, args.jobs)
+    timings = {}
+    started = total_started = time.perf_counter()
+
+    # 知识库目录（机器人配置中的 kb_path），快照目录在它旁边
+    kb_dir = Path(__file__).parent / 'knowledge_base'
+    previous_dir, previous_version = resolve_snapshot(kb_dir)
+    manifest_path = snapshot_root(kb_dir) / MANIFEST_NAME
+
+    # 知识库根目录
+    kb_root = Path(__file__).parent.parent / '知识库'
+    shared_kb = Path(__file__).parent.parent / 'shared' / 'knowledge_base'
+
+    print("=" * 60)
+    print(f"斯坦星球知识库转换工具 {CONVERTER_VERSION}")
+    print("=" * 60)
+
+    manifest = None if full else load_manifest(manifest_path)
+    # 清单记录的是哪个版本的转换结果；回滚过或手动改过 CURRENT 时全量重建
+    if manifest is not None and manifest.get('snapshot') != previous_version:
+        manifest = None
+    old_docs = None if manifest is None else load_previous(previous_dir)
+    if old_docs is None:
+        full = True
+        print("[INFO] 全量重建")
+        manifest = {'converter_version': CONVERTER_VERSION, 'sources': {}}
+        old_docs = {}
+
+    sources, total_skipped = collect_sources(kb_root, shared_kb)
+    previous = manifest['sources']
+
+    # 第一遍：判断哪些源文件需要转换
+    # 文档名沿用原先的JSON文件名（带 来源_级别_模块 分面信息），作为文档在知识库文件中的标识
+    plan = []  # (清单键, md路径, 文档名, 总索引source, stat, 可沿用的清单条目)
+    for md_file, json_name, index_source in sources:
+        key = md_file.relative_to(kb_root.parent).as_posix()
+        stat = md_file.stat()
+        entry = previous.get(key)
+        if entry and entry['output'] == json_name and json_name in old_docs:
+            if (entry['mtime_ns'], entry['size']) != (stat.st_mtime_ns, stat.st_size):
+                # mtime/大小变了再比较内容哈希（只是被touch过的不重新转换）
+                digest = hashlib.sha256(md_file.read_bytes()).hexdigest()
+                if digest != entry['sha256']:
+                    entry = None
+        else:
+            entry = None
+        plan.append((key, md_file, json_name, index_source, stat, entry))
+    timings['扫描'] = time.perf_counter() - started
+
+    version = previous_version
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        # 第二遍：转换（并行时按提交顺序取回结果，输出与串行一致）
+        started = time.perf_counter()
+        tasks = [(md_file, json_name) for _, md_file, json_name, _, _, entry in plan if not entry]
+        if executor is not None and len(tasks) > 1:
+            results = iter(executor.map(convert_task, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+        else:
+            results = map(convert_task, tasks)
+
+        current, docs, all_index, counts, failures = merge_converted(plan, results, previous, old_docs)
+        added, changed, unchanged = counts['added'], counts['changed'], counts['unchanged']
+
+        # 源文件已移除（或输出文件名变了）的旧文档：不再写入新快照
+        removed = 0
+        for key, entry in previous.items():
+            if key not in current and entry['output'] not in docs:
+                removed += 1
+                print(f"[DEL] {entry['output']}")
+
+        updated = full or added or changed or removed
+        if updated:
+            # 所有结果先写进暂存快照，全部完成后才发布，机器人不会看到半成品
+            version, output_dir = new_snapshot(kb_dir)
+
+            # 知识库文件：按文档名排序，与读取旧版JSON目录时的文档顺序一致
+            documents = [docs[name] for name in sorted(docs)]
+            kb_file = save_pack(documents, output_dir, args.compress)
+            print(f"[OK] 已生成知识库文件 {kb_file.name}（{kb_file.stat().st_size // 1024} KB）")
+
+            # 写入总索引
+            with open(output_dir / '_总索引.json', 'w', encoding='utf-8') as f:
+                json.dump({
+                    'total': len(all_index),
+                    'updated': '2026-02-10',
+                    'version': 'V2.0',
+                    'documents': all_index
+                }, f, ensure_ascii=False, indent=2)
+        timings['转换'] = time.perf_counter() - started
+
+        if updated:
+            print()
+            # 建索引用的文档不带章节偏移，与机器人读取知识库文件得到的一致
+            documents = [
+                {key: value for key, value in doc.items() if key != 'sections'} for doc in documents if doc['content']
+            ]
+            index = update_derived(previous_dir, output_dir, documents, full, executor, workers, timings)
+
+            # 转换报告：与上一版本的报告比较增长。全量转换（或 --time-load）时加载一次刚生成的
+            # 预建索引计时；增量转换只改了几篇文档，省下这次加载
+            started = time.perf_counter()
+            load_seconds = None
+            if full or args.time_load:
+                loaded = load_index(output_dir, check_source=False)
+                load_seconds = time.perf_counter() - started
+                del loaded
+                gc.collect()  # 索引有循环引用，及时回收以释放文件映射（Windows 上改名暂存目录需要）
+            artifacts = {
+                path.name: path.stat().st_size
+                for path in (pack_path(output_dir), index_path(output_dir), *vector_paths(output_dir))
+                if path.exists()
+            }
+            sources_info = {
+                entry['output']: {'bytes': entry['size'], 'convert_ms': entry.get('convert_ms')}
+                for entry in current.values()
+            }
+            report = build_report(index, sources_info, artifacts, load_seconds, version, load_report(previous_dir),
+                                  failures)
+            save_report(report, output_dir)
+            print_report(report)
+            timings['报告'] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            snapshot = publish(kb_dir, version, {
+                'converter_version': CONVERTER_VERSION,
+                'previous': previous_version,
+                'documents': len(index.documents),
+                'chunks': len(index.chunks),
+                'duplicates': duplicate_stats(index.canonical)[0],
+            }, keep=args.keep)
+            del index
+            print(f"[OK] 已发布快照 {version}（{snapshot}）")
+            timings['发布'] = time.perf_counter() - started
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # 清单最后写：中途失败时下次运行仍会把这些文件当作改动重新处理
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump({'converter_version': CONVERTER_VERSION, 'rules': RULE_VERSIONS, 'snapshot': version, 'sources': current},
+                  f, ensure_ascii=False, indent=2)
+    timings['总计'] = time.perf_counter() - total_started
 
     print(f"\n{'=' * 60}")
     print(f"完成！")
-    print(f"  - 已转换: {total_converted} 个文件")
+    print(f"  - 新增: {added}  修改: {changed}  删除: {removed}  未变: {unchanged}")
+    if failures:
+        retained = sum(failure['retained'] for failure in failures)
+        print(f"  - 转换失败: {len(failures)} 个（{retained} 个沿用上一版本）")
     print(f"  - 已跳过: {total_skipped} 个文件")
-    print(f"  - 输出目录: {output_dir}")
+    print(f"  - 当前版本: {version or '无'}（{snapshot_root(kb_dir)}）")
+    print(f"  - 耗时（{workers} 进程）: " + "  ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items()))
     print("=" * 60)
 
-    return total_converted
+    return added + changed
 
 if __name__ == '__main__':
     main()
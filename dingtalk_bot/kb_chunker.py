@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+斯坦星球知识库 - 按标题层级切分段落
+
+原先只按 `## ` 切 section，### / #### 小节、表格与列表全堆在一个 section 里，超长时
+再在任意空行处硬切：表格可能被拦腰切断，Python 课的代码块里 `# 注释` 也会被当成标题。
+这里逐行扫描 markdown（生成器，不预先切分整篇文本）：
+
+- 跟踪 H1~H4 的标题路径，代码块（``` / ~~~）内的 # 行不算标题
+- 表格（连续的 | 行）与代码块是不可分的整体，只有它们本身超长时才按行切开
+- H1/H2 总是开始新的段落；H3/H4 小节在当前段落已有 CHUNK_MIN_CHARS 字时开始新段落，
+  否则并入当前段落（避免大量只有两三行的碎段落）
+- 段落不超过 CHUNK_MAX_CHARS 字，在块（段、表格、代码、标题）边界处断开
+
+产出 (起, 止, 标题路径)：字符区间指向原文，标题路径是 ((级别, 标题), ...)，段落跨越
+多个小节时取它们共同的上级。kb_index.split_chunks 据此生成段落，预建索引、段落向量与
+近似去重都使用同一份分块。
+"""
+
+import re
+
+CHUNK_MAX_CHARS = 1600  # 与原先片段窗口(400+1200)相当
+CHUNK_MIN_CHARS = 400  # H3/H4 小节在当前段落短于此值时并入
+MAX_HEADING_LEVEL = 4
+CHUNKER_VERSION = 2  # 分块规则变化时递增，预建索引与向量文件据此判断是否需要重新生成
+BREADCRUMB_SEPARATOR = " > "
+
+HEADING_RE = re.compile(r"(#{1,6})[ \t]+(.*?)[ \t#]*$")
+FENCE_RE = re.compile(r"[ \t]{0,3}(`{3,}|~{3,})")
+
+
+def iter_lines(text: str):
+    """逐行产出（保留换行符），不一次性切分整篇文本"""
+    pos = 0
+    length = len(text)
+    while pos < length:
+        end = text.find("\n", pos)
+        end = length if end == -1 else end + 1
+        yield text[pos:end]
+        pos = end
+
+
+def iter_blocks(lines):
+    """把行归并为块，产出 (类型, 起, 行尾偏移列表, 标题级别, 标题)
+
+    类型为 heading / table / code / text：代码块从起始标记到结束标记，表格是连续的 | 行，
+    段落是空行之间的连续行。空行并入前一个块；行尾偏移供超长块按行切开。
+    """
+    pos = 0
+    block = None  # [类型, 起, 行尾偏移列表, 级别, 标题]
+    fence = None  # 所在代码块的起始标记（``` 或 ~~~ 串）
+    after_blank = False
+    for line in lines:
+        start, pos = pos, pos + len(line)
+        stripped = line.strip()
+
+        if fence is not None:
+            block[2].append(pos)
+            if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                fence = None
+            continue
+        if not stripped:
+            if block is not None:
+                block[2].append(pos)
+            after_blank = True
+            continue
+
+        first = stripped[0]
+        heading = HEADING_RE.match(stripped) if first == "#" else None
+        fence_match = FENCE_RE.match(line) if first in "`~" else None
+        if fence_match:
+            kind = "code"
+            fence = fence_match.group(1)
+        elif heading and len(heading.group(1)) <= MAX_HEADING_LEVEL:
+            kind = "heading"
+        elif first == "|":
+            kind = "table"
+        else:
+            kind = "text"
+
+        if block is not None and kind == block[0] and kind in ("table", "text") and not after_blank:
+            block[2].append(pos)
+            continue
+        after_blank = False
+        if block is not None:
+            yield tuple(block)
+        if kind == "heading":
+            block = [kind, start, [pos], len(heading.group(1)), heading.group(2).strip()]
+        else:
+            block = [kind, start, [pos], 0, ""]
+    if block is not None:
+        yield tuple(block)
+
+
+def _split_lines(start: int, line_ends: list[int], max_chars: int):
+    """超长块在行边界处切成不超过 max_chars 的片段，单行超长时硬切"""
+    piece_start = start
+    last_cut = start
+    for end in line_ends:
+        if end - piece_start > max_chars:
+            if last_cut > piece_start:
+                yield piece_start, last_cut
+                piece_start = last_cut
+            while end - piece_start > max_chars:
+                yield piece_start, piece_start + max_chars
+                piece_start += max_chars
+        last_cut = end
+    if line_ends[-1] > piece_start:
+        yield piece_start, line_ends[-1]
+
+
+def _common_path(a: tuple, b: tuple) -> tuple:
+    common = []
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        common.append(x)
+    return tuple(common)
+
+
+def iter_chunks(lines, max_chars: int = CHUNK_MAX_CHARS):
+    """逐行读入 markdown（任意行的可迭代对象，如 iter_lines(text) 或打开的文件），
+    产出段落 (起, 止, 标题路径)；区间按读入的字符数计算"""
+    path = ()  # 当前的标题路径 ((级别, 标题), ...)
+    start = end = None  # 正在累积的段落区间
+    chunk_path = ()
+    for kind, block_start, line_ends, level, title in iter_blocks(lines):
+        block_end = line_ends[-1]
+        if kind == "heading":
+            path = tuple(item for item in path if item[0] < level) + ((level, title),)
+            if start is not None and (level <= 2 or end - start >= CHUNK_MIN_CHARS):
+                yield start, end, chunk_path
+                start = None
+        if start is not None and block_end - start > max_chars:
+            yield start, end, chunk_path
+            start = None
+
+        if start is None:
+            start, chunk_path = block_start, path
+        elif kind == "heading":
+            chunk_path = _common_path(chunk_path, path)  # 并入的小节：取共同的上级
+        end = block_end
+
+        # 块本身就超长（大表格、长代码、没有空行的长段落）：按行切开，最后一片留作当前段落
+        if end - start > max_chars:
+            pieces = list(_split_lines(start, line_ends, max_chars))
+            for piece_start, piece_end in pieces[:-1]:
+                yield piece_start, piece_end, chunk_path
+            start = pieces[-1][0]
+    if start is not None:
+        yield start, end, chunk_path
+
+
+def breadcrumb(path: tuple, title: str = "") -> str:
+    """标题路径 -> "小节 > 子小节"；与文档标题相同的一级标题省略"""
+    names = [name for level, name in path if not (level == 1 and name == title)]
+    return BREADCRUMB_SEPARATOR.join(names)
+
+
+# ============== 供大模型阅读的精简文本 ==============
+
+RENDER_VERSION = 2  # 精简规则变化时递增，预建索引据此判断是否需要重新生成
+
+TABLE_RULE_RE = re.compile(r"^\|?[\s:|-]*-[\s:|-]*\|?$")  # 表格的 |---|:---:| 分隔行
+HORIZONTAL_RULE_RE = re.compile(r"^(?:[-*_][ \t]*){3,}$")
+INLINE_MARKUP_RE = re.compile(r"\*\*|__|`")
+LINK_RE = re.compile(r"!?\[([^\]]*)\]\([^)]*\)")
+UID_RE = re.compile(r"\[UID:[^\]]*\]")
+QUOTE_RE = re.compile(r"^(?:>[ \t]?)+")
+SPACES_RE = re.compile(r"[ \t]{2,}")
+TABLE_CELL_SEPARATOR = " / "  # 多列表格一行内各单元格之间
+
+
+def _table_cells(line: str) -> list[str]:
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|"):
+        line = line[:-1]
+    return [_lean_inline(cell) for cell in line.split("|")]
+
+
+def _lean_inline(text: str) -> str:
+    text = LINK_RE.sub(r"\1", text)
+    text = UID_RE.sub("", text)
+    text = INLINE_MARKUP_RE.sub("", text)
+    return SPACES_RE.sub(" ", text).strip()
+
+
+def _lean_table(lines: list[str]) -> list[str]:
+    """表格 -> 每行一条：两列表为“键：值”；多列表先列一行表头，之后每行“值1 / 值2 / 值3”
+    （空单元格写作 -，位置与表头对应），不在每个单元格前重复表头"""
+    rows = [line for line in lines if line.strip()]
+    header = None
+    if len(rows) > 1 and TABLE_RULE_RE.match(rows[1].strip()):
+        header = _table_cells(rows[0])
+        rows = rows[2:]
+    out = []
+    if header and len(header) > 2 and any(header):
+        out.append(TABLE_CELL_SEPARATOR.join(name or "-" for name in header))
+    for row in rows:
+        if TABLE_RULE_RE.match(row.strip()):
+            continue
+        cells = _table_cells(row)
+        if len(cells) == 2:
+            key, value = cells
+            out.append(f"{key}：{value}" if key and value else key or value)
+        elif any(cells):
+            out.append(TABLE_CELL_SEPARATOR.join(cell or "-" for cell in cells))
+    return [line for line in out if line]
+
+
+def lean_text(text: str) -> str:
+    """markdown 段落 -> 交给大模型的精简文本（转换知识库时预先生成，随预建索引保存）
+
+    去掉排版符号（**、`、分隔线、引用符、表格竖线与分隔行、[UID: ...] 标记），两列表格改为
+    “键：值”行、多列表格改为一行表头加“a / b / c”行，标题只留文字，空行合并；代码块原样
+    保留（缩进有意义）。内容不删减。
+    """
+    out = []
+    for kind, start, line_ends, level, title in iter_blocks(iter_lines(text)):
+        lines = [text[a:b] for a, b in zip([start] + line_ends[:-1], line_ends)]
+        if kind == "heading":
+            out.append(_lean_inline(title))
+        elif kind == "code":
+            out.extend(line.rstrip() for line in lines if not FENCE_RE.match(line) and line.strip())
+        elif kind == "table":
+            out.extend(_lean_table(lines))
+        else:
+            for line in lines:
+                line = QUOTE_RE.sub("", line.strip())
+                if HORIZONTAL_RULE_RE.match(line):
+                    continue
+                line = _lean_inline(line)
+                if line:
+                    out.append(line)
+    return "\n".join(out)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+斯坦星球知识库 - 近似重复段落
+
+同一份课程内容常在知识库里出现好几次：萃取报告的单节课文件、模块概览（_模块概览）、
+知识点数据库与项目案例库的汇总都会大段重复课文。检索时前5个段落经常是几乎相同的
+内容，8000字的上下文里信息量很少。转换知识库时对全部段落（与 kb_index.split_chunks
+的分块一致）做一次 MinHash/LSH 近似去重：
+
+- 规范化：小写，去掉空白与标点（表格竖线、**、--- 等排版差异不影响判断）
+- MinHash：5字shingle，单次哈希 + 64个分桶取最小值（one-permutation hashing，
+  空桶向后借值），每个段落只需一次 crc32 / shingle
+- LSH：16个band × 4行，同一band取值完全相同的段落成为候选，估计的 Jaccard 相似度
+  不低于 DUPLICATE_THRESHOLD 才算重复；重复关系传递合并成组
+- 每组保留最长（信息最全）的段落为代表，其余段落记为它的重复
+
+结果是 块ID -> 代表块ID 的数组（代表与不重复的段落指向自己），随预建索引文件保存；
+检索与构建上下文时同组段落只保留排名最高的一个。
+
+签名只取决于段落正文，也随预建索引保存：增量转换时未改动段落的签名直接复用，只为
+新段落计算（计算签名占去重耗时的大半）。分桶与比对仍覆盖全部段落——删掉一个段落
+可能把原来经它连起来的一组拆开，只看改动段落所在的桶得不到与全量相同的结果。
+"""
+
+import re
+import zlib
+from array import array
+from collections import defaultdict
+
+SHINGLE_CHARS = 5
+MINHASH_BINS = 64
+LSH_BANDS = 16
+DUPLICATE_THRESHOLD = 0.8  # 估计 Jaccard 相似度不低于此值视为重复
+MIN_DEDUP_CHARS = 50  # 规范化后过短的段落（只有标题、一两行）不参与去重
+MINHASH_BATCH = 64  # 并行计算时每次发给子进程的段落数
+
+NORMALIZE_RE = re.compile(r"[\W_]+")
+EMPTY_BIN = 0xFFFFFFFF
+
+
+def minhash(text: str) -> tuple[int, ...] | None:
+    """段落的 MinHash 签名；规范化后太短时返回 None（不参与去重）"""
+    text = NORMALIZE_RE.sub("", text.lower())
+    if len(text) < MIN_DEDUP_CHARS:
+        return None
+    bins = [EMPTY_BIN] * MINHASH_BINS
+    crc32 = zlib.crc32
+    for i in range(len(text) - SHINGLE_CHARS + 1):
+        h = crc32(text[i:i + SHINGLE_CHARS].encode("utf-8"))
+        b = h % MINHASH_BINS
+        v = h // MINHASH_BINS
+        if v < bins[b]:
+            bins[b] = v
+    # 空桶取其后第一个非空桶的值（循环），保证签名可比
+    filled = next(i for i in range(MINHASH_BINS) if bins[i] != EMPTY_BIN)
+    for offset in range(MINHASH_BINS, 0, -1):
+        i = (filled + offset) % MINHASH_BINS
+        if bins[i] == EMPTY_BIN:
+            bins[i] = bins[(i + 1) % MINHASH_BINS]
+    return tuple(bins)
+
+
+def similarity(a: tuple[int, ...], b: tuple[int, ...]) -> float:
+    """两个签名估计的 Jaccard 相似度"""
+    return sum(x == y for x, y in zip(a, b)) / MINHASH_BINS
+
+
+def minhash_all(texts: list[str], executor=None, known: dict | None = None) -> list:
+    """全部段落的签名；known 为 正文 -> 签名（上一版本的签名），只为其余正文计算，
+    给出进程池时分发到子进程计算"""
+    known = dict(known or {})
+    missing = [text for text in dict.fromkeys(texts) if text not in known]
+    if executor is None:
+        known.update(zip(missing, map(minhash, missing)))
+    else:
+        known.update(zip(missing, executor.map(minhash, missing, chunksize=MINHASH_BATCH)))
+    return [known[text] for text in texts]
+
+
+def pack_signatures(signatures: list) -> array:
+    """签名拼成一个数组随预建索引保存，每个段落 MINHASH_BINS 个值，不参与去重的段落全为 EMPTY_BIN"""
+    packed = array("I")
+    for signature in signatures:
+        packed.extend(signature if signature is not None else (EMPTY_BIN,) * MINHASH_BINS)
+    return packed
+
+
+def unpack_signatures(texts: list[str], packed) -> dict:
+    """预建索引中保存的签名还原为 正文 -> 签名（供 minhash_all 的 known）"""
+    known = {}
+    for i, text in enumerate(texts):
+        signature = tuple(packed[i * MINHASH_BINS:(i + 1) * MINHASH_BINS])
+        known[text] = None if signature[0] == EMPTY_BIN else signature
+    return known
+
+
+def find_duplicates(texts: list[str], executor=None, signatures: list | None = None) -> array:
+    """返回 块ID -> 代表块ID 的数组（见模块说明）；signatures 为 minhash_all 算好的签名，
+    不给出时现算（给出进程池时分发到子进程计算）"""
+    if signatures is None:
+        signatures = minhash_all(texts, executor)
+
+    parent = list(range(len(texts)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    rows = MINHASH_BINS // LSH_BANDS
+    checked = set()
+    for band in range(LSH_BANDS):
+        buckets = defaultdict(list)
+        for chunk_id, signature in enumerate(signatures):
+            if signature is not None:
+                buckets[signature[band * rows:(band + 1) * rows]].append(chunk_id)
+        for members in buckets.values():
+            for i, a in enumerate(members):
+                for b in members[i + 1:]:
+                    if (a, b) in checked:
+                        continue
+                    checked.add((a, b))
+                    if find(a) != find(b) and similarity(signatures[a], signatures[b]) >= DUPLICATE_THRESHOLD:
+                        parent[find(b)] = find(a)
+
+    # 每组的代表：正文最长的段落，一样长时取块ID最小的
+    representative = {}
+    for chunk_id in range(len(texts)):
+        root = find(chunk_id)
+        best = representative.get(root)
+        if best is None or len(texts[chunk_id]) > len(texts[best]):
+            representative[root] = chunk_id
+    return array("I", (representative[find(chunk_id)] for chunk_id in range(len(texts))))
+
+
+def duplicate_stats(canonical) -> tuple[int, int]:
+    """(重复段落数, 含重复的组数)"""
+    groups = defaultdict(int)
+    for chunk_id, representative in enumerate(canonical):
+        groups[representative] += 1
+    duplicated = [size for size in groups.values() if size > 1]
+    return sum(duplicated) - len(duplicated), len(duplicated)
@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+"""
+斯坦星球知识库 - 检索核心（bot.py 与 bot_stream.py 共用）
+
+两个入口原先各有一份 load_config / load_knowledge_base / extract_query_terms /
+search_documents / build_context / ask_llm，已经改得不一致（Webhook 模式的提示词没有
+纯文本要求，回复里带着 ** 和 ###；出错时的日志与提示也不同）。这里只保留一份：
+
+- load_config：读取 config.json 合并进机器人的 CONFIG
+- RetrievalEngine：一个机器人进程的知识库——当前索引（热更新时整体替换）、热更新线程、
+  检索与日志
+- extract_query_terms / build_context / clean_markdown / ask_llm：查询切词、上下文、
+  大模型调用与回复清理
+- answer / stream_llm / ReplyStream：流式回答（llm_stream），边读 SSE 边逐段送出
+- PendingAnswer / question_key：检索与大模型调用分开执行时检索一步的结果，以及合并相同
+  问题用的键（见 kb_sched）
+
+HTTP 请求经 kb_http 的共享连接池（keep-alive，连接/读取超时分开）。
+重依赖延迟导入：requests 在第一次调用大模型时才导入；numpy 只在排序引擎用到向量
+（vector / hybrid）时随向量文件加载。导入本模块不会带上 Flask、requests、
+dingtalk_stream 或 numpy。
+"""
+
+import json
+import logging
+import re
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+
+from kb_http import get_client
+from kb_index import KnowledgeIndex
+from kb_rank import get_ranker, search_chunks
+from kb_reload import KnowledgeBaseWatcher
+from kb_snapshot import resolve_snapshot
+from kb_store import has_source, index_path, load_documents, load_index, pack_path
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = Path(__file__).parent / "config.json"
+DEFAULT_KB_PATH = Path(__file__).parent / "knowledge_base"
+VECTOR_ENGINES = ("vector", "hybrid")  # 需要加载段落向量的排序引擎
+MESSAGE_SEGMENT_CHARS = 200  # 流式回答逐段发消息时每段至少攒的字数（太碎会刷屏）
+CARD_SEGMENT_CHARS = 40  # 更新同一张卡片时每段至少攒的字数
+SENTENCE_END_RE = re.compile(r"[。！？；!?;]")
+FENCE_RE = re.compile(r"^[ \t]*```", re.MULTILINE)  # 代码块围栏行
+QUESTION_NOISE_RE = re.compile(r"\s+|[。！？!?.~～]+$")  # 规范化问题时去掉的空白与句末标点
+DEFAULT_LLM_BASE_URL = "https://open.bigmodel.cn/api/paas/v4"
+DEFAULT_LLM_MODEL = "glm-4.7"
+LLM_UNAVAILABLE = "抱歉，AI服务暂时不可用，请稍后再试。"
+NO_API_KEY = "错误：未配置大模型API密钥"
+STREAM_INTERRUPTED = "（回答中断，请稍后再试）"
+NO_RESULTS = "抱歉，没有找到与您问题相关的内容。请尝试换个关键词，或咨询教学主管。"
+EMPTY_SCOPE = "该范围内没有资料，请换个范围或直接提问。"
+
+
+# ============== 配置 ==============
+
+def load_config(config: dict, config_path: Path = CONFIG_PATH) -> dict:
+    """加载配置文件，合并进 config（机器人的 CONFIG，原地更新）"""
+    if config_path.exists():
+        with open(config_path, "r", encoding="utf-8") as f:
+            config.update(json.load(f))
+
+    if not config.get("kb_path"):
+        config["kb_path"] = str(DEFAULT_KB_PATH)
+    return config
+
+
+# ============== 知识库 ==============
+
+class RetrievalEngine:
+    """一个机器人进程的知识库：当前索引、热更新与检索
+
+    index 是唯一的共享状态，load 把新索引完整建好后才以一次赋值替换；请求开始时用 lease
+    取一次 index 并持有租约，中途热更新既不会混用新旧索引，也不会在用完之前关闭旧索引。
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.index = None  # 倒排索引（附带文档与快照版本），随 load 整体替换
+        self.watcher = None  # 知识库热更新线程
+        self.retired = []  # 换下的旧索引，租约全部归还后由 release_retired 关闭
+        self._retired_lock = threading.Lock()
+
+    def load(self) -> list:
+        """加载知识库所有文档（读取 convert_kb.py 发布的当前快照，优先使用其中的预建索引文件）"""
+        kb_dir, version = resolve_snapshot(Path(self.config["kb_path"]))
+        if version is None:
+            # 旧版布局：逐篇JSON已不随仓库提供，本地残留的多半是很久以前转换的
+            logger.warning(f"没有发布过知识库快照，改为读取旧版布局 {kb_dir}，内容可能已过期；"
+                           f"请运行 python convert_kb.py 从 知识库/ 发布快照")
+            version = "未发布快照"
+        logger.info(f"知识库版本: {version}（{kb_dir}）")
+        try:
+            index = load_index(kb_dir)
+            logger.info(f"已从预建索引文件 {index_path(kb_dir).name} 加载")
+        except (OSError, ValueError) as e:
+            logger.info(f"预建索引不可用，改为读取知识库文件: {e}")
+            if not has_source(kb_dir):
+                logger.error(f"知识库不存在: {pack_path(kb_dir)} / {kb_dir}")
+                return []
+            index = KnowledgeIndex(load_documents(kb_dir))
+        index.version = version
+
+        rank_engine = self.config["rank_engine"]
+        if rank_engine in VECTOR_ENGINES:
+            from kb_vectors import load_vectors  # 随 numpy 一起导入，关键词检索用不到
+
+            try:
+                index.vectors = load_vectors(kb_dir, index)
+                logger.info(f"已加载段落向量 {index.vectors.coverage}/{len(index.chunks)}")
+            except (ImportError, OSError, ValueError) as e:
+                logger.info(f"向量检索未启用: {e}")
+        # 文档频率与长度归一化在建索引时一次算好
+        get_ranker(index, rank_engine)
+
+        old, self.index = self.index, index
+        if old is not None:
+            with self._retired_lock:
+                self.retired.append(old)
+        logger.info(f"已加载 {len(index.documents)} 个文档，切分为 {len(index.chunks)} 个段落，索引词项 {len(index.body.postings)} 个")
+        return index.documents
+
+    def start_watcher(self) -> KnowledgeBaseWatcher | None:
+        """按配置启动知识库热更新线程（kb_reload_interval 为0时不启动），应在首次加载之前调用"""
+        interval = self.config["kb_reload_interval"]
+        if interval and interval > 0 and self.watcher is None:
+            self.watcher = KnowledgeBaseWatcher(self.config["kb_path"], self.load, interval,
+                                                release=self.release_retired).start()
+        return self.watcher
+
+    def release_retired(self) -> int:
+        """关闭已没有请求持有租约的旧索引（释放预建索引文件的内存映射，快照才能清理）；
+        还在用或关闭不了的留到下次。返回本次关闭的个数"""
+        with self._retired_lock:
+            retired = list(self.retired)
+        closed = 0
+        for index in retired:
+            if not index.close():
+                continue
+            with self._retired_lock:
+                self.retired.remove(index)
+            closed += 1
+            logger.info(f"已关闭旧版本知识库索引（{index.version}）")
+        return closed
+
+    def acquire(self) -> KnowledgeIndex | None:
+        """取当前索引并登记租约（知识库未加载时返回 None），用完后须以 release 归还"""
+        while True:
+            index = self.index
+            if index is None or index.acquire():
+                return index
+            # 取到的是刚换下并已开始关闭的旧索引：self.index 已是新索引，重取
+
+    def release(self, index: KnowledgeIndex | None):
+        """归还 acquire 取得的索引租约"""
+        if index is not None:
+            index.release()
+
+    @contextmanager
+    def lease(self):
+        """with 块内持有当前索引的租约，见 acquire"""
+        index = self.acquire()
+        try:
+            yield index
+        finally:
+            self.release(index)
+
+    def documents(self) -> list:
+        """当前知识库的全量文档（附带所属索引，请求处理中途热更新也不会混用新旧索引）"""
+        index = self.index
+        return index.documents if index is not None else []
+
+    def search_index(self, documents: list) -> KnowledgeIndex:
+        """获取覆盖给定文档的倒排索引（非知识库文档时临时建立）"""
+        index = getattr(documents, "index", None)  # 全量文档列表与分面视图都带着所属索引
+        if isinstance(index, KnowledgeIndex):  # 普通 list 的 index 是 list.index 方法
+            return index
+        index = self.index
+        if index is not None and index.covers(documents):
+            return index
+        return KnowledgeIndex(documents)
+
+    def search(self, query: str, documents: list, max_results: int = 5) -> list:
+        """搜索相关段落（检索单元为section分块，返回块的副本并附带_score与_sources）"""
+        query_terms = extract_query_terms(query)
+        index = self.search_index(documents)
+        ranker = get_ranker(index, self.config["rank_engine"])
+
+        results, timings = search_chunks(
+            index, ranker, query, query_terms, index.chunk_ids_of(documents), max_results
+        )
+        timing_text = ", ".join(
+            f"{name} {'超时' if ms is None else f'{ms:.0f}ms'}" for name, ms in timings.items()
+        )
+        sources_text = "; ".join(
+            f"{r['title'][:20]}<{'+'.join(f'{name}#{rank}' for name, rank in r['_sources'].items())}>"
+            + (f"(合并{r['_duplicates']}个重复)" if r["_duplicates"] else "")
+            for r in results
+        )
+        logger.info(f"检索[{ranker.name}] {timing_text} | {sources_text}")
+        return results
+
+
+# ============== 检索与上下文 ==============
+
+def extract_query_terms(query: str) -> list[str]:
+    """提取查询关键词（支持中文、数字、课程编号）"""
+    query_lower = query.lower()
+    terms = set()
+
+    # 英文/数字连续片段
+    for token in re.findall(r"[a-z0-9]+", query_lower):
+        terms.add(token)
+
+    # 课程编号（如 1-1-2）
+    for token in re.findall(r"\d+(?:-\d+)+", query_lower):
+        terms.add(token)
+        parts = token.split("-")
+        if len(parts) >= 2:
+            terms.add("-".join(parts[:2]))
+
+    # 中文连续片段与二字切分
+    for token in re.findall(r"[\u4e00-\u9fff]+", query_lower):
+        terms.add(token)
+        if len(token) >= 2:
+            for i in range(len(token) - 1):
+                terms.add(token[i:i + 2])
+
+    if not terms:
+        terms.add(query_lower.strip())
+
+    return list(terms)
+
+
+def build_context(documents: list, max_chars: int = 8000) -> str:
+    """构建上下文，控制长度（近似重复的段落只放一次，见 kb_dedup）"""
+    context_parts = []
+    total_chars = 0
+    groups = set()
+
+    for doc in documents:
+        group = doc.get("_group")
+        if group is not None:
+            if group in groups:
+                continue
+            groups.add(group)
+        title = doc.get("title", "未知")
+        if doc.get("section"):
+            title = f"{title} - {doc['section']}"
+        content = doc.get("lean") or doc.get("content", "")  # 检索段落带有转换时生成的精简文本
+
+        if total_chars + len(content) > max_chars:
+            remaining = max_chars - total_chars
+            if remaining > 500:
+                content = content[:remaining] + "\n...(内容截断)"
+            else:
+                break
+
+        context_parts.append(f"### {title}\n\n{content}")
+        total_chars += len(content)
+
+    return "\n\n---\n\n".join(context_parts)
+
+
+# ============== 大模型 ==============
+
+SYSTEM_PROMPT = """你是斯坦星球的知识库助手，专门回答老师和销售顾问关于课程、教学、销售的问题。
+
+斯坦星球简介：
+- 专注于STEM科创和编程教育
+- 课程体系：STEM幼儿科创（3-6岁）→ CODE少儿编程（6-12岁）→ PythonAI（10岁+）→ C++信奥
+- 教学理念：项目制学习(PBL)、八大能力培养、做中学
+
+重要规则：
+1. 只能基于提供的知识库内容回答，不要编造任何信息
+2. 如果知识库中没有相关内容，明确说"这个问题我在知识库中没有找到相关资料，建议咨询教学主管"
+3. 回答要简洁实用，直接给出答案
+4. 涉及具体课程、年龄、级别时，必须严格按照知识库内容
+5. 用口语化的方式回答，像同事之间的对话
+
+格式要求（非常重要！）：
+- 输出纯文本，不要使用任何Markdown格式
+- 不要用 **加粗** 或 *斜体*
+- 不要用 ## 标题 或 ### 小标题
+- 不要用 ``` 代码块
+- 不要用 --- 分隔线
+- 不要用 | 表格 |
+- 用【】或「」来强调重点，用空行分段
+- 用数字1. 2. 3.或符号•来列举，不要用-
+
+课程体系要点（必须严格遵守）：
+- STEM：小班(3-4岁)→中班(4-5岁)→大班(5-6岁)，每阶段4个主题
+- CODE：CODE1(6-8岁)→CODE2(8-10岁)→CODE3(10-12岁)，机械+编程结合
+- PythonAI：L1(10-12岁)→L2(12岁+)，人工智能方向
+- C++信奥：面向竞赛的专业课程"""
+
+USER_PROMPT = """请基于以下知识库内容回答问题。
+
+【知识库内容】
+{context}
+
+【用户问题】
+{question}
+
+请直接回答，不要说"根据知识库"之类的开场白。"""
+
+
+def get_llm_config(config: dict):
+    """获取大模型配置（优先读取llm_*, 兼容claude_*）"""
+    api_key = config.get("llm_api_key") or config.get("claude_api_key") or ""
+    base_url = config.get("llm_base_url") or config.get("claude_base_url") or DEFAULT_LLM_BASE_URL
+    model = config.get("llm_model") or DEFAULT_LLM_MODEL
+    return api_key, base_url, model
+
+
+def clean_markdown(text: str) -> str:
+    """清理Markdown格式符号，转为纯文本（钉钉文本消息不渲染Markdown）"""
+    if not text:
+        return text
+
+    # 移除代码块
+    text = re.sub(r'```[\s\S]*?```', lambda m: m.group(0).replace('```', '').strip(), text)
+
+    # 移除行内代码
+    text = re.sub(r'`([^`]+)`', r'\1', text)
+
+    # 移除加粗
+    text = re.sub(r'\*\*([^*]+)\*\*', r'【\1】', text)
+    text = re.sub(r'__([^_]+)__', r'【\1】', text)
+
+    # 移除斜体
+    text = re.sub(r'\*([^*]+)\*', r'\1', text)
+    text = re.sub(r'_([^_]+)_', r'\1', text)
+
+    # 移除标题符号
+    text = re.sub(r'^#{1,6}\s*', '', text, flags=re.MULTILINE)
+
+    # 移除分隔线
+    text = re.sub(r'^-{3,}$', '', text, flags=re.MULTILINE)
+    text = re.sub(r'^\*{3,}$', '', text, flags=re.MULTILINE)
+    text = re.sub(r'^_{3,}$', '', text, flags=re.MULTILINE)
+
+    # 将Markdown列表符号替换为更友好的符号
+    text = re.sub(r'^[-*+]\s+', '· ', text, flags=re.MULTILINE)
+
+    # 移除链接格式，保留文字
+    text = re.sub(r'\[([^\]]+)\]\([^)]+\)', r'\1', text)
+
+    # 清理多余空行
+    text = re.sub(r'\n{3,}', '\n\n', text)
+
+    return text.strip()
+
+
+def _chat_request(config: dict, question: str, context: str, stream: bool = False):
+    """大模型请求的 (url, payload, headers)；没有配置API密钥时返回 None"""
+    api_key, base_url, model = get_llm_config(config)
+    if not api_key:
+        return None
+    url = base_url.rstrip("/") + "/chat/completions"
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": USER_PROMPT.format(context=context, question=question)},
+        ],
+        "temperature": 0.2,
+        "max_tokens": 1200,
+        "thinking": {"type": "disabled"},
+    }
+    if stream:
+        payload["stream"] = True
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    return url, payload, headers
+
+
+def ask_llm(config: dict, question: str, context: str) -> str:
+    """调用大模型生成回答（智谱OpenAI兼容接口），返回清理过Markdown的纯文本"""
+    request = _chat_request(config, question, context)
+    if request is None:
+        return NO_API_KEY
+    url, payload, headers = request
+    client = get_client(config)
+
+    try:
+        started = time.perf_counter()
+        resp = client.post(url, json=payload, headers=headers)
+        if resp.status_code != 200:
+            logger.error(f"LLM错误: {resp.status_code} {resp.text[:300]}")
+            return LLM_UNAVAILABLE
+        data = resp.json()
+        content = data.get("choices", [{}])[0].get("message", {}).get("content", "")
+        if not content:
+            logger.error(f"LLM返回空内容: {data}")
+            return LLM_UNAVAILABLE
+        logger.info(f"LLM回答 {len(content)}字，耗时 {time.perf_counter() - started:.1f}s（{client.summary(url)}）")
+        return clean_markdown(content)
+    except Exception as e:
+        logger.exception(f"LLM调用异常: {type(e).__name__}: {e}")
+        return f"{LLM_UNAVAILABLE}(错误: {type(e).__name__})"
+
+
+# ============== 流式回答 ==============
+# 完整生成一个回答（max_tokens 1200）要10~30秒，用户一直看不到任何回复。流式模式下
+# 请求带 stream: true，边读 SSE 边按行攒批，每段清理 Markdown 后立即送出（钉钉AI卡片
+# 逐段更新，或逐段回复文本消息）。
+
+def iter_llm_deltas(config: dict, question: str, context: str):
+    """流式调用大模型，逐个产出增量文本（SSE 事件中 choices[0].delta.content）
+
+    HTTP 状态不是200时记录日志、不产出任何内容；读取中途出错时抛出异常。
+    """
+    request = _chat_request(config, question, context, stream=True)
+    if request is None:
+        return
+    url, payload, headers = request
+    client = get_client(config)
+    started = time.perf_counter()
+    first = None
+    chars = 0
+    # chunk_size=None：数据到了就处理，不等凑满缓冲区
+    with client.post(url, json=payload, headers=headers, stream=True) as resp:
+        if resp.status_code != 200:
+            logger.error(f"LLM错误: {resp.status_code} {resp.text[:300]}")
+            return
+        for line in resp.iter_lines(chunk_size=None):
+            if not line.startswith(b"data:"):
+                continue  # 空行、注释与 event:/id: 字段
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                continue  # 读到响应结束，连接才能放回连接池复用
+            choices = json.loads(data).get("choices") or [{}]
+            delta = (choices[0].get("delta") or {}).get("content")
+            if delta:
+                if first is None:
+                    first = time.perf_counter() - started
+                chars += len(delta)
+                yield delta
+    if first is not None:
+        logger.info(f"LLM流式回答 {chars}字，首字 {first:.1f}s，耗时 {time.perf_counter() - started:.1f}s（{client.summary(url)}）")
+
+
+def iter_segments(deltas, segment_chars: int = MESSAGE_SEGMENT_CHARS):
+    """增量文本 -> 清理过 Markdown 的回答片段
+
+    缓冲区攒够 segment_chars 字后在最后一个换行处断开（Markdown 标记不跨行，按行断开
+    不会把 **加粗** 切成两半）；断点落在未闭合的 ``` 代码块内时退到代码块开头，整块
+    代码留到闭合后一起送出。一直没有换行的长段落攒到3倍长度时在句末断开。
+    """
+    buffer = ""
+    for delta in deltas:
+        buffer += delta
+        if len(buffer) < segment_chars:
+            continue
+        cut = _segment_cut(buffer, segment_chars)
+        if cut:
+            segment = clean_markdown(buffer[:cut])
+            buffer = buffer[cut:]
+            if segment:
+                yield segment
+    segment = clean_markdown(buffer)
+    if segment:
+        yield segment
+
+
+def _segment_cut(buffer: str, segment_chars: int) -> int:
+    """缓冲区的断点（0 为暂不断开）；缓冲区总是从片段边界开始，不在代码块内"""
+    cut = buffer.rfind("\n") + 1
+    fences = [m.start() for m in FENCE_RE.finditer(buffer, 0, cut)]
+    if len(fences) % 2:
+        return fences[-1]  # 断点前有未闭合的代码块，只送出它之前的内容
+    if not cut and len(buffer) >= segment_chars * 3 and not FENCE_RE.search(buffer):
+        ends = list(SENTENCE_END_RE.finditer(buffer))
+        cut = ends[-1].end() if ends else 0
+    return cut
+
+
+def stream_llm(config: dict, question: str, context: str, segment_chars: int = MESSAGE_SEGMENT_CHARS):
+    """流式生成回答，逐个产出片段（见 iter_segments）；出错时产出给用户的提示"""
+    if not get_llm_config(config)[0]:
+        yield NO_API_KEY
+        return
+    emitted = False
+    try:
+        for segment in iter_segments(iter_llm_deltas(config, question, context), segment_chars):
+            emitted = True
+            yield segment
+    except Exception as e:
+        logger.exception(f"LLM流式调用异常: {type(e).__name__}: {e}")
+        yield STREAM_INTERRUPTED if emitted else f"{LLM_UNAVAILABLE}(错误: {type(e).__name__})"
+        return
+    if not emitted:
+        yield LLM_UNAVAILABLE
+
+
+class ReplyStream(ABC):
+    """流式回答的去向：answer 每得到一段就调用 deliver；子类实现 send（发消息、更新卡片）"""
+
+    segment_chars = MESSAGE_SEGMENT_CHARS
+
+    def __init__(self):
+        self.segments = []  # 已送出的片段
+
+    def deliver(self, segment: str):
+        self.segments.append(segment)
+        self.send(segment)
+
+    @abstractmethod
+    def send(self, segment: str):
+        """送出一段回答（deliver 已把它记入 segments）"""
+
+
+def answer(config: dict, question: str, context: str, stream: ReplyStream | None = None) -> str:
+    """生成回答并返回全文；给出 stream 且配置 llm_stream 为真时边生成边逐段送出"""
+    if stream is None or not config.get("llm_stream"):
+        return ask_llm(config, question, context)
+    for segment in stream_llm(config, question, context, stream.segment_chars):
+        stream.deliver(segment)
+    return "\n\n".join(stream.segments)
+
+
+def question_key(question: str, *scope) -> tuple:
+    """合并相同问题用的键：规范化的问题（全角转半角、小写、去空白与句末标点）+ 检索范围
+
+    scope 为决定检索结果的其余因素（知识库版本、指定范围、课程类型与编号等），须可哈希。
+    """
+    normalized = QUESTION_NOISE_RE.sub("", unicodedata.normalize("NFKC", question).lower())
+    return (normalized, *scope)
+
+
+class PendingAnswer:
+    """检索已经完成、还没调用大模型的回答：调用方（kb_sched 的调度器）决定 run 在哪个线程执行
+
+    key 为 question_key(question, *scope)，调度器据此合并同时进行的相同问题。
+    """
+
+    def __init__(self, config: dict, question: str, context: str, stream: ReplyStream | None = None,
+                 scope: tuple = ()):
+        self.config = config
+        self.question = question
+        self.context = context
+        self.stream = stream
+        self.key = question_key(question, *scope)
+
+    def run(self) -> str:
+        return answer(self.config, self.question, self.context, self.stream)
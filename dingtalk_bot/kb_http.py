@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+斯坦星球知识库 - 共享 HTTP 连接池
+
+ask_llm 与 Webhook 模式的 send_message 原先每次都调用模块级 requests.post：每条消息都要
+重新和 open.bigmodel.cn、oapi.dingtalk.com 做一次 TCP + TLS 握手，回答前平白多出
+几百毫秒。这里整个进程共用一个 requests.Session：
+
+- 按主机分别保持连接池（keep-alive），池的个数与每个主机的连接数可在配置中调整：
+  http_pool_hosts / http_pool_maxsize；并发请求超过连接数时临时另开连接，用完不保留
+- 连接超时与读取超时分开设置：http_connect_timeout（连不上尽快失败）、
+  http_read_timeout（两次收到数据之间的最长间隔，大模型生成较慢，要留足）
+- stats() 按主机返回请求数、新建连接数与复用率，确认握手确实被摊薄
+
+requests 在第一次发请求时才导入（见 kb_engine 的延迟导入约定）。
+"""
+
+import logging
+import threading
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+POOL_HOSTS = 4  # 保持连接池的主机数（大模型、钉钉，留有余量）
+POOL_MAXSIZE = 8  # 每个主机保持的连接数，宜不少于同时进行的大模型调用数
+CONNECT_TIMEOUT = 5  # 建立连接的超时（秒）
+READ_TIMEOUT = 30  # 读取超时（秒）：两次收到数据之间的最长间隔
+
+
+class HttpClient:
+    """带按主机连接池的 HTTP 客户端，线程安全（urllib3 连接池本身加锁）"""
+
+    def __init__(self, pool_hosts: int = POOL_HOSTS, pool_maxsize: int = POOL_MAXSIZE,
+                 connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT):
+        self.pool_hosts = pool_hosts
+        self.pool_maxsize = pool_maxsize
+        self.timeout = (connect_timeout, read_timeout)
+        self._session = None
+        self._adapter = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    adapter = HTTPAdapter(pool_connections=self.pool_hosts, pool_maxsize=self.pool_maxsize)
+                    session = requests.Session()
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._adapter = adapter
+                    self._session = session
+        return self._session
+
+    def request(self, method: str, url: str, **kwargs):
+        """发请求；未指定 timeout 时使用 (连接超时, 读取超时)"""
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self) -> dict:
+        """按主机统计：{主机: {"requests": 请求数, "connections": 新建连接数, "reuse": 复用率}}
+
+        计数来自 urllib3 连接池（num_requests / num_connections）；主机数超过 http_pool_hosts
+        被挤出的池不再计入。
+        """
+        totals = {}
+        if self._adapter is not None:
+            pools = self._adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_done, connections = totals.get(pool.host, (0, 0))
+                totals[pool.host] = (requests_done + pool.num_requests, connections + pool.num_connections)
+        return {
+            host: {
+                "requests": requests_done,
+                "connections": connections,
+                "reuse": round(1 - connections / requests_done, 3) if requests_done else 0.0,
+            }
+            for host, (requests_done, connections) in totals.items()
+        }
+
+    def summary(self, url: str) -> str:
+        """某个主机的连接复用情况，用于日志"""
+        entry = self.stats().get(urlsplit(url).hostname)
+        if not entry:
+            return "无连接"
+        return f"{entry['requests']}次请求/{entry['connections']}个连接"
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client(config: dict | None = None) -> HttpClient:
+    """进程共用的客户端，第一次调用时按配置创建（之后的 config 不再生效）"""
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                config = config or {}
+                _CLIENT = HttpClient(
+                    pool_hosts=config.get("http_pool_hosts", POOL_HOSTS),
+                    pool_maxsize=config.get("http_pool_maxsize", POOL_MAXSIZE),
+                    connect_timeout=config.get("http_connect_timeout", CONNECT_TIMEOUT),
+                    read_timeout=config.get("http_read_timeout", READ_TIMEOUT),
+                )
+                logger.info(f"HTTP连接池: 每主机 {_CLIENT.pool_maxsize} 个连接，超时 连接{_CLIENT.timeout[0]}s/读取{_CLIENT.timeout[1]}s")
+    return _CLIENT
@@ -0,0 +1,728 @@
+#!/usr/bin/env python3
+"""
+斯坦星球知识库 - 倒排索引
+
+在加载知识库时把每篇文档按标题层级切成大小受限的块（见 kb_chunker），并一次性建立
+词项 -> 倒排表（块、词频、位置）的内存索引；检索只访问包含查询词的块，
+返回的是段落而不是整篇文档；超长段落再按倒排表中的词项位置，一次扫描
+取出查询词最密集的窗口作为片段。
+
+词项切分（与 extract_query_terms 保持一致，均基于小写文本）：
+- 英文/数字连续片段：[a-z0-9]+
+- 课程编号片段：形如 1-1-02 的数字与连字符串
+- 中文二字切分：每个汉字位置以其开头的二字词为键，连续片段末字以单字为键
+"""
+
+import re
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from pathlib import Path
+
+from kb_chunker import CHUNK_MAX_CHARS, breadcrumb, iter_chunks, iter_lines, lean_text
+from kb_keywords import BOOST_BITS, DOC_TYPE_BITS, DOC_TYPE_MASK, scan_keywords
+
+LATIN_TOKEN_RE = re.compile(r"[a-z0-9]+")
+CODE_TOKEN_RE = re.compile(r"[0-9-]*(?:[0-9]-|-[0-9])[0-9-]*")
+CJK_TOKEN_RE = re.compile(r"(?=([\u4e00-\u9fff][\u4e00-\u9fff]?))")
+
+LATIN_TERM_RE = re.compile(r"[a-z0-9]+")
+CODE_TERM_RE = re.compile(r"\d+(?:-\d+)+")
+CJK_TERM_RE = re.compile(r"[\u4e00-\u9fff]+")
+
+
+# 分面：由知识库JSON文件名（convert_kb.py 输出的 前缀_级别_模块_... 结构）与课程类型位图得到
+LEVEL_VALUES = {"小班", "中班", "大班", "CODE1", "CODE2", "CODE3", "L1", "L2", "MP"}
+MODULE_RE = re.compile(r"M\d+")
+
+# 显式检索范围命令（如 /code2 问题）的别名 -> 分面过滤条件
+SCOPE_ALIASES = {
+    "stem": {"course": "STEM"},
+    "code": {"course": "CODE"},
+    "python": {"course": "PythonAI"},
+    "pythonai": {"course": "PythonAI"},
+    "cpp": {"course": "CPP"},
+    "c++": {"course": "CPP"},
+    "信奥": {"course": "CPP"},
+    "小班": {"level": "小班"},
+    "中班": {"level": "中班"},
+    "大班": {"level": "大班"},
+    "code1": {"level": "CODE1"},
+    "code2": {"level": "CODE2"},
+    "code3": {"level": "CODE3"},
+    "l1": {"level": "L1"},
+    "l2": {"level": "L2"},
+    "mp": {"level": "MP"},
+}
+
+# 课程编号命中后截取的上下文窗口（命中点前/后字符数）
+COURSE_SNIPPET_BEFORE = 600
+COURSE_SNIPPET_AFTER = 1200
+
+# 段落片段：超长段落只保留查询词最密集的若干个窗口
+SNIPPET_WINDOW_CHARS = 600
+SNIPPET_MAX_WINDOWS = 2
+SNIPPET_SNAP_CHARS = 80  # 窗口边界向最近的换行对齐的最大距离
+SNIPPET_SEPARATOR = "\n……\n"
+
+def canonical_course_id(course_id: str) -> str:
+    """课程编号规范化：去掉各段前导零，如 CODE1-1-02 / 1-01-2 -> 1-1-2"""
+    match = CODE_TERM_RE.search(course_id)
+    if not match:
+        return course_id
+    return "-".join(str(int(part)) for part in match.group().split("-"))
+
+
+def course_id_keys(code: str) -> list[str]:
+    """编号及其至少两段的前缀都可作为查找键（1-1-2 也能被 1-1 查到）"""
+    parts = canonical_course_id(code).split("-")
+    return ["-".join(parts[:n]) for n in range(len(parts), 1, -1)]
+
+
+def document_facets(doc: dict, type_mask: int) -> list[tuple[str, str]]:
+    """文档的分面取值：课程线(course)、级别(level)、模块(module)、来源目录(source)"""
+    facets = []
+    for course_type, bit in DOC_TYPE_BITS.items():
+        if type_mask & bit:
+            facets.append(("course", course_type))
+
+    parts = Path(doc.get("file", "")).stem.split("_")
+    if len(parts) > 1 and parts[0]:
+        facets.append(("source", parts[0]))
+        level = parts[1].upper() if parts[1].isascii() else parts[1]
+        if level in LEVEL_VALUES:
+            facets.append(("level", level))
+            if len(parts) > 2 and MODULE_RE.fullmatch(parts[2]):
+                facets.append(("module", parts[2]))
+    return facets
+
+
+def tokenize(text: str) -> dict[str, list[int]]:
+    """将小写文本切分为 词项 -> 位置列表"""
+    tokens = defaultdict(list)
+    for m in LATIN_TOKEN_RE.finditer(text):
+        tokens[m.group()].append(m.start())
+    for m in CODE_TOKEN_RE.finditer(text):
+        tokens[m.group()].append(m.start())
+    for m in CJK_TOKEN_RE.finditer(text):
+        tokens[m.group(1)].append(m.start())
+    return tokens
+
+
+def count_non_overlapping(positions, length: int, start: int = 0, end: int | None = None) -> int:
+    """按 str.count 的语义（从左到右、不重叠）统计区间内的出现次数"""
+    lo = bisect_left(positions, start)
+    count = 0
+    next_free = start
+    for i in range(lo, len(positions)):
+        pos = positions[i]
+        if end is not None and pos + length > end:
+            break
+        if pos >= next_free:
+            count += 1
+            next_free = pos + length
+    return count
+
+
+def best_windows(events: list[tuple[int, int, int, float]], text_length: int,
+                 width: int = SNIPPET_WINDOW_CHARS, max_windows: int = SNIPPET_MAX_WINDOWS) -> list[tuple[int, int]]:
+    """一次滑动窗口扫描找出查询词最密集的窗口
+
+    events 为按位置升序的 (起, 止, 词项下标, 权重)；窗口得分为其中不同词项的权重和，
+    命中次数作次要依据。返回至多 max_windows 个互不重叠的 [起, 止) 区间，按位置排序。
+    """
+    counts = defaultdict(int)
+    distinct = 0.0
+    left = 0
+    candidates = []
+    for right, (_, end, term, weight) in enumerate(events):
+        if counts[term] == 0:
+            distinct += weight
+        counts[term] += 1
+        while end - events[left][0] > width:
+            _, _, old_term, old_weight = events[left]
+            counts[old_term] -= 1
+            if counts[old_term] == 0:
+                distinct -= old_weight
+            left += 1
+        candidates.append((distinct, right - left, events[left][0], end))
+
+    windows = []
+    for _, _, span_start, span_end in sorted(candidates, key=lambda c: (-c[0], -c[1], c[2])):
+        # 命中区间居中扩展到窗口宽度
+        start = max(0, span_start - (width - (span_end - span_start)) // 2)
+        end = min(text_length, start + width)
+        start = max(0, end - width)
+        if any(start < w_end and w_start < end for w_start, w_end in windows):
+            continue
+        windows.append((start, end))
+        if len(windows) == max_windows:
+            break
+    return sorted(windows)
+
+
+def snap_to_lines(text: str, start: int, end: int, slack: int = SNIPPET_SNAP_CHARS) -> tuple[int, int]:
+    """窗口边界就近对齐到行首/行尾，避免切断半句"""
+    line_start = text.rfind("\n", max(0, start - slack), start)
+    if line_start != -1:
+        start = line_start + 1
+    elif start <= slack:
+        start = 0
+    line_end = text.find("\n", end, end + slack)
+    if line_end != -1:
+        end = line_end
+    elif len(text) - end <= slack:
+        end = len(text)
+    return start, end
+
+
+class PostingList:
+    """单个词项的倒排表：按文档ID升序存放 (文档, 词频, 位置)"""
+
+    __slots__ = ("doc_ids", "offsets", "positions")
+
+    def __init__(self, entries: list[tuple[int, list[int]]]):
+        self.doc_ids = array("I", [doc_id for doc_id, _ in entries])
+        self.offsets = array("I", [0])
+        self.positions = array("I")
+        for _, positions in entries:
+            self.positions.extend(positions)
+            self.offsets.append(len(self.positions))
+
+    @classmethod
+    def from_arrays(cls, doc_ids, offsets, positions) -> "PostingList":
+        """直接引用已有的数组（如预建索引文件的内存映射），offsets 可以是全局偏移"""
+        posting = cls.__new__(cls)
+        posting.doc_ids = doc_ids
+        posting.offsets = offsets
+        posting.positions = positions
+        return posting
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        for i, doc_id in enumerate(self.doc_ids):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            yield doc_id, end - start, self.positions[start:end]
+
+
+class FieldIndex:
+    """单个字段（标题或正文）的倒排索引"""
+
+    def __init__(self):
+        self.postings: dict[str, PostingList] = {}
+        self.latin_keys: list[str] = []
+        self.code_keys: list[str] = []
+        self.cjk_keys_by_head: dict[str, list[str]] = defaultdict(list)
+        self.lengths = array("I")  # 每个文档在该字段的词项数（长度归一化用）
+        # 由预建索引恢复时：各倒排表的块ID按 postings 的顺序首尾相接的整段数组（见 kb_store.patch_index）
+        self.id_blob = None
+        self._pending: dict[str, list] = defaultdict(list)
+
+    def add(self, doc_id: int, text: str):
+        """按文档ID升序逐篇加入，全部加入后调用 freeze()"""
+        length = 0
+        for key, positions in tokenize(text).items():
+            self._pending[key].append((doc_id, positions))
+            length += len(positions)
+        self.lengths.append(length)
+
+    def freeze(self):
+        """将建索引时的临时列表压缩为紧凑的数组倒排表"""
+        for key, entries in self._pending.items():
+            self._add_key(key, PostingList(entries))
+        self._pending = defaultdict(list)
+
+    @classmethod
+    def restore(cls, postings: dict[str, PostingList], lengths, id_blob=None) -> "FieldIndex":
+        """由预建索引文件中读出的倒排表恢复（无需重新切词）"""
+        field = cls()
+        for key, posting in postings.items():
+            field._add_key(key, posting)
+        field.lengths = lengths
+        field.id_blob = id_blob
+        return field
+
+    def derive(self, postings: dict[str, PostingList], lengths, dropped: set, added: list) -> "FieldIndex":
+        """增量更新：以新的倒排表派生字段，沿用本字段的词项分类，只处理删去（dropped）与新增（added）的词项"""
+        field = type(self)()
+        field.lengths = lengths
+        field.latin_keys = [key for key in self.latin_keys if key not in dropped] if dropped else list(self.latin_keys)
+        field.code_keys = [key for key in self.code_keys if key not in dropped] if dropped else list(self.code_keys)
+        for head, keys in self.cjk_keys_by_head.items():
+            field.cjk_keys_by_head[head] = [key for key in keys if key not in dropped] if dropped else list(keys)
+        field.postings = postings
+        for key in added:
+            field._add_key(key, postings[key])
+        return field
+
+    def _add_key(self, key: str, posting: PostingList):
+        self.postings[key] = posting
+        if "\u4e00" <= key[0] <= "\u9fff":
+            self.cjk_keys_by_head[key[0]].append(key)
+        elif "-" in key:
+            self.code_keys.append(key)
+        else:
+            self.latin_keys.append(key)
+
+    def lookup(self, term: str) -> dict[int, list[int]] | None:
+        """返回 文档ID -> 升序位置列表；词项无法由索引回答时返回None"""
+        if LATIN_TERM_RE.fullmatch(term):
+            return self._lookup_substring(term, self.latin_keys)
+        if CODE_TERM_RE.fullmatch(term):
+            return self._lookup_substring(term, self.code_keys)
+        if CJK_TERM_RE.fullmatch(term):
+            return self._lookup_cjk(term)
+        return None
+
+    def _lookup_substring(self, term: str, keys: list[str]) -> dict[int, list[int]]:
+        """词项可能是更长片段的子串（如 code 之于 code1），合并所有包含它的键
+
+        中文二字键彼此重叠（“学学习”切出 学学、学习），单字在相邻两个键中会命中同一位置，
+        合并后去重，词频不会重复计算"""
+        hits = defaultdict(list)
+        for key in keys:
+            offsets = []
+            pos = key.find(term)
+            while pos != -1:
+                offsets.append(pos)
+                pos = key.find(term, pos + 1)
+            if not offsets:
+                continue
+            for doc_id, _, positions in self.postings[key]:
+                hits[doc_id].extend(p + off for p in positions for off in offsets)
+        return {doc_id: sorted(set(positions)) for doc_id, positions in hits.items()}
+
+    def _lookup_cjk(self, term: str) -> dict[int, list[int]]:
+        if len(term) == 1:
+            return self._lookup_substring(term, self.cjk_keys_by_head.get(term, []))
+
+        first = self.postings.get(term[:2])
+        if first is None:
+            return {}
+        if len(term) == 2:
+            return {doc_id: list(positions) for doc_id, _, positions in first}
+
+        # 三字及以上：以首个二字词的位置为锚点，逐个校验后续二字词
+        rest = []
+        for i in range(1, len(term) - 1):
+            posting = self.postings.get(term[i:i + 2])
+            if posting is None:
+                return {}
+            rest.append((i, {doc_id: positions for doc_id, _, positions in posting}))
+        hits = {}
+        for doc_id, _, positions in first:
+            following = []
+            for i, by_doc in rest:
+                doc_positions = by_doc.get(doc_id)
+                if doc_positions is None:
+                    break
+                following.append((i, set(doc_positions)))
+            else:
+                matched = [p for p in positions if all(p + i in s for i, s in following)]
+                if matched:
+                    hits[doc_id] = matched
+        return hits
+
+
+def split_chunks(doc_id: int, doc: dict, max_chars: int = CHUNK_MAX_CHARS) -> list[dict]:
+    """按标题层级把文档正文切成大小受限的段落（规则见 kb_chunker）
+
+    每个块记录所属文档(doc_id)、在文档content中的字符区间[start, end)，
+    section 为标题路径（如 "课程基本信息 > 第3课"）。
+    """
+    content = doc.get("content", "")
+    title = doc.get("title", "")
+    chunks = []
+    for start, end, path in iter_chunks(iter_lines(content), max_chars):
+        if not content[start:end].strip():
+            continue
+        chunks.append({
+            "doc_id": doc_id,
+            "title": title,
+            "section": breadcrumb(path, title),
+            "source": doc.get("source", ""),
+            "start": start,
+            "end": end,
+            "content": content[start:end],
+        })
+    return chunks
+
+
+class DocumentView(tuple):
+    """某组分面取值下的文档子集：不可变，附带预先算好的文档ID与段落ID集合
+
+    作为文档列表传给检索函数时无需再逐篇映射，过滤是常数时间的。
+    """
+
+    def __new__(cls, index: "KnowledgeIndex", doc_ids):
+        doc_ids = frozenset(doc_ids)
+        view = super().__new__(cls, (index.documents[i] for i in sorted(doc_ids)))
+        view.index = index
+        view.doc_ids = doc_ids
+        view.chunk_ids = frozenset(i for doc_id in doc_ids for i in index.doc_chunks[doc_id])
+        return view
+
+
+class DocumentList(list):
+    """索引的全量文档列表，与 DocumentView 一样附带所属索引
+
+    热更新（见 kb_reload）只替换全局的索引引用；已经拿到旧文档列表的请求
+    通过 .index 找到的仍是旧索引，不会与新索引混用。
+    """
+
+    index: "KnowledgeIndex"
+
+
+class KnowledgeIndex:
+    """知识库倒排索引
+
+    检索单元是section分块（见 split_chunks），字段为文档标题、section标题与块正文；
+    postings 中的ID均为块ID，块通过 doc_id 指回所属文档。
+    """
+
+    def __init__(self, documents: list, prebuilt: dict | None = None):
+        """prebuilt 为预建索引文件中读出的 fields / chunk_masks / doc_masks / course_table / lean（见 kb_store），
+        给出时跳过切词、关键词扫描与精简文本生成；其中的 chunk_bounds（按块ID排列的
+        (doc_id, start, end, section)）给出时直接按边界恢复分块，不再重新切分"""
+        self.documents = DocumentList(documents)
+        self.documents.index = self
+        self.version = None  # 知识库快照版本（见 kb_snapshot），由加载方填写
+        self.chunks: list[dict] = []
+        self.doc_chunks: list[range] = []  # 文档ID -> 块ID区间
+        bounds = prebuilt.get("chunk_bounds") if prebuilt else None
+        if bounds is None:
+            for doc_id, doc in enumerate(self.documents):
+                first = len(self.chunks)
+                self.chunks.extend(split_chunks(doc_id, doc))
+                self.doc_chunks.append(range(first, len(self.chunks)))
+        else:
+            self._restore_chunks(bounds)
+
+        self.rankers = {}  # 排序引擎缓存，见 kb_rank.get_ranker
+        self.mapped = None  # 预建索引文件的内存映射（见 kb_store.load_index），close 时关闭
+        self.leases = 0  # 正在使用本索引的请求数（见 acquire/release），不为0时 close 不关闭
+        self.closed = False  # close 之后（即使映射还没关掉）不再发放租约
+        self._lease_lock = threading.Lock()
+        self.vectors = None  # 段落稠密向量（可选），见 kb_vectors.load_vectors
+        # 块ID -> 近似重复组的代表块ID（见 kb_dedup），转换知识库时算好；没有时不合并
+        self.canonical = prebuilt.get("canonical") if prebuilt else None
+        # 各段落的 MinHash 签名（kb_dedup.pack_signatures），增量转换时复用；机器人用不到
+        self.signatures = prebuilt.get("signatures") if prebuilt else None
+        self._id_by_object = {id(doc): doc_id for doc_id, doc in enumerate(documents)}
+
+        if prebuilt is None:
+            self._build()
+        else:
+            fields = prebuilt["fields"]
+            self.title, self.section_titles, self.body = fields["title"], fields["section_titles"], fields["body"]
+            self.chunk_masks = prebuilt["chunk_masks"]
+            self.doc_masks = prebuilt["doc_masks"]
+            self.course_table = prebuilt["course_table"]
+            self.lean = prebuilt["lean"]
+
+        # 分面：分面名 -> 取值 -> 文档视图，加载时一次分好
+        members = defaultdict(lambda: defaultdict(set))
+        for doc_id, doc in enumerate(documents):
+            for facet, value in document_facets(doc, self.doc_masks[doc_id]):
+                members[facet][value].add(doc_id)
+        self.facets: dict[str, dict[str, DocumentView]] = {
+            facet: {value: DocumentView(self, doc_ids) for value, doc_ids in values.items()}
+            for facet, values in members.items()
+        }
+        self._views: dict[tuple, DocumentView] = {}
+
+        # 加权关键词组 -> 命中该组的段落
+        self.boost_chunks: dict[str, list[int]] = {
+            key: [chunk_id for chunk_id, mask in enumerate(self.chunk_masks) if mask & bit]
+            for key, bit in BOOST_BITS.items()
+        }
+
+    def _restore_chunks(self, bounds):
+        """按预先切好的块边界恢复 chunks / doc_chunks，结果与 split_chunks 逐篇切分相同"""
+        first = 0
+        for doc_id, start, end, section in bounds:
+            while len(self.doc_chunks) < doc_id:
+                self.doc_chunks.append(range(first, len(self.chunks)))
+                first = len(self.chunks)
+            doc = self.documents[doc_id]
+            self.chunks.append({
+                "doc_id": doc_id,
+                "title": doc.get("title", ""),
+                "section": section,
+                "source": doc.get("source", ""),
+                "start": start,
+                "end": end,
+                "content": doc.get("content", "")[start:end],
+            })
+        while len(self.doc_chunks) < len(self.documents):
+            self.doc_chunks.append(range(first, len(self.chunks)))
+            first = len(self.chunks)
+
+    def _build(self):
+        """切词建倒排表、扫描关键词位图、建课程编号表（启动时最耗时的部分）"""
+        self.title = FieldIndex()
+        self.section_titles = FieldIndex()
+        self.body = FieldIndex()
+
+        # 关键词位图：段落按标题+正文扫描一次，文档按标题+来源标记课程类型
+        self.chunk_masks = array("Q")
+        self.doc_masks = array("Q", (
+            scan_keywords(f"{doc.get('title', '')}\n{doc.get('source', '')}".lower()) & DOC_TYPE_MASK
+            for doc in self.documents
+        ))
+
+        # 课程编号表：规范化编号 -> [(文档ID, section, 命中位置, 片段起, 片段止)]，每篇文档只记首次出现
+        self.course_table: dict[str, list[tuple[int, str, int, int, int]]] = defaultdict(list)
+        for doc_id, doc in enumerate(self.documents):
+            self._add_course_ids(doc_id, doc)
+
+        for chunk_id, chunk in enumerate(self.chunks):
+            title = chunk["title"].lower()
+            text = chunk["content"].lower()
+            self.title.add(chunk_id, title)
+            self.section_titles.add(chunk_id, chunk["section"].lower())
+            self.body.add(chunk_id, text)
+            self.chunk_masks.append(scan_keywords(f"{title}\n{text}"))
+
+        self.title.freeze()
+        self.section_titles.freeze()
+        self.body.freeze()
+
+        # 交给大模型的精简文本（见 kb_chunker.lean_text），块ID -> 文本
+        self.lean: list[str] = [lean_text(chunk["content"]) for chunk in self.chunks]
+
+    def _add_course_ids(self, doc_id: int, doc: dict):
+        content = doc.get("content", "")
+        chunk_ids = self.doc_chunks[doc_id]
+        chunk_starts = [self.chunks[i]["start"] for i in chunk_ids]
+        seen = set()
+        for m in CODE_TERM_RE.finditer(content):
+            keys = [key for key in course_id_keys(m.group()) if key not in seen]
+            if not keys:
+                continue
+            pos = bisect_right(chunk_starts, m.start()) - 1
+            section = self.chunks[chunk_ids[pos]]["section"] if pos >= 0 else ""
+            entry = (
+                doc_id, section, m.start(),
+                max(m.start() - COURSE_SNIPPET_BEFORE, 0),
+                min(m.end() + COURSE_SNIPPET_AFTER, len(content)),
+            )
+            for key in keys:
+                seen.add(key)
+                self.course_table[key].append(entry)
+
+    def find_course(self, course_id: str, doc_ids: set[int] | None = None) -> list[dict]:
+        """按课程编号查表，返回各文档首次出现处的预计算片段（_group 为片段所在段落的重复组）"""
+        matches = []
+        for doc_id, section, pos, start, end in self.course_table.get(canonical_course_id(course_id), ()):
+            if doc_ids is not None and doc_id not in doc_ids:
+                continue
+            doc = self.documents[doc_id]
+            chunk_id = self.chunk_at(doc_id, pos)
+            matches.append({
+                "title": doc.get("title", "未知"),
+                "section": section,
+                "source": doc.get("source", ""),
+                "content": doc.get("content", "")[start:end],
+                "_group": self.group_of(chunk_id) if chunk_id >= 0 else None,
+            })
+        return matches
+
+    def chunk_at(self, doc_id: int, pos: int) -> int:
+        """文档正文中某个位置所在的块ID（文档没有块时为 -1）"""
+        chunk_ids = self.doc_chunks[doc_id]
+        starts = [self.chunks[i]["start"] for i in chunk_ids]
+        return chunk_ids[max(0, bisect_right(starts, pos) - 1)] if chunk_ids else -1
+
+    def group_of(self, chunk_id: int) -> int:
+        """段落所属的近似重复组（以代表块ID标识）；没有去重结果时每个段落自成一组"""
+        if self.canonical is None:
+            return chunk_id
+        return self.canonical[chunk_id]
+
+    def term_positions(self, query_terms: list[str]) -> list[tuple[dict[int, list[int]], int, float]]:
+        """查询词在正文中的位置：[(块ID -> 位置列表, 词长, 权重)]
+
+        长度超过2的中文片段由其二字切分表示，单字太常见不参与。
+        """
+        found = []
+        for term in query_terms:
+            if CJK_TERM_RE.fullmatch(term):
+                if len(term) != 2:
+                    continue
+                weight = 1.0
+            else:
+                weight = 2.0
+            hits = self.body.lookup(term)
+            if hits:
+                found.append((hits, len(term), weight))
+        return found
+
+    def snippet(self, chunk_id: int, term_positions: list, width: int = SNIPPET_WINDOW_CHARS,
+                max_windows: int = SNIPPET_MAX_WINDOWS) -> tuple[str, list[tuple[int, int]]]:
+        """段落中查询词最密集的窗口拼成的片段，以及各窗口在文档content中的区间
+
+        段落不超过 width * max_windows 时原样返回。
+        """
+        chunk = self.chunks[chunk_id]
+        content = chunk["content"]
+        if len(content) <= width * max_windows:
+            return content, [(chunk["start"], chunk["end"])]
+
+        events = []
+        for term_idx, (hits, length, weight) in enumerate(term_positions):
+            for pos in hits.get(chunk_id, ()):
+                events.append((pos, pos + length, term_idx, weight))
+        if not events:
+            windows = [(0, width)]
+        else:
+            events.sort()
+            windows = best_windows(events, len(content), width, max_windows)
+
+        spans = []
+        for start, end in windows:
+            start, end = snap_to_lines(content, start, end)
+            if spans and start <= spans[-1][1] + SNIPPET_SNAP_CHARS:
+                # 对齐后相邻的窗口合并为连续的一段
+                spans[-1] = (spans[-1][0], max(end, spans[-1][1]))
+            else:
+                spans.append((start, end))
+        text = SNIPPET_SEPARATOR.join(content[start:end].strip() for start, end in spans)
+        return text, [(chunk["start"] + start, chunk["start"] + end) for start, end in spans]
+
+    def fields(self) -> dict[str, FieldIndex]:
+        return {"title": self.title, "section_titles": self.section_titles, "body": self.body}
+
+    def facet_view(self, **filters: str) -> DocumentView:
+        """多个分面取值的交集，如 facet_view(course="CODE", level="CODE2")；结果会缓存"""
+        key = tuple(sorted(filters.items()))
+        view = self._views.get(key)
+        if view is None:
+            doc_ids = None
+            for facet, value in key:
+                members = self.facets.get(facet, {}).get(value)
+                members = members.doc_ids if members is not None else frozenset()
+                doc_ids = members if doc_ids is None else doc_ids & members
+            view = self._views[key] = DocumentView(self, doc_ids if doc_ids is not None else range(len(self.documents)))
+        return view
+
+    def parse_scope(self, token: str) -> dict[str, str] | None:
+        """解析检索范围命令：课程线/级别别名，或来源目录名（如 品牌、培训手册）"""
+        token = token.strip().lower()
+        if token in SCOPE_ALIASES:
+            return SCOPE_ALIASES[token]
+        for value in self.facets.get("source", {}):
+            if value.lower() == token:
+                return {"source": value}
+        return None
+
+    def filter_by_course_type(self, documents: list, course_type: str) -> list:
+        """按课程线分面过滤文档"""
+        view = self.facet_view(course=course_type)
+        if documents is self.documents:
+            return view
+        return [doc for doc in documents if self._id_by_object[id(doc)] in view.doc_ids]
+
+    def doc_ids_of(self, documents: list) -> set[int] | None:
+        """将文档列表映射为文档ID集合；全量文档时返回None表示不过滤"""
+        if documents is self.documents:
+            return None
+        if isinstance(documents, DocumentView) and documents.index is self:
+            return documents.doc_ids
+        return {self._id_by_object[id(doc)] for doc in documents}
+
+    def chunk_ids_of(self, documents: list) -> set[int] | None:
+        """将文档列表（如按课程类型过滤后的子集）映射为块ID集合
+
+        列表就是全量文档时返回None表示不过滤；含有不属于本索引的文档时抛出KeyError。
+        """
+        if documents is self.documents:
+            return None
+        if isinstance(documents, DocumentView) and documents.index is self:
+            return documents.chunk_ids
+        chunk_ids = set()
+        for doc in documents:
+            chunk_ids.update(self.doc_chunks[self._id_by_object[id(doc)]])
+        return chunk_ids
+
+    def acquire(self) -> bool:
+        """请求开始使用本索引时登记租约；已关闭（或正在关闭）时返回 False，应改取引擎的当前索引"""
+        with self._lease_lock:
+            if self.closed:
+                return False
+            self.leases += 1
+            return True
+
+    def release(self):
+        """归还 acquire 登记的租约"""
+        with self._lease_lock:
+            self.leases -= 1
+
+    def close(self) -> bool:
+        """关闭预建索引文件的内存映射，之后本索引不能再检索。还有请求持有租约时什么都不动，返回 False；
+        开始关闭后不再发放租约，映射内存仍被别处引用（mmap.close 抛 BufferError）时返回 False，稍后再试"""
+        with self._lease_lock:
+            if self.leases:
+                return False
+            self.closed = True
+            if self.mapped is None:
+                return True
+            # 倒排表、位图与排序引擎缓存引用着映射内存，先放下才能关闭映射
+            self.title = self.section_titles = self.body = None
+            self.chunk_masks = self.doc_masks = self.canonical = self.signatures = None
+            self.rankers = {}
+            try:
+                self.mapped.close()
+            except BufferError:
+                return False
+            self.mapped = None
+            return True
+
+    def covers(self, documents: list) -> bool:
+        """判断给定文档列表是否都来自本索引"""
+        if isinstance(documents, DocumentView):
+            return documents.index is self
+        return all(id(doc) in self._id_by_object for doc in documents)
+
+    def _scan_term(self, term: str, scores: dict[int, int], chunk_ids):
+        """无法由索引回答的词项（如整句兜底词）退回逐块扫描"""
+        for chunk_id in (chunk_ids if chunk_ids is not None else range(len(self.chunks))):
+            chunk = self.chunks[chunk_id]
+            if term in chunk["title"].lower():
+                scores[chunk_id] += 10
+            content = chunk["content"].lower()
+            if term in content:
+                scores[chunk_id] += 3 + content.count(term)
+
+    def score_legacy(self, query: str, query_terms: list[str], chunk_ids: set[int] | None = None) -> list[tuple[int, int]]:
+        """原有打分规则（作用于块）：标题命中+10，正文命中+3+出现次数，关键词组命中+5
+
+        返回按块ID升序的 (块ID, 分数) 列表，仅包含分数大于0的块。
+        """
+        query_lower = query.lower()
+        scores = defaultdict(int)
+
+        for term in query_terms:
+            title_hits = self.title.lookup(term)
+            body_hits = self.body.lookup(term)
+            if title_hits is None or body_hits is None:
+                self._scan_term(term, scores, chunk_ids)
+                continue
+            for chunk_id in title_hits:
+                scores[chunk_id] += 10
+            for chunk_id, positions in body_hits.items():
+                scores[chunk_id] += 3 + count_non_overlapping(positions, len(term))
+
+        query_mask = scan_keywords(query_lower)
+        for key, bit in BOOST_BITS.items():
+            if query_mask & bit:
+                for chunk_id in self.boost_chunks[key]:
+                    scores[chunk_id] += 5
+
+        return sorted(
+            (chunk_id, score) for chunk_id, score in scores.items()
+            if score > 0 and (chunk_ids is None or chunk_id in chunk_ids)
+        )
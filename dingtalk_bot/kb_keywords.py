@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+斯坦星球知识库 - 关键词表与多模式匹配自动机
+
+与查询无关的关键词表（加权关键词组、课程类型识别词、文档课程类型标记词）
+在启动时编译进同一个 Aho-Corasick 自动机，每个关键词对应一组比特位：
+- 加载时对每个文档/段落扫描一次，得到其命中的关键词组位图
+- 每次查询只对问题文本扫描一次，之后全部是位运算
+"""
+
+from collections import deque
+
+# 斯坦星球专用关键词加权（查询命中某组关键词时，命中同组关键词的段落+5分）
+BOOST_KEYWORDS = {
+    # STEM相关
+    "stem": ["stem", "幼儿", "科创", "机械", "建筑", "物理"],
+    "小班": ["小班", "3-4岁", "认识我自己", "动物", "植物"],
+    "中班": ["中班", "4-5岁", "机械", "建筑", "智能"],
+    "大班": ["大班", "5-6岁", "复杂机械", "能源", "空间", "智能硬件"],
+    # CODE相关
+    "code": ["code", "scratch", "编程", "少儿编程", "游戏开发"],
+    "code1": ["code1", "机械结构", "智能硬件", "编程启蒙"],
+    "code2": ["code2", "智能应用", "智能交互", "算法逻辑"],
+    "code3": ["code3", "智能系统", "游戏开发", "高级工程"],
+    # Python相关
+    "python": ["python", "pythonai", "人工智能", "ai"],
+    "l1": ["l1", "函数", "算法", "数据结构"],
+    "l2": ["l2", "数据科学", "计算机视觉", "cv", "仿生"],
+    # C++信奥
+    "信奥": ["信奥", "c++", "noi", "csp", "竞赛"],
+    # 销售相关
+    "销售": ["销售", "话术", "咨询", "异议", "促单"],
+    "家长": ["家长", "沟通", "续费", "转介绍"],
+}
+
+# 查询中的课程类型识别词（按优先级排列，先命中者优先）
+COURSE_TYPE_QUERY_KEYWORDS = {
+    # STEM幼儿课程关键词
+    "STEM": ["小班", "中班", "大班", "幼儿", "stem", "3岁", "4岁", "5岁", "6岁", "认识我自己", "动物王国", "植物奥秘",
+             "数理物理", "机械与工具", "建筑与结构", "智能机械", "物理科学", "复杂机械", "地球与空间", "能源科学", "智能硬件"],
+    # PythonAI课程关键词
+    "PythonAI": ["python", "pythonai", "人工智能", "ai课", "l1", "l2", "函数", "算法", "数据结构", "计算机视觉", "仿生"],
+    # CODE少儿编程关键词
+    "CODE": ["code1", "code2", "code3", "scratch", "少儿编程", "编程启蒙", "游戏开发"],
+    # C++信奥关键词
+    "CPP": ["信奥", "c++", "noi", "csp", "竞赛"],
+}
+
+# 文档标题/来源中的课程类型标记词
+COURSE_TYPE_DOC_KEYWORDS = {
+    "STEM": ["stem", "小班", "中班", "大班"],
+    "PythonAI": ["python"],
+    "CODE": ["code"],
+    "CPP": ["c++", "信奥", "noi", "csp"],
+}
+
+
+class KeywordAutomaton:
+    """Aho-Corasick 多模式匹配：一次线性扫描得到所有命中关键词的位图并集"""
+
+    def __init__(self):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[int] = [0]
+
+    def add(self, pattern: str, mask: int):
+        node = 0
+        for ch in pattern:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(0)
+                self._goto[node][ch] = nxt
+            node = nxt
+        self._out[node] |= mask
+
+    def build(self):
+        """广度优先计算失败指针，并把失败链上的输出位图合并到每个节点"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._out[nxt] |= self._out[self._fail[nxt]]
+                queue.append(nxt)
+        return self
+
+    def scan(self, text: str) -> int:
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        mask = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            mask |= out[node]
+        return mask
+
+
+def _assign_bits(tables: list[dict]) -> list[dict[str, int]]:
+    bits = []
+    next_bit = 0
+    for table in tables:
+        bits.append({key: 1 << (next_bit + i) for i, key in enumerate(table)})
+        next_bit += len(table)
+    return bits
+
+
+BOOST_BITS, QUERY_TYPE_BITS, DOC_TYPE_BITS = _assign_bits(
+    [BOOST_KEYWORDS, COURSE_TYPE_QUERY_KEYWORDS, COURSE_TYPE_DOC_KEYWORDS]
+)
+BOOST_MASK = sum(BOOST_BITS.values())
+QUERY_TYPE_MASK = sum(QUERY_TYPE_BITS.values())
+DOC_TYPE_MASK = sum(DOC_TYPE_BITS.values())
+
+
+def _build_keyword_automaton() -> KeywordAutomaton:
+    automaton = KeywordAutomaton()
+    for table, bits in (
+        (BOOST_KEYWORDS, BOOST_BITS),
+        (COURSE_TYPE_QUERY_KEYWORDS, QUERY_TYPE_BITS),
+        (COURSE_TYPE_DOC_KEYWORDS, DOC_TYPE_BITS),
+    ):
+        for key, patterns in table.items():
+            for pattern in patterns:
+                automaton.add(pattern, bits[key])
+    return automaton.build()
+
+
+KEYWORDS = _build_keyword_automaton()
+
+
+def scan_keywords(text: str) -> int:
+    """扫描小写文本，返回命中的全部关键词组位图"""
+    return KEYWORDS.scan(text)
+
+
+def boost_groups(mask: int) -> list[str]:
+    return [key for key, bit in BOOST_BITS.items() if mask & bit]
+
+
+def course_type_of_query(mask: int) -> str | None:
+    """按优先级返回查询位图对应的课程类型"""
+    for course_type, bit in QUERY_TYPE_BITS.items():
+        if mask & bit:
+            return course_type
+    return None
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+斯坦星球知识库 - 排序引擎
+
+可插拔的段落（section分块）打分器，通过 config.json 的 rank_engine 选择：
+- legacy：原有规则（标题+10、正文+3+出现次数、关键词组+5），偏向篇幅大的文本
+- bm25：BM25F，对标题、section标题、正文三个字段分别做长度归一化后加权，
+  文档频率与长度归一化系数在建索引时一次算好
+- vector：本地稠密向量余弦相似度（见 kb_vectors），召回换了说法的问题
+- hybrid：bm25 与 vector 并发检索，按倒数排名融合（RRF）；每一路有独立的时间预算，
+  超时的一路直接丢弃，用另一路的结果。只有 bm25 交给线程池（便于超时丢弃），向量一路
+  只是一次矩阵乘，在当前线程执行：卡住的 bm25 占满线程池时，后来的查询仍有向量结果可答
+"""
+
+import math
+import re
+import time
+from array import array
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from kb_index import CJK_TERM_RE, KnowledgeIndex
+from kb_vectors import chunk_key
+
+# 问句里的疑问词与语气词：跨过它们的二字切分（“有什么区别”中的 有什/么区）在正文里
+# 随处可见又恰好不太常见，IDF 偏高，会把无关段落排到课程名前面
+QUESTION_FILLER_RE = re.compile(r"有什么|是什么|什么是|为什么|什么|怎么样|怎么办|怎么|如何|哪些|哪个|请问|一下|[吗呢吧啊呀]")
+
+
+class LegacyRanker:
+    """原有打分规则"""
+
+    name = "legacy"
+
+    def __init__(self, index: KnowledgeIndex):
+        self.index = index
+
+    def score(self, query: str, query_terms: list[str], chunk_ids: set[int] | None = None) -> list[tuple[int, float]]:
+        return self.index.score_legacy(query, query_terms, chunk_ids)
+
+
+class BM25FRanker:
+    """BM25F：多字段词频按字段权重与长度归一化合并后再做饱和"""
+
+    name = "bm25"
+
+    K1 = 1.2
+    # 查询词权重：英文/编号词项（课程名、课程编号）区分度高；中文单字多为虚词
+    LATIN_TERM_WEIGHT = 2.0
+    CJK_CHAR_WEIGHT = 0.3
+    # 字段: (权重, 长度归一化系数b)
+    FIELDS = {
+        "title": (3.0, 0.5),
+        "section_titles": (2.0, 0.6),
+        "body": (1.0, 0.75),
+    }
+
+    def __init__(self, index: KnowledgeIndex):
+        self.index = index
+        self.doc_count = len(index.chunks)
+        fields = index.fields()
+
+        # 长度归一化分母 1 - b + b * len / avg_len，按字段预先算好
+        self.norms = {}
+        for name, (_, b) in self.FIELDS.items():
+            lengths = fields[name].lengths
+            avg_len = (sum(lengths) / len(lengths)) if lengths else 0
+            self.norms[name] = array("d", (
+                (1 - b + b * length / avg_len) if avg_len else 1.0
+                for length in lengths
+            ))
+
+        # 文档频率：任一字段包含该词项的块数（标题类字段的词表很小，只对它们求并集）
+        self.df = {key: len(posting) for key, posting in index.body.postings.items()}
+        for key in set(index.title.postings) | set(index.section_titles.postings):
+            chunk_ids = set()
+            for field in fields.values():
+                posting = field.postings.get(key)
+                if posting is not None:
+                    chunk_ids.update(posting.doc_ids)
+            self.df[key] = len(chunk_ids)
+
+    def idf(self, df: int) -> float:
+        return math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+
+    def ranking_terms(self, query_terms: list[str], query: str = "") -> list[tuple[str, float]]:
+        """返回 (词项, 权重)；长度超过2的中文片段由其二字切分表示，避免重复计分
+
+        给出 query 时先去掉其中的疑问词与语气词，不再出现在剩余文本中的中文词项不参与打分。
+        """
+        remaining = QUESTION_FILLER_RE.sub(" ", query.lower()) if query else None
+        weighted = []
+        for term in query_terms:
+            if not term:
+                continue
+            if CJK_TERM_RE.fullmatch(term):
+                if remaining is not None and term not in remaining:
+                    continue
+                if len(term) == 1:
+                    weighted.append((term, self.CJK_CHAR_WEIGHT))
+                elif len(term) == 2:
+                    weighted.append((term, 1.0))
+            else:
+                weighted.append((term, self.LATIN_TERM_WEIGHT))
+        return weighted
+
+    def field_frequencies(self, term: str) -> dict[str, dict[int, int]]:
+        """词项在各字段中的词频：块ID -> tf"""
+        freqs = {}
+        for name, field in self.index.fields().items():
+            if len(term) == 1 and CJK_TERM_RE.fullmatch(term):
+                # 单字没有独立的键，由以该字开头的所有键合并得到
+                hits = field.lookup(term) or {}
+                freqs[name] = {chunk_id: len(positions) for chunk_id, positions in hits.items()}
+                continue
+            posting = field.postings.get(term)
+            freqs[name] = {} if posting is None else {chunk_id: tf for chunk_id, tf, _ in posting}
+        return freqs
+
+    def score(self, query: str, query_terms: list[str], chunk_ids: set[int] | None = None) -> list[tuple[int, float]]:
+        scores = defaultdict(float)
+        for term, term_weight in self.ranking_terms(query_terms, query):
+            freqs = self.field_frequencies(term)
+            matched = set()
+            for by_doc in freqs.values():
+                matched.update(by_doc)
+            if not matched:
+                continue
+            df = self.df.get(term, len(matched))
+            idf = self.idf(df) * term_weight
+
+            for chunk_id in matched:
+                if chunk_ids is not None and chunk_id not in chunk_ids:
+                    continue
+                weighted_tf = 0.0
+                for name, (weight, _) in self.FIELDS.items():
+                    tf = freqs[name].get(chunk_id)
+                    if tf:
+                        weighted_tf += weight * tf / self.norms[name][chunk_id]
+                scores[chunk_id] += idf * weighted_tf / (self.K1 + weighted_tf)
+
+        return sorted((chunk_id, round(score, 4)) for chunk_id, score in scores.items() if score > 0)
+
+
+class VectorRanker:
+    """稠密向量检索：需要先生成向量文件并随知识库加载到 index.vectors"""
+
+    name = "vector"
+
+    CANDIDATES = 50
+
+    def __init__(self, index: KnowledgeIndex):
+        if index.vectors is None:
+            raise ValueError("向量检索不可用：需要安装 numpy 并运行 python kb_vectors.py 生成向量文件")
+        self.index = index
+
+    def score(self, query: str, query_terms: list[str], chunk_ids: set[int] | None = None) -> list[tuple[int, float]]:
+        hits = self.index.vectors.search(query, chunk_ids, self.CANDIDATES)
+        return sorted((chunk_id, round(score, 4)) for chunk_id, score in hits)
+
+
+class HybridRanker:
+    """关键词 + 向量混合检索：各路并发执行，倒数排名融合，结果带上各路排名便于调参"""
+
+    name = "hybrid"
+
+    RRF_K = 60
+    STAGE_DEPTH = 50  # 每一路参与融合的候选段落数
+    # 每一路的时间预算（毫秒），从同一起点计时
+    STAGE_BUDGET_MS = {"bm25": 800, "vector": 200}
+
+    # 只执行关键词一路：超时的一路仍会跑完才让出线程，还没开始的在超时时取消
+    _executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rank")
+
+    def __init__(self, index: KnowledgeIndex):
+        self.index = index
+        # 没有向量文件时退化为只有 bm25 一路
+        names = ["bm25"] + (["vector"] if index.vectors is not None else [])
+        self.stages = [get_ranker(index, name) for name in names]
+
+    def _run_stage(self, ranker, query: str, query_terms: list[str], chunk_ids):
+        started = time.perf_counter()
+        scored = ranker.score(query, query_terms, chunk_ids)
+        scored.sort(key=lambda x: x[1], reverse=True)
+        return scored[:self.STAGE_DEPTH], (time.perf_counter() - started) * 1000
+
+    def fuse(self, query: str, query_terms: list[str], chunk_ids: set[int] | None = None):
+        """返回 (融合结果, 各路耗时)
+
+        融合结果为 [(块ID, RRF分数, {路名: 排名})]，按分数降序，内容相同的段落只保留一个；
+        各路耗时为 {路名: 毫秒}，超出预算被丢弃的一路记为 None。
+        """
+        started = time.perf_counter()
+        keyword, *inline = self.stages
+        results = {}
+        timings = {ranker.name: None for ranker in self.stages}
+        if not inline:
+            # 只有一路：没有别的结果可用，不设预算
+            results[keyword.name], timings[keyword.name] = self._run_stage(keyword, query, query_terms, chunk_ids)
+        else:
+            future = self._executor.submit(self._run_stage, keyword, query, query_terms, chunk_ids)
+            late = []  # 超出预算的向量路：关键词一路也没有结果时仍用它
+            for ranker in inline:
+                scored, timings[ranker.name] = self._run_stage(ranker, query, query_terms, chunk_ids)
+                if (time.perf_counter() - started) * 1000 > self.STAGE_BUDGET_MS.get(ranker.name, 500):
+                    late.append((ranker.name, scored))
+                else:
+                    results[ranker.name] = scored
+            remaining = self.STAGE_BUDGET_MS.get(keyword.name, 500) / 1000 - (time.perf_counter() - started)
+            try:
+                results[keyword.name], timings[keyword.name] = future.result(timeout=max(remaining, 0))
+            except TimeoutError:
+                future.cancel()  # 线程池被占满、还没轮到执行的直接取消
+            for name, scored in late:
+                if results:
+                    timings[name] = None
+                else:
+                    results[name] = scored
+
+        fused = defaultdict(float)
+        sources = defaultdict(dict)
+        for name, scored in results.items():
+            for rank, (chunk_id, _) in enumerate(scored, 1):
+                fused[chunk_id] += 1 / (self.RRF_K + rank)
+                sources[chunk_id][name] = rank
+
+        hits = []
+        seen = {}
+        for chunk_id in sorted(fused, key=lambda c: (-fused[c], c)):
+            key = chunk_key(self.index.chunks[chunk_id])
+            if key in seen:
+                # 重复文件中的相同段落：并入排名靠前的那个
+                for name, rank in sources[chunk_id].items():
+                    seen[key].setdefault(name, rank)
+                continue
+            seen[key] = sources[chunk_id]
+            hits.append((chunk_id, round(fused[chunk_id], 6), sources[chunk_id]))
+        return hits, timings
+
+    def score(self, query: str, query_terms: list[str], chunk_ids: set[int] | None = None) -> list[tuple[int, float]]:
+        hits, _ = self.fuse(query, query_terms, chunk_ids)
+        return sorted((chunk_id, score) for chunk_id, score, _ in hits)
+
+
+RANKERS = {
+    LegacyRanker.name: LegacyRanker,
+    BM25FRanker.name: BM25FRanker,
+    VectorRanker.name: VectorRanker,
+    HybridRanker.name: HybridRanker,
+}
+
+
+def get_ranker(index: KnowledgeIndex, name: str):
+    """获取索引对应的排序引擎（同一索引上只初始化一次）"""
+    ranker = index.rankers.get(name)
+    if ranker is None:
+        if name not in RANKERS:
+            raise ValueError(f"未知的排序引擎: {name}，可选: {', '.join(RANKERS)}")
+        ranker = index.rankers[name] = RANKERS[name](index)
+    return ranker
+
+
+def search_chunks(index: KnowledgeIndex, ranker, query: str, query_terms: list[str],
+                  chunk_ids: set[int] | None, limit: int, snippets: bool = True):
+    """排序并取前 limit 个段落
+
+    返回 (段落列表, 各路耗时)；段落是块的副本，附带 _score 与 _sources（{路名: 排名}，
+    单一排序引擎时只有一路）。snippets 为真时超长段落只保留查询词最密集的窗口，
+    _windows 记录这些窗口在文档中的区间。
+
+    lean 为交给大模型的精简文本（转换时预先生成，见 kb_chunker.lean_text），总是整段给出
+    （段落本身不超过 CHUNK_MAX_CHARS 字）；build_context 优先使用它，而不是 content 中的片段。
+
+    近似重复的段落（见 kb_dedup）只保留排名最高的一个，_group 为所属的重复组，
+    _duplicates 为排在它之后、被合并掉的同组段落数；名额留给内容不同的段落。
+    """
+    if isinstance(ranker, HybridRanker):
+        hits, timings = ranker.fuse(query, query_terms, chunk_ids)
+    else:
+        started = time.perf_counter()
+        scored = ranker.score(query, query_terms, chunk_ids)
+        scored.sort(key=lambda x: x[1], reverse=True)
+        hits = [(chunk_id, score, {ranker.name: rank}) for rank, (chunk_id, score) in enumerate(scored, 1)]
+        timings = {ranker.name: (time.perf_counter() - started) * 1000}
+
+    collapsed = {}  # 重复组 -> [保留下来的命中, 合并掉的同组段落数]
+    for hit in hits:
+        group = index.group_of(hit[0])
+        if group in collapsed:
+            collapsed[group][1] += 1
+        elif len(collapsed) < limit:
+            collapsed[group] = [hit, 0]
+        else:
+            break
+    hits = [hit for hit, _ in collapsed.values()]
+    term_positions = index.term_positions(query_terms) if snippets and hits else []
+    results = []
+    for chunk_id, score, sources in hits:
+        group = index.group_of(chunk_id)
+        passage = dict(index.chunks[chunk_id], _score=score, _sources=sources,
+                       _group=group, _duplicates=collapsed[group][1])
+        if snippets:
+            passage["content"], passage["_windows"] = index.snippet(chunk_id, term_positions)
+        passage["lean"] = index.lean[chunk_id]
+        results.append(passage)
+    return results, timings
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+斯坦星球知识库 - 热更新
+
+后台线程定期检查知识库有没有新版本：已发布快照时看 kb_snapshots/CURRENT 指向的版本，
+还没有发布过快照时看旧版布局下 knowledge_base.pack、knowledge_base.index 与逐篇JSON
+的修改时间和大小。发现变化后在后台线程里调用机器人的加载函数，新索引完整建好后
+才以一次赋值替换全局引用：
+
+- 查询路径不加锁，请求开始时拿到的索引（以及它的文档列表、分面视图）一直用到请求结束；
+- 正在处理的请求持有索引租约，照常在旧索引上答完；换下的旧索引等租约全部归还后，
+  由每次检查后调用的 release 关闭预建索引文件的内存映射（见 kb_engine）；
+- 加载失败时记录日志，继续使用旧索引，下次检查时重试。
+
+快照由 convert_kb.py 原子切换，检测到就加载；旧版布局下文件是逐个写入的，要连续两次
+检查结果一致（写完了）才加载。用轮询而不是 inotify：不引入额外依赖，Windows 上同样
+可用，知识库一天也更新不了几次，轮询的开销可以忽略。
+"""
+
+import logging
+import threading
+from pathlib import Path
+
+from kb_snapshot import current_version
+from kb_store import index_path, json_files, pack_path
+
+logger = logging.getLogger(__name__)
+
+RELOAD_INTERVAL = 10  # 检查间隔（秒）
+
+
+def source_signature(kb_dir) -> tuple:
+    """知识库当前版本的标识，知识库更新后标识随之变化"""
+    version = current_version(kb_dir)
+    if version is not None:
+        return ("snapshot", version)
+    kb_dir = Path(kb_dir)
+    paths = [pack_path(kb_dir), index_path(kb_dir)]
+    if kb_dir.is_dir():
+        paths += json_files(kb_dir)
+    signature = []
+    for path in paths:
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        signature.append((path.name, stat.st_mtime_ns, stat.st_size))
+    return ("files", tuple(signature))
+
+
+class KnowledgeBaseWatcher:
+    """轮询知识库版本，变化后在后台线程中调用 reload 重新加载
+
+    reload 返回加载到的文档列表，抛出异常或返回空列表都算失败，下次检查时重试。
+
+    应在机器人首次加载知识库之前启动：加载期间发布的新版本也会在下一次检查时被发现。
+    """
+
+    def __init__(self, kb_dir, reload, interval: float = RELOAD_INTERVAL, release=None):
+        self.kb_dir = Path(kb_dir)
+        self.reload = reload
+        self.release = release  # 每次检查后调用，关闭换下的旧索引
+        self.interval = interval
+        self.loaded = source_signature(self.kb_dir)
+        self.failed = None  # 上一次加载失败的标识，重试仍失败时不再重复打印堆栈
+        self.reloads = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="kb-reload", daemon=True)
+
+    def start(self) -> "KnowledgeBaseWatcher":
+        self._thread.start()
+        logger.info(f"知识库热更新已启用，每 {self.interval} 秒检查一次")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        pending = None  # 旧版布局下上一次检查看到的新标识，再次看到相同标识才加载
+        while not self._stop.wait(self.interval):
+            pending = self._check(pending)
+            if self.release is not None:
+                try:
+                    self.release()
+                except Exception as e:
+                    logger.exception(f"释放旧索引失败: {e}")
+
+    def _check(self, pending):
+        """检查一次知识库版本，有变化时重新加载；返回旧版布局下待确认的新标识"""
+        try:
+            signature = source_signature(self.kb_dir)
+        except OSError as e:
+            logger.warning(f"检查知识库版本失败: {e}")
+            return pending
+        if signature == self.loaded:
+            return None
+        if signature[0] == "files" and signature != pending:
+            return signature
+
+        logger.info(f"检测到知识库更新（{signature[1] if signature[0] == 'snapshot' else '知识库文件'}），后台重新加载")
+        try:
+            if not self.reload():
+                raise ValueError("没有加载到任何文档")
+        except Exception as e:
+            # 不记下这个版本：下次检查时重试，临时性的失败（文件被占用、磁盘满）不会一直用旧版本
+            if signature != self.failed:
+                logger.exception(f"知识库重新加载失败，继续使用当前版本: {e}")
+            else:
+                logger.warning(f"知识库重新加载仍然失败，继续使用当前版本: {e}")
+            self.failed = signature
+            return signature
+        self.loaded = signature
+        self.failed = None
+        self.reloads += 1
+        return None
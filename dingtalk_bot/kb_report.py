@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+斯坦星球知识库 - 转换报告
+
+convert_kb.py 每次发布快照时生成 knowledge_base.report.json（随快照保存）并在控制台打印摘要：
+
+- 按来源目录（文件名前缀，如 CODE、品牌、编程概念）与逐篇文档统计：源文件字节数、
+  段落数、估算 token 数（原文 / 交给大模型的精简文本）、最大的几个小节、近似重复段落
+  占比、转换耗时
+- 生成文件大小（知识库文件、预建索引、段落向量）与预建索引的加载耗时（增量转换默认不计时）
+- 与上一个快照的报告相比的增长
+- 转换失败的源文件（改动过的文件转换失败时沿用上一版本的文档）
+
+逐篇文档的段落、token 与小节统计只取决于正文（和分块、精简文本规则）：正文的 CRC32
+与上一版本报告中的一致时直接沿用，增量转换时只统计改动过的文档；重复段落数跟着全库
+去重结果变，每次重新计数。
+
+token 数按中文每字1个、其余字符每4个1个估算，只用于比较大小，不是精确计数。
+单篇文档的精简文本超过 CONTEXT_BUDGET_CHARS（机器人构建上下文的默认长度）时标记为
+超出上下文预算：按课程编号命中时只能放进它的一部分。
+
+查看某个快照的报告：
+python kb_report.py [版本]
+"""
+
+import json
+import re
+import sys
+import unicodedata
+import zlib
+from collections import defaultdict
+from pathlib import Path
+
+from kb_chunker import CHUNKER_VERSION, RENDER_VERSION
+
+REPORT_VERSION = 1
+CONTEXT_BUDGET_CHARS = 8000  # 与 build_context 的 max_chars 默认值一致
+LARGEST_SECTIONS = 3  # 每篇文档列出的最大小节数
+TOP_DOCUMENTS = 10  # 控制台列出的最大文档数
+
+CJK_CHAR_RE = re.compile(r"[　-〿一-鿿＀-￯]")
+
+
+def report_path(kb_dir) -> Path:
+    kb_dir = Path(kb_dir)
+    return kb_dir.parent / f"{kb_dir.name}.report.json"
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中文（含全角标点）每字1个，其余每4个字符1个"""
+    other = len(CJK_CHAR_RE.sub("", text))
+    return len(text) - other + (other + 3) // 4
+
+
+def load_report(kb_dir) -> dict | None:
+    try:
+        with open(report_path(kb_dir), "r", encoding="utf-8") as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return report if report.get("version") == REPORT_VERSION else None
+
+
+def _source_group(file_name: str) -> str:
+    return file_name.split("_", 1)[0] or "其他"
+
+
+def _content_stats(index, chunk_ids) -> dict:
+    """只取决于正文的统计：token、是否超出上下文预算、最大的几个小节"""
+    sections = defaultdict(lambda: [0, 0])  # 小节 -> [字数, token]
+    tokens = lean_tokens = 0
+    for chunk_id in chunk_ids:
+        chunk = index.chunks[chunk_id]
+        chunk_tokens = estimate_tokens(chunk["content"])
+        tokens += chunk_tokens
+        lean_tokens += estimate_tokens(index.lean[chunk_id])
+        sections[chunk["section"]][0] += len(chunk["content"])
+        sections[chunk["section"]][1] += chunk_tokens
+    largest = sorted(sections.items(), key=lambda item: item[1][0], reverse=True)[:LARGEST_SECTIONS]
+    return {
+        "tokens": tokens,
+        "lean_tokens": lean_tokens,
+        "over_budget": sum(len(index.lean[i]) for i in chunk_ids) > CONTEXT_BUDGET_CHARS,
+        "largest_sections": [
+            {"section": name or "（开头）", "chars": chars, "tokens": section_tokens}
+            for name, (chars, section_tokens) in largest
+        ],
+    }
+
+
+def _document_entry(index, doc_id: int, doc: dict, source: dict, previous: dict | None = None) -> dict:
+    """单篇文档的统计；previous 为上一版本报告中同名文档的条目，正文未变时沿用其中的统计"""
+    chunk_ids = index.doc_chunks[doc_id]
+    content = doc.get("content", "")
+    crc = zlib.crc32(content.encode("utf-8"))
+    if previous is not None and previous.get("crc32") == crc and previous.get("chunks") == len(chunk_ids):
+        stats = {key: previous[key] for key in ("tokens", "lean_tokens", "over_budget", "largest_sections")}
+    else:
+        stats = _content_stats(index, chunk_ids)
+    return {
+        "file": doc.get("file", ""),
+        "title": doc.get("title", ""),
+        "bytes": source.get("bytes", 0),
+        "chars": len(content),
+        "crc32": crc,
+        "chunks": len(chunk_ids),
+        "tokens": stats["tokens"],
+        "lean_tokens": stats["lean_tokens"],
+        "duplicate_chunks": sum(index.group_of(chunk_id) != chunk_id for chunk_id in chunk_ids),
+        "convert_ms": source.get("convert_ms"),
+        "over_budget": stats["over_budget"],
+        "largest_sections": stats["largest_sections"],
+    }
+
+
+def _summarize(entries: list[dict]) -> dict:
+    chunks = sum(e["chunks"] for e in entries)
+    duplicates = sum(e["duplicate_chunks"] for e in entries)
+    return {
+        "documents": len(entries),
+        "bytes": sum(e["bytes"] for e in entries),
+        "chunks": chunks,
+        "tokens": sum(e["tokens"] for e in entries),
+        "lean_tokens": sum(e["lean_tokens"] for e in entries),
+        "duplicate_chunks": duplicates,
+        "duplicate_ratio": round(duplicates / chunks, 4) if chunks else 0.0,
+        "convert_ms": round(sum(e["convert_ms"] or 0 for e in entries), 1),
+        "over_budget": sum(e["over_budget"] for e in entries),
+    }
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _growth(current: dict, previous: dict) -> dict:
+    """数值项的增长；本次或上一次没有的项（如增量转换未计时的加载耗时）不比较"""
+    return {key: value - previous.get(key, 0) for key, value in current.items()
+            if _is_number(value) and _is_number(previous.get(key, 0))}
+
+
+def build_report(index, sources: dict, artifacts: dict, load_seconds: float | None,
+                 version: str, previous: dict | None = None, failures: list[dict] | None = None) -> dict:
+    """汇总转换结果。sources 为 文档名 -> {"bytes": 源文件字节数, "convert_ms": 转换耗时}，
+    artifacts 为 生成文件名 -> 字节数，load_seconds 为预建索引加载耗时（None 为未计时），
+    previous 为上一个快照的报告（没有时不计算增长），
+    failures 为转换失败的源文件 [{"file", "source", "error", "retained"}]"""
+    # 分块或精简文本规则变了时不沿用上一版本的逐篇统计
+    reusable = {}
+    if previous is not None and (previous.get("chunker"), previous.get("render")) == (CHUNKER_VERSION, RENDER_VERSION):
+        reusable = {entry["file"]: entry for entry in previous.get("documents", [])}
+    documents = [
+        _document_entry(index, doc_id, doc, sources.get(doc.get("file"), {}), reusable.get(doc.get("file")))
+        for doc_id, doc in enumerate(index.documents)
+    ]
+    groups = defaultdict(list)
+    for entry in documents:
+        groups[_source_group(entry["file"])].append(entry)
+
+    totals = _summarize(documents)
+    totals["artifact_bytes"] = sum(artifacts.values())
+    totals["index_load_ms"] = round(load_seconds * 1000, 1) if load_seconds is not None else None
+    report = {
+        "version": REPORT_VERSION,
+        "snapshot": version,
+        "chunker": CHUNKER_VERSION,
+        "render": RENDER_VERSION,
+        "totals": totals,
+        "artifacts": artifacts,
+        "groups": {name: _summarize(entries) for name, entries in groups.items()},
+        "documents": documents,
+        "failures": failures or [],
+    }
+
+    if previous is not None:
+        previous_files = {e["file"] for e in previous.get("documents", [])}
+        current_files = {e["file"] for e in documents}
+        report["growth"] = {
+            "previous": previous.get("snapshot"),
+            "totals": _growth(totals, previous.get("totals", {})),
+            "groups": {
+                name: _growth(summary, previous.get("groups", {}).get(name, {}))
+                for name, summary in report["groups"].items()
+            },
+            "added_documents": len(current_files - previous_files),
+            "removed_documents": len(previous_files - current_files),
+        }
+    return report
+
+
+def save_report(report: dict, kb_dir) -> Path:
+    path = report_path(kb_dir)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def _ljust(text: str, width: int) -> str:
+    """按显示宽度左对齐（中文占两格）"""
+    shown = sum(2 if unicodedata.east_asian_width(ch) in "WF" else 1 for ch in text)
+    return text + " " * max(0, width - shown)
+
+
+def _signed(value, unit: str = "") -> str:
+    return f"{value:+,}{unit}" if isinstance(value, int) else f"{value:+,.1f}{unit}"
+
+
+def print_report(report: dict):
+    """控制台摘要：各来源目录、最大的文档、生成文件与增长"""
+    totals = report["totals"]
+    print(f"\n{_ljust('来源', 12)}  文档   段落  源文件KB     token(原文/精简) 重复率   转换ms")
+    rows = sorted(report["groups"].items(), key=lambda item: item[1]["tokens"], reverse=True)
+    for name, group in rows + [("合计", totals)]:
+        print(f"{_ljust(name, 12)}{group['documents']:>6}{group['chunks']:>7}{group['bytes'] // 1024:>10}"
+              f"{group['tokens']:>12}/{group['lean_tokens']:<8}{group['duplicate_ratio']:>7.1%}{group['convert_ms']:>9.0f}")
+
+    print(f"\n最大的 {TOP_DOCUMENTS} 篇文档（精简后 token；* 为超出上下文预算 {CONTEXT_BUDGET_CHARS} 字）：")
+    for entry in sorted(report["documents"], key=lambda e: e["lean_tokens"], reverse=True)[:TOP_DOCUMENTS]:
+        largest = entry["largest_sections"][0]["section"] if entry["largest_sections"] else ""
+        marker = "*" if entry["over_budget"] else " "
+        print(f" {marker}{entry['lean_tokens']:>7}  {entry['chunks']:>3}段  {entry['file']}  （最大小节：{largest}）")
+    print(f"  共 {totals['over_budget']} 篇超出上下文预算")
+
+    sizes = "  ".join(f"{name} {size // 1024}KB" for name, size in report["artifacts"].items())
+    load_ms = totals["index_load_ms"]
+    print(f"\n生成文件：{sizes}；预建索引加载 {f'{load_ms:.0f}ms' if load_ms is not None else '未计时（--time-load）'}")
+
+    failures = report.get("failures") or []
+    if failures:
+        print(f"\n转换失败 {len(failures)} 个源文件：")
+        for failure in failures:
+            print(f"  {failure['source']}：{failure['error']}（{'沿用上一版本' if failure['retained'] else '未收录'}）")
+
+    growth = report.get("growth")
+    if growth:
+        g = growth["totals"]
+        print(f"较上一版本 {growth['previous']}：文档 {_signed(g['documents'])}"
+              f"（新增 {growth['added_documents']}，移除 {growth['removed_documents']}）  段落 {_signed(g['chunks'])}"
+              f"  token {_signed(g['tokens'])}  生成文件 {_signed(g['artifact_bytes'] // 1024, 'KB')}"
+              + (f"  加载 {_signed(g['index_load_ms'], 'ms')}" if "index_load_ms" in g else ""))
+        changed = [(name, d) for name, d in growth["groups"].items() if d.get("documents") or d.get("tokens")]
+        for name, d in changed:
+            print(f"  {name}: 文档 {_signed(d['documents'])}  段落 {_signed(d['chunks'])}  token {_signed(d['tokens'])}")
+
+
+def main():
+    from kb_snapshot import current_version, snapshot_kb_dir, snapshot_root
+
+    kb_dir = Path(__file__).parent / "knowledge_base"
+    version = sys.argv[1] if len(sys.argv) > 1 else current_version(kb_dir)
+    if version is None:
+        print("还没有发布过快照")
+        sys.exit(1)
+    report = load_report(snapshot_kb_dir(snapshot_root(kb_dir) / version, kb_dir))
+    if report is None:
+        print(f"快照 {version} 没有转换报告")
+        sys.exit(1)
+    print(f"快照 {version}")
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+斯坦星球知识库 - 消息调度
+
+MessageScheduler（Stream 模式）：StarplanetKnowledgeHandler.process 原先对每条消息直接
+asyncio.to_thread(handle_message)，没有任何上限：大群里一阵提问就开出一批线程，各自阻塞
+在大模型调用上，大模型接口随即对所有请求限流。这里把一条消息拆成两步，分别放进两个线程池：
+
+- 检索（CPU）：快捷命令、切词、检索、构建上下文，retrieval_workers 个线程
+- 大模型（I/O）：llm_concurrency 个线程，同时进行的大模型调用不超过这个数
+
+handle_message 需要调用大模型时返回 kb_engine.PendingAnswer，由调度器放进大模型线程池。
+
+已接收、还没开始调用大模型的消息最多 queue_limit 条：队列满时直接拒绝（QueueFull，
+机器人回复稍后再试）；大模型线程都在忙时先回一句“已收到，前面还有 N 个问题”。
+stats() 返回当前排队数、进行中的大模型调用、排队等待时间（平均 / P95 / 最大）与累计计数。
+
+计数只在事件循环中修改，不需要加锁。
+
+WorkerPool（Webhook 模式）：dingtalk_callback 原先为每条消息新开一个守护线程，没有上限、
+不复用，停止时正在处理的问题直接丢失。这里改为固定 worker_threads 个工作线程从有界
+队列（queue_limit）取任务：
+
+- 队列满时 submit 抛出 QueueFull，机器人回复稍后再试
+- task_timeout：任务从接收起算的时限。排队超过时限才轮到的任务不再处理（回复稍后再试）；
+  已经开始的任务无法中断（大模型调用另有 HTTP 超时兜底），超时完成的记为 overdue
+- 退出时（SIGTERM / Ctrl+C 触发的正常退出，含 gunicorn 的优雅停止）不再接收新任务，
+  等已接收的任务处理完再退出，最多等 task_timeout 秒
+
+SingleFlight（两种模式共用）：群里老师问了一个问题，几位同事常在几秒内问同样的问题，各自
+一次检索加一次大模型调用。相同的问题（kb_engine.question_key：规范化的问题 + 检索范围）
+正在回答时，后来的请求不再调用大模型，等它的结果，各自收到一条完整回复。只合并同时进行的
+请求，结果不缓存；合并次数见 stats() 的 coalesced。
+"""
+
+import asyncio
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from kb_engine import PendingAnswer
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_WORKERS = 2  # 检索线程数（检索受 GIL 限制，多开无益）
+LLM_CONCURRENCY = 4  # 同时进行的大模型调用数
+QUEUE_LIMIT = 20  # 已接收、还没开始调用大模型的消息上限
+WORKER_THREADS = 8  # Webhook 模式的工作线程数
+TASK_TIMEOUT = 60  # Webhook 模式任务从接收起算的时限（秒），也是退出时等待的上限
+WAIT_WINDOW = 200  # 统计排队等待时间用的最近消息数
+QUEUED_REPLY = "已收到，前面还有 {position} 个问题在处理，请稍候～"
+BUSY_REPLY = "当前提问的人较多，请稍后再问一次。"
+
+
+class QueueFull(Exception):
+    """排队的消息已达上限（或正在停止）"""
+
+
+def wait_stats(waits) -> dict:
+    """排队等待时间（秒）的平均、P95 与最大值"""
+    waits = sorted(waits)
+    if not waits:
+        return {"wait_avg": 0.0, "wait_p95": 0.0, "wait_max": 0.0}
+    return {
+        "wait_avg": round(sum(waits) / len(waits), 3),
+        "wait_p95": round(waits[int(len(waits) * 0.95)], 3),
+        "wait_max": round(waits[-1], 3),
+    }
+
+
+class SingleFlight:
+    """相同键的调用同时只执行一次，执行中再来的调用等它的结果；线程安全，也可在事件循环中使用"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}  # 键 -> Future
+        self.counts = {"calls": 0, "coalesced": 0}
+
+    def claim(self, key) -> tuple[Future, bool]:
+        """返回 (future, leader)：leader 为 True 时调用方负责执行，并用 settle 给出结果"""
+        with self.lock:
+            self.counts["calls"] += 1
+            future = self.flights.get(key)
+            if future is not None:
+                self.counts["coalesced"] += 1
+                logger.info(f"相同问题正在回答，等待其结果（已合并 {self.counts['coalesced']} 次）: {key[0][:50]}")
+                return future, False
+            future = self.flights[key] = Future()
+            return future, True
+
+    def settle(self, key, future: Future, result=None, error: BaseException | None = None):
+        with self.lock:
+            self.flights.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, *args):
+        """执行 fn(*args) 并返回结果；相同键正在执行时等它的结果"""
+        future, leader = self.claim(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            self.settle(key, future, error=e)
+            raise
+        self.settle(key, future, result)
+        return result
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"in_flight": len(self.flights), **self.counts}
+
+
+class MessageScheduler:
+    """有界排队 + 检索/大模型两个线程池；配置在第一条消息到来时读取（与 RetrievalEngine 一致）"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.retrieval_pool = None
+        self.llm_pool = None
+        self.llm_slots = None
+        self.waiting = 0  # 已接收、还没开始调用大模型
+        self.running = 0  # 进行中的大模型调用
+        self.max_waiting = 0
+        self.waits = deque(maxlen=WAIT_WINDOW)  # 最近消息的排队等待时间（秒）
+        self.counts = {"accepted": 0, "queued": 0, "rejected": 0, "llm_calls": 0}
+        self.flights = SingleFlight()
+
+    @property
+    def llm_concurrency(self) -> int:
+        return self.config.get("llm_concurrency", LLM_CONCURRENCY)
+
+    @property
+    def queue_limit(self) -> int:
+        return self.config.get("queue_limit", QUEUE_LIMIT)
+
+    def _start(self):
+        workers = self.config.get("retrieval_workers", RETRIEVAL_WORKERS)
+        self.retrieval_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="retrieval")
+        self.llm_pool = ThreadPoolExecutor(max_workers=self.llm_concurrency, thread_name_prefix="llm")
+        self.llm_slots = asyncio.Semaphore(self.llm_concurrency)
+        logger.info(f"消息调度: 检索 {workers} 线程，大模型并发 {self.llm_concurrency}，排队上限 {self.queue_limit}")
+
+    def _admit(self) -> int:
+        """接收一条消息，返回排队位置（0为不用等大模型线程）"""
+        if self.llm_pool is None:
+            self._start()
+        if self.waiting >= self.queue_limit:
+            self.counts["rejected"] += 1
+            raise QueueFull(f"排队已满（{self.waiting}条）")
+        position = self.waiting + 1 - (self.llm_concurrency - self.running)
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        self.counts["accepted"] += 1
+        if position > 0:
+            self.counts["queued"] += 1
+        return max(position, 0)
+
+    def _dequeue(self, admitted: float):
+        self.waiting -= 1
+        self.waits.append(time.perf_counter() - admitted)
+
+    async def submit(self, prepare, *args, on_queued=None):
+        """在检索线程池中执行 prepare(*args)；返回 PendingAnswer 时再占一个大模型名额执行它
+        （相同问题正在回答时不占名额，等它的结果）
+
+        队列已满时抛出 QueueFull；需要排队时先以排队位置调用 on_queued（在线程中执行，
+        出错只记日志）。返回最终回复。
+        """
+        position = self._admit()
+        admitted = time.perf_counter()
+        queued = True
+        loop = asyncio.get_running_loop()
+        try:
+            if position and on_queued is not None:
+                try:
+                    await loop.run_in_executor(None, on_queued, position)
+                except Exception as e:
+                    logger.warning(f"排队提示发送失败: {e}")
+            result = await loop.run_in_executor(self.retrieval_pool, prepare, *args)
+            if not isinstance(result, PendingAnswer):
+                return result
+            future, leader = self.flights.claim(result.key)
+            if not leader:
+                queued = False
+                self._dequeue(admitted)
+                return await asyncio.wrap_future(future)
+            try:
+                async with self.llm_slots:
+                    queued = False
+                    self._dequeue(admitted)
+                    self.running += 1
+                    self.counts["llm_calls"] += 1
+                    try:
+                        reply = await loop.run_in_executor(self.llm_pool, result.run)
+                    finally:
+                        self.running -= 1
+            except BaseException as e:
+                self.flights.settle(result.key, future, error=e)
+                raise
+            self.flights.settle(result.key, future, reply)
+            return reply
+        finally:
+            if queued:
+                self._dequeue(admitted)
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "running": self.running,
+            "llm_concurrency": self.llm_concurrency,
+            "queue_limit": self.queue_limit,
+            **wait_stats(self.waits),
+            **self.counts,
+            "coalesced": self.flights.stats()["coalesced"],
+        }
+
+    def summary(self) -> str:
+        """当前排队情况，用于日志"""
+        s = self.stats()
+        return (f"排队 {s['waiting']}/{s['queue_limit']}，大模型 {s['running']}/{s['llm_concurrency']}，"
+                f"等待 平均{s['wait_avg']:.1f}s P95 {s['wait_p95']:.1f}s，"
+                f"已拒绝 {s['rejected']}/{s['accepted'] + s['rejected']}，相同问题合并 {s['coalesced']}")
+
+
+class WorkerPool:
+    """固定数量的工作线程 + 有界队列（Webhook 模式）；配置在第一次提交时读取"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.queue = None
+        self.threads = []
+        self.closed = False
+        self.pending = 0  # 已接收、还没处理完（排队中 + 处理中）
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.waits = deque(maxlen=WAIT_WINDOW)
+        self.counts = {"accepted": 0, "rejected": 0, "completed": 0, "failed": 0, "expired": 0, "overdue": 0}
+
+    @property
+    def task_timeout(self) -> float:
+        return self.config.get("task_timeout", TASK_TIMEOUT)
+
+    def _start(self):
+        workers = self.config.get("worker_threads", WORKER_THREADS)
+        self.queue = queue.Queue(maxsize=self.config.get("queue_limit", QUEUE_LIMIT))
+        # 守护线程：进程退出时由 shutdown（atexit）等待已接收的任务，不依赖线程 join
+        self.threads = [
+            threading.Thread(target=self._work, name=f"worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+        atexit.register(self.shutdown)
+        logger.info(f"工作线程池: {workers} 线程，排队上限 {self.queue.maxsize}，任务时限 {self.task_timeout}s")
+
+    def submit(self, fn, *args, on_expired=None):
+        """排入任务 fn(*args)；队列已满或正在停止时抛出 QueueFull
+
+        排队超过 task_timeout 才轮到时不执行 fn，改为调用 on_expired()（如回复稍后再试）。
+        """
+        with self.lock:
+            if self.queue is None:
+                self._start()
+            if self.closed:
+                self.counts["rejected"] += 1
+                raise QueueFull("正在停止，不再接收新消息")
+            try:
+                self.queue.put_nowait((fn, args, on_expired, time.perf_counter()))
+            except queue.Full:
+                self.counts["rejected"] += 1
+                raise QueueFull(f"排队已满（{self.queue.maxsize}条）") from None
+            self.pending += 1
+            self.counts["accepted"] += 1
+
+    def _work(self):
+        while True:
+            fn, args, on_expired, accepted = self.queue.get()
+            started = time.perf_counter()
+            with self.lock:
+                self.waits.append(started - accepted)
+                self.busy += 1
+            outcome = "completed"
+            try:
+                if started - accepted > self.task_timeout:
+                    outcome = "expired"
+                    logger.warning(f"任务排队 {started - accepted:.1f}s 超过时限，不再处理")
+                    if on_expired is not None:
+                        on_expired()
+                else:
+                    fn(*args)
+                    elapsed = time.perf_counter() - accepted
+                    if elapsed > self.task_timeout:
+                        outcome = "overdue"
+                        logger.warning(f"任务耗时 {elapsed:.1f}s，超过时限 {self.task_timeout}s")
+            except Exception as e:
+                outcome = "failed"
+                logger.exception(f"任务执行失败: {e}")
+            finally:
+                with self.lock:
+                    self.counts[outcome] += 1
+                    self.busy -= 1
+                    self.pending -= 1
+                    self.idle.notify_all()
+
+    def shutdown(self, timeout: float | None = None) -> bool:
+        """停止接收新任务，等已接收的任务处理完（最多 timeout 秒，默认 task_timeout）；全部完成时返回 True"""
+        timeout = self.task_timeout if timeout is None else timeout
+        with self.lock:
+            self.closed = True
+            if self.pending:
+                logger.info(f"正在停止：等待 {self.pending} 个已接收的任务处理完（最多 {timeout}s）")
+            drained = self.idle.wait_for(lambda: self.pending == 0, timeout)
+            if not drained:
+                logger.warning(f"停止等待超时，仍有 {self.pending} 个任务未处理完")
+        return drained
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "workers": len(self.threads),
+                "busy": self.busy,
+                "queued": self.pending - self.busy,
+                "queue_limit": self.queue.maxsize if self.queue is not None else self.config.get("queue_limit", QUEUE_LIMIT),
+                "task_timeout": self.task_timeout,
+                **wait_stats(self.waits),
+                **self.counts,
+            }
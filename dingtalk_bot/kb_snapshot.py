@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+斯坦星球知识库 - 快照发布
+
+convert_kb.py 每次转换都写入一个新的快照目录，写完后生成带校验和的清单，再通过
+改名原子地切换 CURRENT 指针；机器人只读取 CURRENT 指向的快照，转换过程中启动或
+重新加载的机器人看到的永远是完整的旧版本或完整的新版本。
+
+    kb_snapshots/
+    ├── CURRENT                          # 当前版本号（先写临时文件再改名替换）
+    ├── 20260210-153000/                 # 一个快照
+    │   ├── SNAPSHOT.json                # 版本、文件清单（大小 + sha256）与总校验和
+    │   ├── knowledge_base/_总索引.json
+    │   ├── knowledge_base.pack
+    │   ├── knowledge_base.index
+    │   └── knowledge_base.vectors.*
+    └── .staging-20260211-090000/        # 正在写入（尚未发布）的快照
+
+快照内的文件名与知识库目录旁的旧布局一致，kb_store / kb_vectors 的路径函数直接可用。
+保留最近 N 个快照，回滚只是把 CURRENT 指回旧版本。已发布的快照不再改写，正被机器人
+mmap 的文件也就不会被替换（Windows 上替换已映射的文件会失败）。
+
+使用方法：
+python kb_snapshot.py                    # 列出快照
+python kb_snapshot.py verify [版本]      # 校验快照文件（默认当前版本）
+python kb_snapshot.py rollback [版本]    # 切换到指定版本（默认上一个版本，运行中的机器人自动加载）
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+from kb_store import mapped_files
+
+SNAPSHOT_DIR_NAME = "kb_snapshots"
+CURRENT_NAME = "CURRENT"
+MANIFEST_NAME = "SNAPSHOT.json"
+STAGING_PREFIX = ".staging-"
+KEEP_SNAPSHOTS = 3
+SNAPSHOT_FORMAT = 1
+
+
+def snapshot_root(kb_dir) -> Path:
+    return Path(kb_dir).parent / SNAPSHOT_DIR_NAME
+
+
+def snapshot_kb_dir(snapshot: Path, kb_dir) -> Path:
+    """快照中与知识库目录同名的目录（生成文件放在它旁边）"""
+    return snapshot / Path(kb_dir).name
+
+
+def list_snapshots(kb_dir) -> list[str]:
+    """已发布的快照版本，按时间升序"""
+    root = snapshot_root(kb_dir)
+    if not root.is_dir():
+        return []
+    return sorted(p.name for p in root.iterdir() if p.is_dir() and (p / MANIFEST_NAME).exists())
+
+
+def current_version(kb_dir) -> str | None:
+    try:
+        version = (snapshot_root(kb_dir) / CURRENT_NAME).read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+    if version and (snapshot_root(kb_dir) / version / MANIFEST_NAME).exists():
+        return version
+    return None
+
+
+def resolve_snapshot(kb_dir) -> tuple[Path, str | None]:
+    """机器人实际读取的知识库目录与版本号；还没有发布过快照时原样返回 (kb_dir, None)"""
+    version = current_version(kb_dir)
+    if version is None:
+        return Path(kb_dir), None
+    return snapshot_kb_dir(snapshot_root(kb_dir) / version, kb_dir), version
+
+
+# ============== 发布（转换知识库时） ==============
+
+def new_snapshot(kb_dir) -> tuple[str, Path]:
+    """创建暂存目录，返回 (版本号, 暂存快照中的知识库目录)"""
+    root = snapshot_root(kb_dir)
+    base = time.strftime("%Y%m%d-%H%M%S")
+    version = base
+    suffix = 0
+    while (root / version).exists() or (root / f"{STAGING_PREFIX}{version}").exists():
+        suffix += 1
+        version = f"{base}-{suffix}"
+    staging = root / f"{STAGING_PREFIX}{version}"
+    out_dir = snapshot_kb_dir(staging, kb_dir)
+    out_dir.mkdir(parents=True)
+    return version, out_dir
+
+
+def _file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _snapshot_files(snapshot: Path) -> dict[str, dict]:
+    return {
+        path.relative_to(snapshot).as_posix(): {"size": path.stat().st_size, "sha256": _file_digest(path)}
+        for path in sorted(snapshot.rglob("*"))
+        if path.is_file() and path.name != MANIFEST_NAME
+    }
+
+
+def _checksum(files: dict[str, dict]) -> str:
+    return hashlib.sha256(json.dumps(files, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _write_current(root: Path, version: str):
+    tmp_path = root / f"{CURRENT_NAME}.tmp"
+    tmp_path.write_text(version, encoding="utf-8")
+    os.replace(tmp_path, root / CURRENT_NAME)
+
+
+def publish(kb_dir, version: str, info: dict | None = None, keep: int = KEEP_SNAPSHOTS) -> Path:
+    """写清单与校验和，把暂存目录改名为正式快照，再原子切换 CURRENT；返回快照目录"""
+    root = snapshot_root(kb_dir)
+    staging = root / f"{STAGING_PREFIX}{version}"
+    files = _snapshot_files(staging)
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "version": version,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        **(info or {}),
+        "files": files,
+        "checksum": _checksum(files),
+    }
+    with open(staging / MANIFEST_NAME, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    snapshot = root / version
+    staging.rename(snapshot)
+    _write_current(root, version)
+    prune(kb_dir, keep)
+    return snapshot
+
+
+def prune(kb_dir, keep: int = KEEP_SNAPSHOTS) -> list[str]:
+    """只保留最近 keep 个快照（当前版本总是保留），并清理残留的暂存目录；返回删除的版本
+
+    本进程仍映射着其中预建索引文件的快照跳过（见 kb_store.mapped_files）；别的进程映射着的，
+    POSIX 上删除不影响已建立的映射，Windows 上删除失败，留到下次"""
+    root = snapshot_root(kb_dir)
+    current = current_version(kb_dir)
+    versions = list_snapshots(kb_dir)
+    in_use = {path.parent for path in mapped_files()}
+    stale = [v for v in versions[:max(0, len(versions) - keep)]
+             if v != current and (root / v).resolve() not in in_use]
+    stale += [p.name for p in root.iterdir() if p.is_dir() and p.name.startswith(STAGING_PREFIX)]
+    removed = []
+    for name in stale:
+        try:
+            shutil.rmtree(root / name)
+            removed.append(name)
+        except OSError:
+            pass  # 仍被运行中的机器人映射（Windows），下次再删
+    return removed
+
+
+# ============== 校验与回滚 ==============
+
+def verify(kb_dir, version: str) -> list[str]:
+    """逐个文件核对清单中的大小与 sha256，返回问题列表（为空表示完好）"""
+    snapshot = snapshot_root(kb_dir) / version
+    try:
+        with open(snapshot / MANIFEST_NAME, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        return [f"清单不可读: {e}"]
+    problems = []
+    if _checksum(manifest.get("files", {})) != manifest.get("checksum"):
+        problems.append("清单校验和不符")
+    actual = _snapshot_files(snapshot)
+    for name, expected in manifest.get("files", {}).items():
+        if name not in actual:
+            problems.append(f"缺少文件: {name}")
+        elif actual[name] != expected:
+            problems.append(f"文件已改动: {name}")
+    problems += [f"多出文件: {name}" for name in actual if name not in manifest.get("files", {})]
+    return problems
+
+
+def rollback(kb_dir, version: str | None = None) -> str:
+    """把 CURRENT 切到指定版本（默认当前版本的上一个），校验不通过时拒绝切换"""
+    versions = list_snapshots(kb_dir)
+    if version is None:
+        current = current_version(kb_dir)
+        older = [v for v in versions if current is None or v < current]
+        if not older:
+            raise ValueError("没有更早的快照可回滚")
+        version = older[-1]
+    if version not in versions:
+        raise ValueError(f"快照不存在: {version}")
+    problems = verify(kb_dir, version)
+    if problems:
+        raise ValueError(f"快照 {version} 校验失败: {'; '.join(problems)}")
+    _write_current(snapshot_root(kb_dir), version)
+    return version
+
+
+def main():
+    kb_dir = Path(__file__).parent / "knowledge_base"
+    action = sys.argv[1] if len(sys.argv) > 1 else "list"
+    version = sys.argv[2] if len(sys.argv) > 2 else None
+
+    if action == "verify":
+        version = version or current_version(kb_dir)
+        if version is None:
+            print("还没有发布过快照")
+            sys.exit(1)
+        problems = verify(kb_dir, version)
+        print(f"{version}: " + ("完好" if not problems else "\n  ".join(["有问题"] + problems)))
+        sys.exit(1 if problems else 0)
+    elif action == "rollback":
+        try:
+            print(f"已切换到 {rollback(kb_dir, version)}，机器人下次检查知识库版本时自动加载")
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+    else:
+        current = current_version(kb_dir)
+        for name in list_snapshots(kb_dir):
+            with open(snapshot_root(kb_dir) / name / MANIFEST_NAME, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            marker = "*" if name == current else " "
+            print(f"{marker} {name}  {manifest.get('documents', '?')} 个文档  {manifest.get('created', '')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,783 @@
+#!/usr/bin/env python3
+"""
+斯坦星球知识库 - 知识库读取与预建索引文件
+
+- load_documents：读取转换好的知识库（机器人与转换工具共用），优先读紧凑格式文件
+- save_pack / load_pack：知识库目录旁的 knowledge_base.pack 紧凑格式知识库文件
+- save_index / load_index：知识库目录旁的 knowledge_base.index 预建索引文件
+- patch_index：转换工具增量更新时，在旧索引基础上只为改动的文档切词
+
+紧凑格式文件由 convert_kb.py 生成，取代逐篇缩进排版的JSON（每篇正文在JSON中
+full_content、sections 各存一份）：正文只存一份并按块gzip压缩，section 记为正文中的
+(标题, 起, 止) 偏移。文件格式：
+
+    SKBPACK1 | 头部长度(u64) | CRC32(u32) | 头部JSON（文档目录、数据块表） | 数据块
+
+预建索引文件同样由 convert_kb.py 生成，包含文档正文、三个字段的倒排表、关键词位图、
+课程编号表、各段落的边界（所属文档、正文区间、标题路径）、近似重复段落的分组与
+MinHash 签名（见 kb_dedup）以及各段落交给大模型的精简文本；机器人启动时用 mmap 打开，倒排表直接引用映射的内存，不再切词。
+文件格式：
+
+    SKBIDX01 | 头部长度(u64) | CRC32(u32) | 头部JSON | 8字节对齐的二进制数据块
+
+两种文件的 CRC32 都覆盖头部与数据块；版本、字节序不符，校验失败，或知识库文件在
+预建索引生成之后被改动过，load_index 都会抛出 ValueError，调用方退回读取知识库文件。
+
+单独重建预建索引 / 把已有的JSON目录打包成紧凑格式文件：
+python kb_store.py [知识库目录]
+python kb_store.py [知识库目录] --pack
+"""
+
+import gc
+import gzip
+import json
+import logging
+import mmap
+import re
+import struct
+import sys
+import weakref
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import accumulate
+from pathlib import Path
+
+from kb_dedup import find_duplicates
+from kb_chunker import CHUNKER_VERSION, RENDER_VERSION, lean_text
+from kb_index import CHUNK_MAX_CHARS, FieldIndex, KnowledgeIndex, PostingList, split_chunks, tokenize
+from kb_keywords import DOC_TYPE_MASK, scan_keywords
+
+logger = logging.getLogger(__name__)
+
+PACK_MAGIC = b"SKBPACK1"
+PACK_VERSION = 1
+PACK_COMPRESSIONS = ("gzip", "none")
+PACK_BLOCK_BYTES = 1 << 20  # 正文按约1MB分块压缩
+SECTION_LINE_RE = re.compile(r"^## (.*)$", re.MULTILINE)
+
+INDEX_MAGIC = b"SKBIDX01"
+INDEX_VERSION = 4
+HEADER_STRUCT = struct.Struct("<QI")  # 头部JSON长度, CRC32
+FIELD_NAMES = ("title", "section_titles", "body")
+
+
+def build_content_from_sections(sections: list) -> str:
+    """将sections合并为可检索的正文内容"""
+    parts = []
+    for sec in sections or []:
+        if not isinstance(sec, dict):
+            continue
+        title = (sec.get("title") or "").strip()
+        content = (sec.get("content") or "").strip()
+        if not title and not content:
+            continue
+        if title:
+            parts.append(f"## {title}\n{content}".strip())
+        else:
+            parts.append(content)
+    return "\n\n".join([p for p in parts if p])
+
+
+def json_files(kb_dir) -> list[Path]:
+    """知识库文档JSON；下划线开头的是总索引、转换清单等元数据文件，不是文档"""
+    return sorted(f for f in Path(kb_dir).glob("*.json") if not f.name.startswith("_"))
+
+
+def load_documents(kb_dir) -> list[dict]:
+    """加载知识库文档：优先读取紧凑格式文件 knowledge_base.pack，没有时读取目录下的JSON"""
+    if pack_path(kb_dir).exists():
+        try:
+            return [doc for doc in load_pack(kb_dir) if doc["content"]]
+        except (OSError, ValueError) as e:
+            logger.warning(f"无法读取 {pack_path(kb_dir).name}，改为读取JSON: {e}")
+    return load_json_documents(kb_dir)
+
+
+def load_json_documents(kb_dir) -> list[dict]:
+    """加载知识库所有JSON文档（按文件名排序，保证文档ID稳定）"""
+    documents = []
+    for json_file in json_files(kb_dir):
+        try:
+            with open(json_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+
+            # entries列表格式
+            if "entries" in data:
+                for entry in data["entries"]:
+                    documents.append({
+                        "title": entry.get("title", ""),
+                        "source": json_file.name,
+                        "file": json_file.name,
+                        "content": entry.get("content", {}).get("raw", ""),
+                    })
+            # md转换的JSON格式（full_content或sections）
+            elif "title" in data:
+                content = (data.get("full_content") or build_content_from_sections(data.get("sections", []))
+                           or data.get("content", ""))
+                if content:
+                    documents.append({
+                        "title": data.get("title", ""),
+                        "source": data.get("source", json_file.name),
+                        "file": json_file.name,  # 文件名带有 来源_级别_模块 分面信息
+                        "content": content,
+                    })
+        except Exception as e:
+            logger.warning(f"无法加载 {json_file.name}: {e}")
+    return documents
+
+
+def source_fingerprint(kb_dir) -> str:
+    """知识库文件的指纹，用于判断预建索引是否过期：紧凑格式文件直接取其头部CRC，
+    JSON目录则对文件名+内容计算CRC"""
+    path = pack_path(kb_dir)
+    if path.exists():
+        with open(path, "rb") as f:
+            prefix = f.read(len(PACK_MAGIC) + HEADER_STRUCT.size)
+        if prefix[:len(PACK_MAGIC)] == PACK_MAGIC and len(prefix) == len(PACK_MAGIC) + HEADER_STRUCT.size:
+            _, crc = HEADER_STRUCT.unpack(prefix[len(PACK_MAGIC):])
+            return f"pack:{crc:08x}"
+    crc = 0
+    for json_file in json_files(kb_dir):
+        crc = zlib.crc32(json_file.name.encode("utf-8"), crc)
+        crc = zlib.crc32(json_file.read_bytes(), crc)
+    return f"{crc:08x}"
+
+
+def index_path(kb_dir) -> Path:
+    kb_dir = Path(kb_dir)
+    return kb_dir.parent / f"{kb_dir.name}.index"
+
+
+def pack_path(kb_dir) -> Path:
+    kb_dir = Path(kb_dir)
+    return kb_dir.parent / f"{kb_dir.name}.pack"
+
+
+def has_source(kb_dir) -> bool:
+    """知识库目录或紧凑格式文件是否存在"""
+    return pack_path(kb_dir).exists() or Path(kb_dir).is_dir()
+
+
+# ============== 紧凑格式知识库文件 ==============
+
+def section_spans(content: str) -> list[tuple[str, int, int]]:
+    """## 标题及其正文在 content 中的区间（去掉首尾空白，空标题的section不记录）"""
+    spans = []
+    matches = list(SECTION_LINE_RE.finditer(content))
+    for i, m in enumerate(matches):
+        title = m.group(1).strip()
+        if not title:
+            continue
+        start = min(m.end() + 1, len(content))
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(content)
+        while start < end and content[start].isspace():
+            start += 1
+        while end > start and content[end - 1].isspace():
+            end -= 1
+        spans.append((title, start, end))
+    return spans
+
+
+def save_pack(documents: list, kb_dir, compression: str = "gzip") -> Path:
+    """把文档写成紧凑格式文件：每篇正文只存一份，section 以 (标题, 起, 止) 偏移记录；
+    正文按块压缩（gzip 或 none）。先写临时文件再改名。"""
+    if compression not in PACK_COMPRESSIONS:
+        raise ValueError(f"不支持的压缩方式: {compression}")
+
+    metas = []
+    blocks = []
+    block = []
+    block_size = 0
+    for doc in documents:
+        content = doc.get("content", "")
+        metas.append({
+            "title": doc.get("title", ""),
+            "source": doc.get("source", ""),
+            "file": doc.get("file", ""),
+            "length": len(content),
+            "sections": doc.get("sections") or section_spans(content),
+        })
+        raw = content.encode("utf-8")
+        block.append(raw)
+        block_size += len(raw)
+        if block_size >= PACK_BLOCK_BYTES:
+            blocks.append(b"".join(block))
+            block, block_size = [], 0
+    if block:
+        blocks.append(b"".join(block))
+
+    payload = bytearray()
+    layout = []
+    for raw in blocks:
+        stored = gzip.compress(raw, mtime=0) if compression == "gzip" else raw
+        layout.append([len(payload), len(stored), len(raw)])
+        payload += stored
+
+    header = json.dumps({
+        "version": PACK_VERSION,
+        "compression": compression,
+        "documents": metas,
+        "blocks": layout,
+    }, ensure_ascii=False).encode("utf-8")
+
+    crc = zlib.crc32(payload, zlib.crc32(header))
+    path = pack_path(kb_dir)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(PACK_MAGIC)
+        f.write(HEADER_STRUCT.pack(len(header), crc))
+        f.write(header)
+        f.write(payload)
+    tmp_path.replace(path)
+    return path
+
+
+def load_pack(kb_dir, sections: bool = False) -> list[dict]:
+    """读取紧凑格式文件中的全部文档；sections=True 时附带 section 偏移（机器人检索用不到，默认不带）。
+    文件缺失抛出 OSError，格式或校验不符抛出 ValueError"""
+    path = pack_path(kb_dir)
+    data = path.read_bytes()
+    prefix = len(PACK_MAGIC) + HEADER_STRUCT.size
+    if len(data) < prefix or data[:len(PACK_MAGIC)] != PACK_MAGIC:
+        raise ValueError(f"{path.name} 不是知识库文件")
+    header_len, crc = HEADER_STRUCT.unpack(data[len(PACK_MAGIC):prefix])
+    view = memoryview(data)
+    if zlib.crc32(view[prefix:]) != crc:
+        raise ValueError(f"{path.name} 校验失败（文件不完整或已损坏）")
+    header = json.loads(bytes(view[prefix:prefix + header_len]))
+    if header.get("version") != PACK_VERSION or header.get("compression") not in PACK_COMPRESSIONS:
+        raise ValueError(f"{path.name} 版本或压缩方式与当前程序不一致")
+
+    payload = prefix + header_len
+    parts = []
+    for offset, size, raw_size in header["blocks"]:
+        stored = view[payload + offset:payload + offset + size]
+        raw = gzip.decompress(stored) if header["compression"] == "gzip" else bytes(stored)
+        if len(raw) != raw_size:
+            raise ValueError(f"{path.name} 数据块长度不符")
+        parts.append(raw)
+    text = b"".join(parts).decode("utf-8")
+
+    documents = []
+    pos = 0
+    for meta in header["documents"]:
+        content = text[pos:pos + meta["length"]]
+        pos += meta["length"]
+        doc = {"title": meta["title"], "source": meta["source"], "file": meta["file"], "content": content}
+        if sections:
+            doc["sections"] = [tuple(span) for span in meta["sections"]]
+        documents.append(doc)
+    if pos != len(text):
+        raise ValueError(f"{path.name} 正文长度与目录不符")
+    return documents
+
+
+# ============== 生成（转换知识库时） ==============
+
+def _field_blobs(field: FieldIndex) -> tuple[list[str], dict[str, array]]:
+    """字段倒排表拼接为全局数组：各键的文档区间、各文档的位置区间与位置"""
+    keys = list(field.postings)
+    key_starts = array("I", [0])
+    doc_ids = array("I")
+    entry_offsets = array("I")
+    positions = array("I")
+    for key in keys:
+        posting = field.postings[key]
+        # 增量更新沿用的倒排表仍引用上一版本文件中的全局位置数组，按它的区间取出
+        offsets = posting.offsets
+        first = offsets[0]
+        shift = len(positions) - first
+        doc_ids.extend(posting.doc_ids)
+        entry_offsets.extend(map(shift.__add__, offsets[:-1]))
+        positions.extend(posting.positions[first:offsets[-1]])
+        key_starts.append(len(doc_ids))
+    entry_offsets.append(len(positions))
+    return keys, {
+        "key_starts": key_starts,
+        "doc_ids": doc_ids,
+        "entry_offsets": entry_offsets,
+        "positions": positions,
+        "lengths": array("I", field.lengths),
+    }
+
+
+def save_index(index: KnowledgeIndex, kb_dir) -> Path:
+    """把已建好的索引写成预建索引文件（先写临时文件再改名，不会留下半个文件）"""
+    contents = [doc.get("content", "") for doc in index.documents]
+    content_offsets = array("Q", [0])
+    for content in contents:
+        content_offsets.append(content_offsets[-1] + len(content))
+
+    blobs = {
+        "content": "".join(contents).encode("utf-8"),
+        "content_offsets": content_offsets,
+        "chunk_masks": array("Q", index.chunk_masks),
+        "doc_masks": array("Q", index.doc_masks),
+        "lean": "".join(index.lean).encode("utf-8"),
+        "lean_offsets": array("Q", accumulate(map(len, index.lean), initial=0)),
+        # 段落边界：加载时按边界切出段落，不再重新切分
+        "chunk_docs": array("I", (chunk["doc_id"] for chunk in index.chunks)),
+        "chunk_starts": array("I", (chunk["start"] for chunk in index.chunks)),
+        "chunk_ends": array("I", (chunk["end"] for chunk in index.chunks)),
+        "sections": "".join(chunk["section"] for chunk in index.chunks).encode("utf-8"),
+        "section_offsets": array("Q", accumulate((len(chunk["section"]) for chunk in index.chunks), initial=0)),
+        # 没有做过去重时每个段落自成一组
+        "canonical": array("I", index.canonical if index.canonical is not None else range(len(index.chunks))),
+    }
+    if index.signatures is not None:
+        blobs["signatures"] = array("I", index.signatures)
+    fields = {}
+    for name in FIELD_NAMES:
+        keys, arrays = _field_blobs(getattr(index, name))
+        fields[name] = keys
+        blobs.update({f"{name}.{part}": data for part, data in arrays.items()})
+
+    payload = bytearray()
+    layout = {}
+    for name, data in blobs.items():
+        raw = data.tobytes() if isinstance(data, array) else data
+        layout[name] = [len(payload), len(raw), data.typecode if isinstance(data, array) else "B"]
+        payload += raw
+        payload += b"\0" * (-len(payload) % 8)
+
+    header = json.dumps({
+        "version": INDEX_VERSION,
+        "byteorder": sys.byteorder,
+        "itemsizes": {typecode: array(typecode).itemsize for typecode in "IQ"},
+        "chunk_max_chars": CHUNK_MAX_CHARS,
+        "chunker": CHUNKER_VERSION,
+        "render": RENDER_VERSION,
+        "source_fingerprint": source_fingerprint(kb_dir),
+        "chunk_count": len(index.chunks),
+        "documents": [
+            {key: value for key, value in doc.items() if key != "content"} for doc in index.documents
+        ],
+        "fields": fields,
+        "course_table": index.course_table,
+        "blobs": layout,
+    }, ensure_ascii=False).encode("utf-8")
+    header += b" " * (-(len(INDEX_MAGIC) + HEADER_STRUCT.size + len(header)) % 8)
+
+    crc = zlib.crc32(payload, zlib.crc32(header))
+    path = index_path(kb_dir)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(INDEX_MAGIC)
+        f.write(HEADER_STRUCT.pack(len(header), crc))
+        f.write(header)
+        f.write(payload)
+    tmp_path.replace(path)
+    return path
+
+
+# ============== 并行构建（全量转换时） ==============
+
+INDEX_SHARDS_PER_WORKER = 2  # 每个进程分到的文档分片数，分片按正文长度均分
+
+
+def _index_shard(documents: list) -> dict:
+    """子进程：为一段连续的文档建索引，返回可序列化的数组（文档/块ID均从0起）"""
+    index = KnowledgeIndex(documents)
+    return {
+        "chunk_count": len(index.chunks),
+        "fields": {name: _field_blobs(getattr(index, name)) for name in FIELD_NAMES},
+        "chunk_masks": index.chunk_masks,
+        "doc_masks": index.doc_masks,
+        "course_table": dict(index.course_table),
+        "lean": index.lean,
+        "chunk_bounds": _chunk_bounds(index.chunks),
+    }
+
+
+def _chunk_bounds(chunks, doc_delta: int = 0) -> list[tuple]:
+    return [(chunk["doc_id"] + doc_delta, chunk["start"], chunk["end"], chunk["section"]) for chunk in chunks]
+
+
+def _split_shards(documents: list, count: int) -> list[list]:
+    total = sum(len(doc.get("content", "")) for doc in documents) or 1
+    shards = [[] for _ in range(count)]
+    done = 0
+    for doc in documents:
+        shards[min(count - 1, done * count // total)].append(doc)
+        done += len(doc.get("content", ""))
+    return [shard for shard in shards if shard]
+
+
+def build_index(documents: list, executor=None, workers: int = 1) -> KnowledgeIndex:
+    """建索引；给出进程池时按文档分片并行切词，再按分片顺序合并。
+
+    合并后的倒排表、词项顺序（首次出现的顺序）与课程编号表都与串行构建完全一致，
+    写出的预建索引文件逐字节相同。"""
+    if executor is None or workers <= 1 or len(documents) < 2:
+        return KnowledgeIndex(documents)
+
+    shards = _split_shards(documents, workers * INDEX_SHARDS_PER_WORKER)
+    merged = {name: defaultdict(list) for name in FIELD_NAMES}  # 词项 -> [(块ID基数, 分片数组, 分片内下标)]
+    lengths = {name: array("I") for name in FIELD_NAMES}
+    chunk_masks = array("Q")
+    doc_masks = array("Q")
+    course_table = defaultdict(list)
+    lean = []
+    chunk_bounds = []
+    chunk_base = doc_base = 0
+    for shard, part in zip(shards, executor.map(_index_shard, shards)):
+        for name in FIELD_NAMES:
+            keys, arrays = part["fields"][name]
+            for i, key in enumerate(keys):
+                merged[name][key].append((chunk_base, arrays, i))
+            lengths[name].extend(arrays["lengths"])
+        chunk_masks.extend(part["chunk_masks"])
+        doc_masks.extend(part["doc_masks"])
+        for key, entries in part["course_table"].items():
+            course_table[key].extend((doc_id + doc_base, *rest) for doc_id, *rest in entries)
+        lean.extend(part["lean"])
+        chunk_bounds.extend((doc_id + doc_base, *rest) for doc_id, *rest in part["chunk_bounds"])
+        chunk_base += part["chunk_count"]
+        doc_base += len(shard)
+
+    fields = {}
+    for name in FIELD_NAMES:
+        postings = {}
+        for key, pieces in merged[name].items():
+            posting = PostingList([])
+            for base, arrays, i in pieces:
+                start, end = arrays["key_starts"][i], arrays["key_starts"][i + 1]
+                offsets = arrays["entry_offsets"]
+                first = offsets[start]
+                shift = len(posting.positions) - first
+                posting.doc_ids.extend(map(base.__add__, arrays["doc_ids"][start:end]))
+                posting.offsets.extend(map(shift.__add__, offsets[start + 1:end + 1]))
+                posting.positions.extend(arrays["positions"][first:offsets[end]])
+            postings[key] = posting
+        fields[name] = FieldIndex.restore(postings, lengths[name])
+
+    return KnowledgeIndex(documents, prebuilt={
+        "fields": fields,
+        "chunk_masks": chunk_masks,
+        "doc_masks": doc_masks,
+        "course_table": course_table,
+        "lean": lean,
+        "chunk_bounds": chunk_bounds,
+    })
+
+
+# ============== 增量更新（转换工具只改动了部分文档时） ==============
+
+def _field_text(chunk: dict, name: str) -> str:
+    """段落在某个字段中切词用的文本（与 KnowledgeIndex 建索引时一致）"""
+    return {"title": chunk["title"], "section_titles": chunk["section"], "body": chunk["content"]}[name].lower()
+
+
+def _copy_ids(values, delta: int = 0) -> array:
+    ids = array("I")
+    if delta:
+        ids.extend(map(delta.__add__, values))
+    else:
+        ids.frombytes(memoryview(values).cast("B"))
+    return ids
+
+
+def _patch_field(old: FieldIndex, segments: list, new_of_old: array, fresh: dict, stale: set,
+                 lengths: array) -> FieldIndex:
+    """只重建改动段落（旧的与新的）含有的词项：复用旧倒排表中未改动段落的条目（按区间整段切片、
+    平移块ID），与新切词的条目按块ID合并；其余词项原样沿用旧倒排表，块ID有平移时只换块ID数组
+
+    new_of_old 为 旧块ID -> 新块ID，stale 为已删除/改动的旧段落中出现过的词项"""
+    shift_from = next((lo for lo, _, delta in segments if delta), None)  # 从这个旧块ID起块ID有平移
+    shifted = None
+    if shift_from is not None and old.id_blob is not None:
+        # 整个字段的块ID一次换算，沿用的倒排表各取其中一段（不必逐个词项换算）
+        shifted = memoryview(array("I", map(new_of_old.__getitem__, old.id_blob)))
+    touched = stale.union(fresh)
+    postings = {}
+    start = 0  # 当前词项在 id_blob 中的起点
+    for key, posting in old.postings.items():
+        end = start + len(posting.doc_ids)
+        if key in touched:
+            posting = _merge_posting(posting, segments, fresh.get(key, ()))
+            if posting is not None:
+                postings[key] = posting
+        elif shift_from is None or posting.doc_ids[-1] < shift_from:
+            postings[key] = posting
+        elif shifted is not None:
+            postings[key] = PostingList.from_arrays(shifted[start:end], posting.offsets, posting.positions)
+        else:
+            i = bisect_left(posting.doc_ids, shift_from)
+            doc_ids = _copy_ids(posting.doc_ids[:i])
+            doc_ids.extend(map(new_of_old.__getitem__, posting.doc_ids[i:]))
+            postings[key] = PostingList.from_arrays(doc_ids, posting.offsets, posting.positions)
+        start = end
+    added = [key for key in fresh if key not in old.postings]
+    for key in added:
+        postings[key] = _merge_posting(None, segments, fresh[key])
+    dropped = {key for key in stale if key in old.postings and key not in postings}
+    return old.derive(postings, lengths, dropped, added)
+
+
+def _merge_posting(posting: PostingList | None, segments: list, entries) -> PostingList | None:
+    """旧倒排表中未改动段落的条目 + 新切词的 (块ID, 位置) 条目，按块ID合并；都没有时返回 None"""
+    pieces = []  # (新块ID起点, 块ID数组, 该段内的位置区间, 位置数组)
+    if posting is not None:
+        for lo, hi, delta in segments:
+            i = bisect_left(posting.doc_ids, lo)
+            j = bisect_left(posting.doc_ids, hi, i)
+            if i < j:
+                offsets = posting.offsets
+                first = offsets[i]
+                pieces.append((lo + delta, _copy_ids(posting.doc_ids[i:j], delta),
+                               [offset - first for offset in offsets[i + 1:j + 1]],
+                               posting.positions[first:offsets[j]]))
+    for chunk_id, positions in entries:
+        pieces.append((chunk_id, array("I", [chunk_id]), [len(positions)], positions))
+    if not pieces:
+        return None  # 只出现在已删除段落中的词项
+
+    pieces.sort(key=lambda piece: piece[0])
+    merged = PostingList([])
+    for _, doc_ids, ends, positions in pieces:
+        base = len(merged.positions)
+        merged.doc_ids.extend(doc_ids)
+        merged.offsets.extend(base + end for end in ends)
+        if isinstance(positions, list):
+            merged.positions.extend(positions)
+        else:
+            merged.positions.frombytes(memoryview(positions).cast("B"))
+    return merged
+
+
+def patch_index(old: KnowledgeIndex, documents: list) -> tuple[KnowledgeIndex, int]:
+    """以旧索引为基础为新文档列表建索引：内容未变的文档直接复用倒排表、位图与课程编号，
+    只对新增/改动的文档切词。结果与 KnowledgeIndex(documents) 等价，返回 (索引, 重新切词的文档数)"""
+    def doc_key(doc):
+        return doc.get("file"), doc.get("title"), doc.get("source"), doc.get("content")
+
+    old_ids = {}
+    for doc_id, doc in enumerate(old.documents):
+        old_ids.setdefault(doc_key(doc), doc_id)
+
+    # 新文档 -> 旧文档ID（-1 为新增/改动），以及新旧块ID的对应
+    doc_map = []
+    chunk_count = 0
+    new_chunks = []  # 需要切词的 (新块ID, 块)
+    chunk_source = []  # 新块ID -> 旧块ID（-1 为新切词）
+    chunk_bounds = []
+    for doc_id, doc in enumerate(documents):
+        old_id = old_ids.pop(doc_key(doc), -1)
+        doc_map.append(old_id)
+        if old_id >= 0:
+            chunks = [old.chunks[chunk_id] for chunk_id in old.doc_chunks[old_id]]
+            chunk_source.extend(old.doc_chunks[old_id])
+            chunk_count += len(chunks)
+            chunk_bounds.extend(_chunk_bounds(chunks, doc_id - old_id))
+        else:
+            chunks = split_chunks(doc_id, doc)
+            for chunk in chunks:
+                new_chunks.append((chunk_count, chunk))
+                chunk_source.append(-1)
+                chunk_count += 1
+            chunk_bounds.extend(_chunk_bounds(chunks))
+
+    # 复用的块按连续区间分段：旧块ID [lo, hi) 整体平移 delta
+    segments = []
+    new_of_old = array("I", bytes(4 * len(old.chunks)))  # 删除/改动的旧块不会被查到
+    for new_id, old_id in enumerate(chunk_source):
+        if old_id < 0:
+            continue
+        new_of_old[old_id] = new_id
+        if segments and segments[-1][1] == old_id and segments[-1][1] + segments[-1][2] == new_id:
+            segments[-1][1] += 1
+        else:
+            segments.append([old_id, old_id + 1, new_id - old_id])
+    # 已删除/改动的旧文档的段落：它们含有的词项要重建倒排表
+    reused = set(doc_map)
+    stale_chunks = [
+        old.chunks[chunk_id] for old_id in range(len(old.documents)) if old_id not in reused
+        for chunk_id in old.doc_chunks[old_id]
+    ]
+
+    fields = {}
+    fresh_masks = {}
+    for name in FIELD_NAMES:
+        fresh = defaultdict(list)
+        fresh_lengths = {}
+        for chunk_id, chunk in new_chunks:
+            length = 0
+            for key, positions in tokenize(_field_text(chunk, name)).items():
+                fresh[key].append((chunk_id, positions))
+                length += len(positions)
+            fresh_lengths[chunk_id] = length
+        stale = set()
+        for chunk in stale_chunks:
+            stale.update(tokenize(_field_text(chunk, name)))
+        old_field = getattr(old, name)
+        lengths = array("I", (
+            old_field.lengths[old_id] if old_id >= 0 else fresh_lengths[chunk_id]
+            for chunk_id, old_id in enumerate(chunk_source)
+        ))
+        fields[name] = _patch_field(old_field, segments, new_of_old, fresh, stale, lengths)
+    fresh_lean = {}
+    for chunk_id, chunk in new_chunks:
+        fresh_masks[chunk_id] = scan_keywords(f"{chunk['title'].lower()}\n{chunk['content'].lower()}")
+        fresh_lean[chunk_id] = lean_text(chunk["content"])
+
+    chunk_masks = array("Q", (
+        old.chunk_masks[old_id] if old_id >= 0 else fresh_masks[chunk_id]
+        for chunk_id, old_id in enumerate(chunk_source)
+    ))
+    doc_masks = array("Q", (
+        old.doc_masks[old_id] if old_id >= 0
+        else scan_keywords(f"{doc.get('title', '')}\n{doc.get('source', '')}".lower()) & DOC_TYPE_MASK
+        for doc, old_id in zip(documents, doc_map)
+    ))
+
+    # 课程编号表：旧条目换成新文档ID，新增/改动的文档重新扫描
+    new_of_old = {old_id: doc_id for doc_id, old_id in enumerate(doc_map) if old_id >= 0}
+    course_table = defaultdict(list)
+    for key, entries in old.course_table.items():
+        for old_id, *rest in entries:
+            if old_id in new_of_old:
+                course_table[key].append((new_of_old[old_id], *rest))
+
+    index = KnowledgeIndex(documents, prebuilt={
+        "fields": fields,
+        "chunk_masks": chunk_masks,
+        "doc_masks": doc_masks,
+        "course_table": course_table,
+        "lean": [old.lean[old_id] if old_id >= 0 else fresh_lean[chunk_id] for chunk_id, old_id in enumerate(chunk_source)],
+        "chunk_bounds": chunk_bounds,
+    })
+    retokenized = [doc_id for doc_id, old_id in enumerate(doc_map) if old_id < 0]
+    for doc_id in retokenized:
+        index._add_course_ids(doc_id, documents[doc_id])
+    for entries in course_table.values():
+        entries.sort(key=lambda entry: entry[0])
+    return index, len(retokenized)
+
+
+# ============== 加载（机器人启动时） ==============
+
+# 已加载、映射还没关闭的预建索引（弱引用，索引回收后自动移除），见 mapped_files
+_MAPPED_INDEXES = weakref.WeakKeyDictionary()
+
+
+def mapped_files() -> set[Path]:
+    """本进程中仍以 mmap 打开的预建索引文件（快照清理时跳过它们所在的快照）"""
+    return {path for index, path in list(_MAPPED_INDEXES.items()) if index.mapped is not None}
+
+
+def _read_index_header(mapped, path: Path, kb_dir, check_source: bool) -> tuple[dict, int]:
+    """校验文件头、CRC与版本，返回 (头部, 数据块起点)"""
+    prefix = len(INDEX_MAGIC) + HEADER_STRUCT.size
+    if len(mapped) < prefix or mapped[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+        raise ValueError(f"{path.name} 不是预建索引文件")
+    header_len, crc = HEADER_STRUCT.unpack(mapped[len(INDEX_MAGIC):prefix])
+    with memoryview(mapped) as view:
+        if zlib.crc32(view[prefix:]) != crc:
+            raise ValueError(f"{path.name} 校验失败（文件不完整或已损坏）")
+
+    header = json.loads(mapped[prefix:prefix + header_len])
+    expected = {
+        "version": INDEX_VERSION,
+        "byteorder": sys.byteorder,
+        "itemsizes": {typecode: array(typecode).itemsize for typecode in "IQ"},
+        "chunk_max_chars": CHUNK_MAX_CHARS,
+        "chunker": CHUNKER_VERSION,
+        "render": RENDER_VERSION,
+    }
+    if any(header.get(key) != value for key, value in expected.items()):
+        raise ValueError(f"{path.name} 版本或格式与当前程序不一致")
+    if check_source and has_source(kb_dir) and header["source_fingerprint"] != source_fingerprint(kb_dir):
+        raise ValueError(f"{path.name} 生成后知识库JSON已改动")
+    return header, prefix + header_len
+
+
+def load_index(kb_dir, check_source: bool = True) -> KnowledgeIndex:
+    """打开预建索引文件并恢复 KnowledgeIndex；文件缺失抛出 OSError，其余问题抛出 ValueError
+
+    倒排表直接引用映射的内存，映射挂在返回索引的 mapped 上，由换下索引的一方调用
+    index.close() 关闭（见 kb_engine）；恢复中途出错时先关闭映射再抛出"""
+    path = index_path(kb_dir)
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        header, payload = _read_index_header(mapped, path, kb_dir, check_source)
+        index = _restore_index(mapped, header, payload, path)
+    except Exception as e:  # 校验和通过但内容与头部不符：缺块、越界、编码错误等
+        error = str(e) if type(e) is ValueError else f"{path.name} 内容与头部不符: {type(e).__name__}: {e}"
+    else:
+        index.mapped = mapped
+        _MAPPED_INDEXES[index] = path.resolve()
+        return index
+    # 离开 except 后异常的回溯已释放；恢复到一半的索引可能有循环引用，回收后映射内存才没人引用
+    gc.collect()
+    mapped.close()
+    raise ValueError(error)
+
+
+def _restore_index(mapped: mmap.mmap, header: dict, payload: int, path: Path) -> KnowledgeIndex:
+    """按头部的块目录从映射内存恢复 KnowledgeIndex（倒排表、位图等直接引用映射内存）"""
+    view = memoryview(mapped)
+
+    def blob(name):
+        offset, size, typecode = header["blobs"][name]
+        return view[payload + offset:payload + offset + size].cast(typecode)
+
+    text = str(blob("content"), "utf-8")
+    content_offsets = blob("content_offsets")
+    documents = [
+        dict(meta, content=text[content_offsets[i]:content_offsets[i + 1]])
+        for i, meta in enumerate(header["documents"])
+    ]
+
+    lean = str(blob("lean"), "utf-8")
+    lean_offsets = blob("lean_offsets")
+    sections = str(blob("sections"), "utf-8")
+    section_offsets = blob("section_offsets")
+    chunk_bounds = zip(
+        blob("chunk_docs"), blob("chunk_starts"), blob("chunk_ends"),
+        (sections[section_offsets[i]:section_offsets[i + 1]] for i in range(len(section_offsets) - 1)),
+    )
+
+    fields = {}
+    for name in FIELD_NAMES:
+        key_starts = blob(f"{name}.key_starts")
+        doc_ids = blob(f"{name}.doc_ids")
+        entry_offsets = blob(f"{name}.entry_offsets")
+        positions = blob(f"{name}.positions")
+        postings = {}
+        for i, key in enumerate(header["fields"][name]):
+            start, end = key_starts[i], key_starts[i + 1]
+            postings[key] = PostingList.from_arrays(doc_ids[start:end], entry_offsets[start:end + 1], positions)
+        fields[name] = FieldIndex.restore(postings, blob(f"{name}.lengths"), doc_ids)
+
+    index = KnowledgeIndex(documents, prebuilt={
+        "fields": fields,
+        "chunk_masks": blob("chunk_masks"),
+        "doc_masks": blob("doc_masks"),
+        "course_table": header["course_table"],
+        "lean": [lean[lean_offsets[i]:lean_offsets[i + 1]] for i in range(len(lean_offsets) - 1)],
+        "canonical": blob("canonical"),
+        "signatures": blob("signatures") if "signatures" in header["blobs"] else None,
+        "chunk_bounds": chunk_bounds,
+    })
+    if len(index.chunks) != header["chunk_count"]:
+        raise ValueError(f"{path.name} 段落边界与段落数不一致")
+    return index
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    kb_dir = Path(args[0]) if args else Path(__file__).parent / "knowledge_base"
+    if "--pack" in sys.argv:
+        path = save_pack(load_json_documents(kb_dir), kb_dir)
+        print(f"已生成知识库文件: {path}（{path.stat().st_size // 1024} KB）")
+    index = KnowledgeIndex(load_documents(kb_dir))
+    index.canonical = find_duplicates([chunk["content"] for chunk in index.chunks])
+    path = save_index(index, kb_dir)
+    print(f"已生成预建索引: {path}（{path.stat().st_size // 1024} KB）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+斯坦星球知识库 - 本地稠密向量检索（可选，需要 numpy）
+
+关键词二字切分对换个说法的问题（家长、销售的口语化提问）召回很差，这里在
+转换知识库时为每个段落（与 kb_index.split_chunks 的分块一致）生成一个低维向量：
+- 特征：英文/数字词 + 中文单字、二字，哈希到固定维度，子线性TF × IDF
+- 降维：随机化截断SVD（LSA），只在转换时做一次
+- 存储：知识库目录旁的 knowledge_base.vectors.npy（段落矩阵，float32 或 int8）、
+  knowledge_base.vectors.proj.npy（查询投影矩阵）与 knowledge_base.vectors.json（元数据）
+- 查询：内存映射加载，一次矩阵-向量乘法 + argpartition 取 top-k，纯CPU几毫秒
+
+段落按 标题+内容 的哈希对应到矩阵行，知识库改动后未重新生成的段落只是没有向量，
+不会错位。convert_kb.py 增量转换时用 patch_vectors 只为新段落补向量，投影矩阵不变。
+
+使用方法：
+python kb_vectors.py [知识库目录] [--int8]
+"""
+
+import json
+import math
+import sys
+import zlib
+from collections import Counter
+from importlib.util import find_spec
+from pathlib import Path
+
+from kb_chunker import CHUNKER_VERSION
+from kb_index import CHUNK_MAX_CHARS, CJK_TERM_RE, LATIN_TERM_RE, KnowledgeIndex, split_chunks
+from kb_store import load_documents
+
+VECTORS_AVAILABLE = find_spec("numpy") is not None  # 向量检索是可选功能
+
+
+class _LazyNumpy:
+    """第一次用到 numpy 时才导入（约0.1秒）：只用关键词检索的机器人与只引用 chunk_key 的
+    kb_rank 不必为它付出启动时间"""
+
+    def __getattr__(self, name):
+        import numpy
+        globals()["np"] = numpy
+        return getattr(numpy, name)
+
+
+np = _LazyNumpy() if VECTORS_AVAILABLE else None
+
+VECTORS_VERSION = 1
+HASH_DIM = 1 << 14  # 哈希特征维度
+COMPONENTS = 128  # 降维后的向量维度
+OVERSAMPLE = 16  # 随机化SVD的过采样列数
+POWER_ITERATIONS = 1
+MIN_SIMILARITY = 0.05  # 低于该余弦相似度的段落不返回
+FEATURIZE_BATCH = 64  # 并行生成时每次发给子进程的段落数
+
+
+def vector_paths(kb_dir) -> tuple[Path, Path, Path]:
+    """向量文件放在知识库目录旁边：(段落矩阵, 投影矩阵, 元数据)"""
+    kb_dir = Path(kb_dir)
+    prefix = kb_dir.parent / f"{kb_dir.name}.vectors"
+    return Path(f"{prefix}.npy"), Path(f"{prefix}.proj.npy"), Path(f"{prefix}.json")
+
+
+def chunk_key(chunk: dict) -> str:
+    """段落的内容指纹，用于把索引中的段落对应到矩阵行"""
+    text = f"{chunk['title']}\0{chunk['content']}"
+    return f"{zlib.crc32(text.encode('utf-8')):08x}"
+
+
+def featurize(text: str) -> dict[int, float]:
+    """文本 -> 哈希特征 -> 子线性词频（1 + log tf）"""
+    text = text.lower()
+    counts = Counter(f"w:{token}" for token in LATIN_TERM_RE.findall(text))
+    for m in CJK_TERM_RE.finditer(text):
+        run = m.group()
+        counts.update(run)
+        counts.update(run[i:i + 2] for i in range(len(run) - 1))
+
+    features: dict[int, float] = {}
+    for gram, tf in counts.items():
+        col = zlib.crc32(gram.encode("utf-8")) % HASH_DIM
+        features[col] = features.get(col, 0.0) + 1 + math.log(tf)
+    return features
+
+
+# ============== 生成（转换知识库时） ==============
+
+def _sparse_rows(chunks: list[dict], executor=None):
+    """段落 -> 按行存放的稀疏 TF-IDF 矩阵（列号、取值，行L2归一化），同时返回 IDF
+
+    给出进程池时特征提取分发到子进程（结果按段落顺序取回，与串行一致）。"""
+    texts = [f"{chunk['title']}\n{chunk['content']}" for chunk in chunks]
+    if executor is None:
+        rows = [featurize(text) for text in texts]
+    else:
+        rows = list(executor.map(featurize, texts, chunksize=FEATURIZE_BATCH))
+    df = np.zeros(HASH_DIM, dtype=np.float64)
+    for features in rows:
+        df[list(features)] += 1
+    idf = np.log((1 + len(rows)) / (1 + df)) + 1
+
+    indices = []
+    data = []
+    for features in rows:
+        cols = np.fromiter(features, dtype=np.int64, count=len(features))
+        values = np.fromiter(features.values(), dtype=np.float64, count=len(features)) * idf[cols]
+        norm = np.linalg.norm(values)
+        indices.append(cols)
+        data.append(values / norm if norm else values)
+    return indices, data, idf
+
+
+def _matmul(indices, data, dense):
+    """稀疏矩阵 X(n × HASH_DIM) 乘稠密矩阵 (HASH_DIM × r)"""
+    out = np.zeros((len(indices), dense.shape[1]))
+    for i, (cols, values) in enumerate(zip(indices, data)):
+        out[i] = values @ dense[cols]
+    return out
+
+
+def _rmatmul(indices, data, dense):
+    """X^T(HASH_DIM × n) 乘稠密矩阵 (n × r)；每行内列号不重复，可直接按列累加"""
+    out = np.zeros((HASH_DIM, dense.shape[1]))
+    for i, (cols, values) in enumerate(zip(indices, data)):
+        out[cols] += np.outer(values, dense[i])
+    return out
+
+
+def build_vectors(documents: list, kb_dir, components: int = COMPONENTS, quantize: bool = False,
+                  executor=None) -> int:
+    """为全部段落生成向量文件，返回段落数；executor 为可选的进程池（见 _sparse_rows）"""
+    if np is None:
+        raise ImportError("向量检索需要 numpy：pip install numpy")
+
+    chunks = [chunk for doc_id, doc in enumerate(documents) for chunk in split_chunks(doc_id, doc)]
+    indices, data, idf = _sparse_rows(chunks, executor)
+    rank = min(components + OVERSAMPLE, len(chunks))
+
+    # 随机化截断SVD：X ≈ Q B，B 很小，对 B 做精确SVD
+    rng = np.random.default_rng(0)
+    sample = _matmul(indices, data, rng.standard_normal((HASH_DIM, rank)))
+    basis, _ = np.linalg.qr(sample)
+    for _ in range(POWER_ITERATIONS):
+        basis, _ = np.linalg.qr(_rmatmul(indices, data, basis))
+        basis, _ = np.linalg.qr(_matmul(indices, data, basis))
+    small = _rmatmul(indices, data, basis).T  # B = Q^T X
+    u, s, vt = np.linalg.svd(small, full_matrices=False)
+    components = min(components, len(s))
+
+    # 段落向量 X V = U S；查询向量 q V，IDF 折进投影矩阵
+    embeddings = (basis @ u[:, :components]) * s[:components]
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = np.divide(embeddings, norms, out=np.zeros_like(embeddings), where=norms > 0)
+    projection = (vt[:components].T * idf[:, None]).astype(np.float32)
+    if quantize:
+        matrix = np.round(embeddings * 127).astype(np.int8)
+    else:
+        matrix = embeddings.astype(np.float32)
+
+    matrix_path, projection_path, meta_path = vector_paths(kb_dir)
+    np.save(matrix_path, matrix)
+    np.save(projection_path, projection)
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "version": VECTORS_VERSION,
+            "hash_dim": HASH_DIM,
+            "components": components,
+            "chunk_max_chars": CHUNK_MAX_CHARS,
+            "chunker": CHUNKER_VERSION,
+            "dtype": str(matrix.dtype),
+            "keys": [chunk_key(chunk) for chunk in chunks],
+        }, f, ensure_ascii=False)
+    return len(chunks)
+
+
+def patch_vectors(documents: list, kb_dir, previous_dir=None) -> int | None:
+    """知识库部分改动后更新向量文件：内容未变的段落沿用原有行，新段落用现有投影矩阵嵌入
+    （与查询向量的算法相同，不重新做SVD）。旧向量从 previous_dir（默认即 kb_dir）读取，
+    结果写到 kb_dir。返回新嵌入的段落数；没有可用的旧向量时返回None"""
+    if np is None:
+        raise ImportError("向量检索需要 numpy：pip install numpy")
+    old_matrix_path, old_projection_path, old_meta_path = vector_paths(previous_dir or kb_dir)
+    try:
+        with open(old_meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if (meta.get("version"), meta.get("hash_dim"), meta.get("chunk_max_chars"), meta.get("chunker")) != (
+            VECTORS_VERSION, HASH_DIM, CHUNK_MAX_CHARS, CHUNKER_VERSION
+        ):
+            return None
+        old_matrix = np.load(old_matrix_path)
+        projection = np.load(old_projection_path)
+    except (OSError, ValueError):
+        return None
+    if old_matrix.shape[0] != len(meta["keys"]) or projection.shape != (HASH_DIM, old_matrix.shape[1]):
+        return None
+
+    rows_by_key: dict[str, list[int]] = {}
+    for row, key in enumerate(meta["keys"]):
+        rows_by_key.setdefault(key, []).append(row)
+
+    chunks = [chunk for doc_id, doc in enumerate(documents) for chunk in split_chunks(doc_id, doc)]
+    keys = [chunk_key(chunk) for chunk in chunks]
+    matrix = np.zeros((len(chunks), old_matrix.shape[1]), dtype=old_matrix.dtype)
+    embedded = 0
+    for i, (chunk, key) in enumerate(zip(chunks, keys)):
+        rows = rows_by_key.get(key)
+        if rows:
+            matrix[i] = old_matrix[rows.pop(0)]
+            continue
+        features = featurize(f"{chunk['title']}\n{chunk['content']}")
+        if features:
+            cols = np.fromiter(features, dtype=np.int64, count=len(features))
+            weights = np.fromiter(features.values(), dtype=np.float32, count=len(features))
+            vector = weights @ projection[cols]
+            norm = np.linalg.norm(vector)
+            if norm:
+                vector /= norm
+            matrix[i] = np.round(vector * 127) if matrix.dtype == np.int8 else vector
+        embedded += 1
+
+    matrix_path, projection_path, meta_path = vector_paths(kb_dir)
+    np.save(matrix_path, matrix)
+    if projection_path != old_projection_path:
+        np.save(projection_path, projection)
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(dict(meta, keys=keys), f, ensure_ascii=False)
+    return embedded
+
+
+# ============== 查询（机器人进程内） ==============
+
+class VectorIndex:
+    """内存映射的段落向量矩阵，行号对应到 KnowledgeIndex 的块ID"""
+
+    def __init__(self, index: KnowledgeIndex, matrix, projection, keys: list[str]):
+        self.index = index
+        self.matrix = matrix
+        self.projection = projection
+        self.scale = 127.0 if matrix.dtype == np.int8 else 1.0
+
+        rows_by_key: dict[str, list[int]] = {}
+        for row, key in enumerate(keys):
+            rows_by_key.setdefault(key, []).append(row)
+        self.row_chunk = np.full(len(keys), -1, dtype=np.int64)  # 矩阵行 -> 块ID，-1 表示该行已过期
+        for chunk_id, chunk in enumerate(index.chunks):
+            rows = rows_by_key.get(chunk_key(chunk))
+            if rows:
+                self.row_chunk[rows.pop(0)] = chunk_id
+        self.valid = self.row_chunk >= 0
+        self.coverage = int(self.valid.sum())
+
+    def embed(self, query: str):
+        features = featurize(query)
+        if not features:
+            return None
+        cols = np.fromiter(features, dtype=np.int64, count=len(features))
+        weights = np.fromiter(features.values(), dtype=np.float32, count=len(features))
+        vector = weights @ self.projection[cols]
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def search(self, query: str, chunk_ids=None, top_k: int = 50) -> list[tuple[int, float]]:
+        """返回相似度最高的 (块ID, 余弦相似度)，按相似度降序"""
+        vector = self.embed(query)
+        if vector is None:
+            return []
+        scores = (self.matrix @ vector) / self.scale
+
+        allowed = self.valid
+        if chunk_ids is not None:
+            chunk_mask = np.zeros(len(self.index.chunks), dtype=bool)
+            chunk_mask[np.fromiter(chunk_ids, dtype=np.int64, count=len(chunk_ids))] = True
+            allowed = allowed & chunk_mask[np.where(self.valid, self.row_chunk, 0)]
+        scores = np.where(allowed & (scores >= MIN_SIMILARITY), scores, -np.inf)
+
+        top_k = min(top_k, int(np.isfinite(scores).sum()))
+        if top_k <= 0:
+            return []
+        rows = np.argpartition(-scores, top_k - 1)[:top_k]
+        rows = rows[np.argsort(-scores[rows])]
+        return [(int(self.row_chunk[row]), float(scores[row])) for row in rows]
+
+
+def load_vectors(kb_dir, index: KnowledgeIndex) -> VectorIndex:
+    """加载向量文件（内存映射）；缺少 numpy、文件不存在或参数不一致时抛出异常"""
+    if np is None:
+        raise ImportError("未安装 numpy")
+    matrix_path, projection_path, meta_path = vector_paths(kb_dir)
+    if not meta_path.exists():
+        raise FileNotFoundError(f"向量文件不存在: {meta_path}，请运行 python kb_vectors.py 生成")
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if (meta.get("version"), meta.get("hash_dim"), meta.get("chunk_max_chars"), meta.get("chunker")) != (
+        VECTORS_VERSION, HASH_DIM, CHUNK_MAX_CHARS, CHUNKER_VERSION
+    ):
+        raise ValueError("向量文件与当前特征/分块参数不一致，请重新生成")
+
+    matrix = np.load(matrix_path, mmap_mode="r")
+    projection = np.load(projection_path, mmap_mode="r")
+    if matrix.shape[0] != len(meta["keys"]) or projection.shape != (HASH_DIM, matrix.shape[1]):
+        raise ValueError("向量文件不完整，请重新生成")
+    return VectorIndex(index, matrix, projection, meta["keys"])
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    kb_dir = Path(args[0]) if args else Path(__file__).parent / "knowledge_base"
+    count = build_vectors(load_documents(kb_dir), kb_dir, quantize="--int8" in sys.argv)
+    print(f"已生成 {count} 个段落的向量: {vector_paths(kb_dir)[0]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+本地大模型替身：OpenAI 兼容的 /chat/completions（普通与 SSE 流式），不联网调试机器人
+
+回答由问题与上下文中的段落标题拼成（带 **加粗**、列表等 Markdown，检验 clean_markdown），
+流式时每次发几个字、间隔 --delay 秒，模拟真实的逐字生成；HTTP/1.1 keep-alive，
+可同时观察连接复用（kb_http）。--keepalive 在事件之间插入 SSE 注释行（: keep-alive），
+--fail-after N 在发出 N 个事件后直接断开连接，模拟回答中途出错。
+
+使用方法：
+python llm_standin.py [--port 8765] [--delay 0.05] [--chunk 4] [--keepalive] [--fail-after N]
+
+然后在 config.json 中设置 "llm_base_url": "http://127.0.0.1:8765/v4"，"llm_api_key" 随意填写。
+"""
+
+import argparse
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TITLE_RE = re.compile(r"^### (.+)$", re.MULTILINE)
+QUESTION_RE = re.compile(r"【用户问题】\s*\n(.+?)\n", re.S)
+
+
+def compose_answer(messages: list) -> str:
+    """按请求内容拼出一个带 Markdown 的回答"""
+    prompt = messages[-1].get("content", "") if messages else ""
+    match = QUESTION_RE.search(prompt)
+    question = match.group(1).strip() if match else prompt[:50]
+    titles = TITLE_RE.findall(prompt)
+    lines = [f"**关于「{question}」**", "", "知识库中相关的内容有："]
+    lines += [f"- {title}" for title in titles] or ["- （没有检索到段落）"]
+    lines += ["", "以上是本地替身生成的回答，用于检查流式分段、卡片更新与连接复用。" * 3]
+    return "\n".join(lines)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    delay = 0.05
+    chunk = 4
+    keepalive = False
+    fail_after = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"未知路径 {self.path}"}})
+            return
+        text = compose_answer(body.get("messages", []))
+        if body.get("stream"):
+            self._stream(text, body.get("model", "standin"))
+        else:
+            self._send_json(200, {
+                "model": body.get("model", "standin"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            })
+
+    def _send_json(self, status: int, data: dict):
+        raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _write_chunk(self, raw: bytes):
+        self.wfile.write(f"{len(raw):x}\r\n".encode("ascii") + raw + b"\r\n")
+        self.wfile.flush()
+
+    def _stream(self, text: str, model: str):
+        """SSE：分块传输，每个事件一行 data: {...}，最后 data: [DONE]"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for n, i in enumerate(range(0, len(text), self.chunk)):
+            if n == self.fail_after:
+                self.close_connection = True  # 不发结束块直接断开
+                return
+            if self.keepalive:
+                self._write_chunk(b": keep-alive\n\n")
+            event = {"model": model, "choices": [{"index": 0, "delta": {"content": text[i:i + self.chunk]}}]}
+            self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+            time.sleep(self.delay)
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+
+def serve(port: int = 8765, delay: float = 0.05, chunk: int = 4, keepalive: bool = False,
+          fail_after: int | None = None) -> ThreadingHTTPServer:
+    """创建替身服务器（调用方负责 serve_forever / shutdown）；port 为0时随机分配端口"""
+    handler = type("Handler", (StandinHandler,), {
+        "delay": delay, "chunk": chunk, "keepalive": keepalive, "fail_after": fail_after,
+    })
+    return ThreadingHTTPServer(("127.0.0.1", port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地大模型替身（OpenAI 兼容，支持 SSE 流式）")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=0.05, help="流式时每个事件的间隔（秒）")
+    parser.add_argument("--chunk", type=int, default=4, help="流式时每个事件的字数")
+    parser.add_argument("--keepalive", action="store_true", help="流式时在事件之间插入 SSE 注释行")
+    parser.add_argument("--fail-after", type=int, default=None, help="流式时发出这么多个事件后断开连接")
+    args = parser.parse_args()
+    server = serve(args.port, args.delay, args.chunk, args.keepalive, args.fail_after)
+    print(f"大模型替身已启动: http://127.0.0.1:{server.server_port}/v4/chat/completions（Ctrl+C 停止）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+"""测试从 dingtalk_bot/ 目录导入机器人模块（与直接运行 bot.py 时相同的平铺布局）"""
+
+import sys
+from pathlib import Path
+
+BOT_DIR = Path(__file__).resolve().parent.parent
+KB_DIR = BOT_DIR / "knowledge_base"
+
+if str(BOT_DIR) not in sys.path:
+    sys.path.insert(0, str(BOT_DIR))
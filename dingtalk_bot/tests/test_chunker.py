@@ -0,0 +1,73 @@
+"""分块与精简文本（kb_chunker）"""
+
+from kb_chunker import CHUNK_MIN_CHARS, breadcrumb, iter_chunks, iter_lines, lean_text
+from kb_report import estimate_tokens
+
+
+def chunks(text: str, max_chars: int = 1600) -> list[tuple[str, tuple]]:
+    return [(text[start:end], path) for start, end, path in iter_chunks(iter_lines(text), max_chars)]
+
+
+def test_h1_and_h2_always_start_a_new_chunk():
+    text = "# 课程\n介绍\n## 第一课\n内容一\n### 小节\n细节\n## 第二课\n内容二\n"
+    assert chunks(text) == [
+        ("# 课程\n介绍\n", ((1, "课程"),)),
+        ("## 第一课\n内容一\n### 小节\n细节\n", ((1, "课程"), (2, "第一课"))),  # 短的 H3 小节并入
+        ("## 第二课\n内容二\n", ((1, "课程"), (2, "第二课"))),
+    ]
+
+
+def test_h3_starts_a_new_chunk_once_current_one_is_long_enough():
+    long_section = "## 长节\n" + "甲" * CHUNK_MIN_CHARS + "\n"
+    text = long_section + "### 小节一\n乙\n### 小节二\n丙\n"
+    assert chunks(text) == [
+        (long_section, ((2, "长节"),)),
+        ("### 小节一\n乙\n### 小节二\n丙\n", ((2, "长节"),)),  # 跨两个小节，取共同的上级
+    ]
+
+
+def test_hash_lines_inside_code_fence_are_not_headings():
+    code = "## 代码\n```python\n# 注释不是标题\nprint(1)\n```\n"
+    assert chunks(code + "## 下一节\n正文\n") == [(code, ((2, "代码"),)), ("## 下一节\n正文\n", ((2, "下一节"),))]
+
+
+def test_table_is_kept_whole_and_split_only_at_row_boundaries():
+    rows = [f"| {i} | 第{i}行 |\n" for i in range(6)]
+    text = "## 表\n前言\n" + "".join(rows) + "后记\n"
+    pieces = [piece for piece, _ in chunks(text, max_chars=70)]
+    assert pieces == ["## 表\n前言\n", "".join(rows[:5]), rows[5] + "后记\n"]
+
+
+def test_long_code_block_is_split_at_line_boundaries():
+    lines = [f"x{i} = {i}\n" for i in range(12)]
+    text = "```\n" + "".join(lines) + "```\n"
+    pieces = [piece for piece, _ in chunks(text, max_chars=40)]
+    assert "".join(pieces) == text
+    assert all(len(piece) <= 40 and piece.endswith("\n") for piece in pieces)
+
+
+def test_breadcrumb_omits_h1_repeating_document_title():
+    path = ((1, "课程"), (2, "第一课"), (3, "小节"))
+    assert breadcrumb(path, "课程") == "第一课 > 小节"
+    assert breadcrumb(path, "别的标题") == "课程 > 第一课 > 小节"
+
+WIDE_TABLE = """| 课时 | 主题 | 教具 | 目标 |
+|---|---|---|:---:|
+| 1 | **齿轮**传动 | 乐高 | 认识齿轮 |
+| 2 | 杠杆 |  | 找到支点 |"""
+
+
+def test_wide_table_lists_header_once():
+    assert lean_text(WIDE_TABLE) == "课时 / 主题 / 教具 / 目标\n1 / 齿轮传动 / 乐高 / 认识齿轮\n2 / 杠杆 / - / 找到支点"
+
+
+def test_two_column_table_becomes_key_value_lines():
+    assert lean_text("| 项目 | 说明 |\n|---|---|\n| 时长 | 90分钟 |\n| 人数 | 6人 |") == "时长：90分钟\n人数：6人"
+
+
+def test_lean_text_saves_tokens_on_tables():
+    rows = "\n".join(f"| {i} | 第{i}课的主题 | 教具{i} | 目标{i} |" for i in range(20))
+    table = "| 课时 | 主题 | 教具 | 目标 |\n|---|---|---|---|\n" + rows
+    lean = lean_text(table)
+    assert lean.count("教具") == 21  # 表头一次 + 每行的值，不在每个单元格前重复表头
+    assert estimate_tokens(lean) < estimate_tokens(table)
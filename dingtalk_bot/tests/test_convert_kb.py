@@ -0,0 +1,56 @@
+"""增量转换：改动过的源文件转换失败时沿用上一版本"""
+
+import os
+
+from convert_kb import merge_converted
+
+KEY = "知识库/萃取报告/CODE/a.md"
+NAME = "CODE_a.json"
+
+
+def _entry(**changes):
+    entry = {
+        "output": NAME, "title": "旧标题", "index_source": "a.md",
+        "mtime_ns": 1, "size": 10, "sha256": "old", "convert_ms": 1.0,
+    }
+    entry.update(changes)
+    return entry
+
+
+def _plan(tmp_path):
+    md_file = tmp_path / "a.md"
+    md_file.write_text("# 新标题\n", encoding="utf-8")
+    return [(KEY, md_file, NAME, "a.md", os.stat(md_file), None)]
+
+
+def test_changed_file_that_fails_to_convert_keeps_previous_document(tmp_path):
+    old_doc = {"title": "旧标题", "file": NAME, "content": "旧正文"}
+    previous = {KEY: _entry()}
+
+    current, docs, all_index, counts, failures = merge_converted(
+        _plan(tmp_path), iter([(None, "解析失败")]), previous, {NAME: old_doc}
+    )
+
+    assert docs == {NAME: old_doc}
+    assert current == previous  # 清单仍是旧的 mtime/哈希，下次运行会重试
+    assert all_index == [{"title": "旧标题", "file": NAME, "source": "a.md"}]
+    assert counts == {"added": 0, "changed": 0, "unchanged": 0}
+    assert failures == [{"file": NAME, "source": "a.md", "error": "解析失败", "retained": True}]
+
+
+def test_new_file_that_fails_to_convert_is_skipped(tmp_path):
+    current, docs, _, _, failures = merge_converted(_plan(tmp_path), iter([(None, "解析失败")]), {}, {})
+
+    assert current == {} and docs == {}
+    assert failures[0]["retained"] is False
+
+
+def test_converted_file_replaces_previous_document(tmp_path):
+    new_doc = {"title": "新标题", "file": NAME, "content": "# 新标题\n"}
+    current, docs, _, counts, failures = merge_converted(
+        _plan(tmp_path), iter([((new_doc, "new", 2.0), None)]), {KEY: _entry()}, {NAME: {"title": "旧标题"}}
+    )
+
+    assert docs[NAME] is new_doc
+    assert current[KEY]["sha256"] == "new"
+    assert counts["changed"] == 1 and not failures
@@ -0,0 +1,23 @@
+"""近似去重：增量转换时复用上一版本的 MinHash 签名，分组结果与全量计算相同"""
+
+import kb_dedup
+from kb_dedup import find_duplicates, minhash, minhash_all, pack_signatures, unpack_signatures
+
+LESSON = "齿轮传动可以改变转速和方向，主动轮带动从动轮转动，齿数比决定了转速比。" * 3
+TEXTS = [LESSON, LESSON + "补充一句。", "太短", "杠杆有支点、力点和阻力点，省力杠杆的动力臂比阻力臂长。" * 3]
+
+
+def test_known_signatures_are_not_recomputed(monkeypatch):
+    known = unpack_signatures(TEXTS[:3], pack_signatures([minhash(text) for text in TEXTS[:3]]))
+    computed = []
+
+    def counting_minhash(text):
+        computed.append(text)
+        return minhash(text)
+
+    monkeypatch.setattr(kb_dedup, "minhash", counting_minhash)
+    signatures = minhash_all(TEXTS, known=known)
+    assert computed == [TEXTS[3]]
+    assert known[TEXTS[2]] is None
+    assert list(find_duplicates(TEXTS, signatures=signatures)) == list(find_duplicates(TEXTS))
+    assert list(find_duplicates(TEXTS)) == [1, 1, 2, 3]
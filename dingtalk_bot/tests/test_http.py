@@ -0,0 +1,56 @@
+"""共享连接池：同一主机的请求复用 keep-alive 连接，统计按主机汇总"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import kb_http
+from kb_http import HttpClient, get_client
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 默认的 HTTP/1.0 每次响应后断开
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), EchoHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/echo"
+    server.shutdown()
+    server.server_close()
+
+
+def test_requests_to_one_host_reuse_a_connection(server_url):
+    pytest.importorskip("requests")
+    client = HttpClient(connect_timeout=1, read_timeout=2)
+    try:
+        for i in range(5):
+            assert client.post(server_url, data=f"第{i}次".encode("utf-8")).text == f"第{i}次"
+        assert client.stats() == {"127.0.0.1": {"requests": 5, "connections": 1, "reuse": 0.8}}
+        assert client.summary(server_url) == "5次请求/1个连接"
+    finally:
+        client.close()
+
+
+def test_stats_before_first_request_and_shared_client(monkeypatch):
+    client = HttpClient()
+    assert client.stats() == {} and client.summary("https://open.bigmodel.cn/api") == "无连接"
+    assert client.timeout == (kb_http.CONNECT_TIMEOUT, kb_http.READ_TIMEOUT)
+
+    monkeypatch.setattr(kb_http, "_CLIENT", None)
+    shared = get_client({"http_pool_maxsize": 2, "http_read_timeout": 60})
+    assert shared.pool_maxsize == 2 and shared.timeout == (kb_http.CONNECT_TIMEOUT, 60)
+    assert get_client({"http_pool_maxsize": 16}) is shared  # 之后的配置不再生效
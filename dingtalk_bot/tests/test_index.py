@@ -0,0 +1,108 @@
+"""倒排索引：单个汉字由相邻的二字键合并得到，重叠的位置只算一次"""
+
+from kb_index import (SNIPPET_SEPARATOR, FieldIndex, KnowledgeIndex, best_windows, canonical_course_id,
+                      course_id_keys)
+from kb_rank import get_ranker
+
+
+def test_single_cjk_char_positions_are_not_double_counted():
+    field = FieldIndex()
+    field.add(0, "好好学习，学学")
+    field.freeze()
+    assert field.lookup("好") == {0: [0, 1]}
+    assert field.lookup("学") == {0: [2, 5, 6]}
+
+
+def test_bm25_term_frequency_of_doubled_char():
+    index = KnowledgeIndex([{"title": "习惯", "file": "a.json", "content": "好好学习"}])
+    freqs = get_ranker(index, "bm25").field_frequencies("好")
+    assert freqs["body"] == {0: 2}
+
+
+SCOPED_DOCUMENTS = [
+    {"title": "CODE2 课程大纲", "file": "课程体系_CODE2_M1.json", "source": "课程体系/CODE2/M1.md", "content": "循环与条件"},
+    {"title": "CODE1 课程大纲", "file": "课程体系_CODE1_M2.json", "source": "课程体系/CODE1/M2.md", "content": "顺序结构"},
+    {"title": "中班 机械与工具", "file": "课程体系_中班.json", "source": "课程体系/中班.md", "content": "杠杆与滑轮"},
+    {"title": "新人入职", "file": "培训手册_入职.json", "source": "培训手册/入职.md", "content": "第一周安排"},
+]
+
+
+def test_parse_scope_aliases_and_source_directories():
+    index = KnowledgeIndex(SCOPED_DOCUMENTS)
+    assert index.parse_scope("CODE2") == {"level": "CODE2"}
+    assert index.parse_scope("c++") == {"course": "CPP"}
+    assert index.parse_scope(" 培训手册 ") == {"source": "培训手册"}
+    assert index.parse_scope("不存在") is None
+
+
+def test_facet_view_intersects_facets():
+    index = KnowledgeIndex(SCOPED_DOCUMENTS)
+    assert [doc["title"] for doc in index.facet_view(course="CODE")] == ["CODE2 课程大纲", "CODE1 课程大纲"]
+    view = index.facet_view(course="CODE", level="CODE2")
+    assert [doc["title"] for doc in view] == ["CODE2 课程大纲"]
+    assert view.chunk_ids == frozenset(index.doc_chunks[0])
+    assert index.facet_view(level="CODE2", course="CODE") is view  # 交集按分面排序后缓存
+    assert [doc["title"] for doc in index.facet_view(source="课程体系", level="中班")] == ["中班 机械与工具"]
+
+
+def test_facet_view_without_matching_documents_is_empty():
+    index = KnowledgeIndex(SCOPED_DOCUMENTS)
+    assert not index.facet_view(course="CPP")
+    assert not index.facet_view(course="STEM", level="CODE2")
+    assert not index.facet_view(module="M9")
+
+
+def test_best_window_prefers_more_distinct_terms_then_more_hits():
+    events = [(10, 12, 0, 1.0), (50, 52, 1, 1.0), (900, 902, 0, 1.0), (905, 907, 1, 1.0), (910, 912, 1, 1.0)]
+    assert best_windows(events, 2000, width=100, max_windows=1) == [(856, 956)]  # 命中区间居中
+    assert best_windows(events, 2000, width=100, max_windows=2) == [(0, 100), (856, 956)]
+    repeated = [(10, 12, 0, 1.0), (50, 52, 1, 1.0), (900, 902, 0, 1.0), (910, 912, 0, 1.0)]
+    assert best_windows(repeated, 2000, width=100, max_windows=1) == [(0, 100)]  # 同一个词重复不算更好
+
+
+FILLER = "无关内容" * 30
+
+
+def test_snippet_keeps_densest_window_aligned_to_lines():
+    content = "\n".join([FILLER] * 4 + ["齿轮传动改变转速，齿轮的齿数决定转速比。"] + [FILLER] * 4)
+    index = KnowledgeIndex([{"title": "机械", "file": "a.json", "content": content}])
+    text, spans = index.snippet(0, index.term_positions(["齿轮", "转速"]), width=200)
+    assert "齿轮传动改变转速" in text and len(text) < len(content)
+    assert [content[start:end] for start, end in spans] == [text]
+    assert all(start == 0 or content[start - 1] == "\n" for start, _ in spans)
+
+    # 段落不超过窗口总宽时原样返回
+    assert index.snippet(0, index.term_positions(["齿轮"]), width=600) == (content, [(0, len(content))])
+
+
+def test_snippet_joins_separate_windows():
+    content = "\n".join(["齿轮在这里。"] + [FILLER] * 4 + ["转速在这里。"] + [FILLER] * 4 + ["齿轮传动改变转速。"])
+    index = KnowledgeIndex([{"title": "机械", "file": "a.json", "content": content}])
+    text, spans = index.snippet(0, index.term_positions(["齿轮", "转速"]), width=200, max_windows=2)
+    assert len(spans) == 2 and text.count(SNIPPET_SEPARATOR) == 1
+    assert text.endswith("齿轮传动改变转速。")
+    assert text.split(SNIPPET_SEPARATOR) == [content[start:end].strip() for start, end in spans]
+
+
+def test_course_ids_are_canonicalized_with_prefix_keys():
+    assert canonical_course_id("CODE1-1-02") == "1-1-2"
+    assert canonical_course_id("第01-003课") == "1-3"
+    assert canonical_course_id("没有编号") == "没有编号"
+    assert course_id_keys("01-02-03") == ["1-2-3", "1-2"]
+
+
+def test_course_table_finds_first_occurrence_per_document():
+    documents = [
+        {"title": "CODE1 大纲", "file": "a.json", "source": "a.md",
+         "content": "## 第一单元\n课程 1-01-2：认识循环。\n## 复习\n再看一次 1-1-2。"},
+        {"title": "CODE1 教案", "file": "b.json", "source": "b.md", "content": "## 教案\n本课编号 01-1-02。"},
+        {"title": "其他", "file": "c.json", "source": "c.md", "content": "## 说明\n编号 1-2-1。"},
+    ]
+    index = KnowledgeIndex(documents)
+
+    matches = index.find_course("CODE1-1-2")
+    assert [match["title"] for match in matches] == ["CODE1 大纲", "CODE1 教案"]  # 每篇只记首次出现
+    assert matches[0]["section"] == "第一单元" and "认识循环" in matches[0]["content"]
+    assert [match["title"] for match in index.find_course("1-1", doc_ids={1})] == ["CODE1 教案"]
+    assert [match["title"] for match in index.find_course("01-2")] == ["其他"]  # 两段前缀也能查到
+    assert index.find_course("9-9") == []
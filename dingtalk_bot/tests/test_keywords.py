@@ -0,0 +1,45 @@
+"""关键词自动机：一次扫描的结果与逐个关键词查找一致"""
+
+import random
+
+from kb_keywords import (BOOST_BITS, BOOST_KEYWORDS, COURSE_TYPE_DOC_KEYWORDS, COURSE_TYPE_QUERY_KEYWORDS,
+                         DOC_TYPE_BITS, QUERY_TYPE_BITS, KeywordAutomaton, boost_groups, course_type_of_query,
+                         scan_keywords)
+
+
+def naive_scan(text: str) -> int:
+    mask = 0
+    for table, bits in ((BOOST_KEYWORDS, BOOST_BITS), (COURSE_TYPE_QUERY_KEYWORDS, QUERY_TYPE_BITS),
+                        (COURSE_TYPE_DOC_KEYWORDS, DOC_TYPE_BITS)):
+        for key, patterns in table.items():
+            if any(pattern in text for pattern in patterns):
+                mask |= bits[key]
+    return mask
+
+
+def test_overlapping_and_nested_patterns_are_all_found():
+    automaton = KeywordAutomaton()
+    for bit, pattern in enumerate(["he", "she", "his", "hers"]):
+        automaton.add(pattern, 1 << bit)
+    automaton.build()
+    assert automaton.scan("ushers") == 0b1011  # she 的后缀 he 经失败指针输出
+    assert automaton.scan("this") == 0b0100
+    assert automaton.scan("") == 0
+
+
+def test_scan_matches_naive_lookup_on_random_text():
+    rng = random.Random(7)
+    patterns = [pattern for table in (BOOST_KEYWORDS, COURSE_TYPE_QUERY_KEYWORDS, COURSE_TYPE_DOC_KEYWORDS)
+                for values in table.values() for pattern in values]
+    alphabet = sorted({ch for pattern in patterns for ch in pattern}) + list("的了是 ")
+    for _ in range(300):
+        pieces = [rng.choice(patterns) if rng.random() < 0.3 else rng.choice(alphabet) for _ in range(rng.randint(0, 12))]
+        text = "".join(pieces)
+        assert scan_keywords(text) == naive_scan(text), text
+
+
+def test_query_course_type_follows_table_priority():
+    assert course_type_of_query(scan_keywords("小班的python课")) == "STEM"
+    assert course_type_of_query(scan_keywords("code2 升班规则")) == "CODE"
+    assert course_type_of_query(scan_keywords("怎么报名")) is None
+    assert boost_groups(scan_keywords("家长说续费太贵")) == ["家长"]
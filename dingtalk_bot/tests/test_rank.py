@@ -0,0 +1,82 @@
+"""排序引擎：真实知识库上的回归检查与混合检索的时间预算"""
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import BOT_DIR, KB_DIR
+from kb_engine import RetrievalEngine, extract_query_terms
+from kb_index import KnowledgeIndex
+from kb_rank import HybridRanker, get_ranker, search_chunks
+
+COMPARISON_QUERY = "CODE1和CODE2有什么区别"
+
+
+@pytest.fixture(scope="module")
+def engine():
+    if not KB_DIR.exists():
+        pytest.skip("没有知识库")
+    engine = RetrievalEngine({"kb_path": str(KB_DIR), "rank_engine": "bm25"})
+    engine.load()
+    return engine
+
+
+def test_question_filler_bigrams_are_not_ranked(engine):
+    ranker = get_ranker(engine.index, "bm25")
+    terms = dict(ranker.ranking_terms(extract_query_terms(COMPARISON_QUERY), COMPARISON_QUERY))
+    assert "code1" in terms and "code2" in terms and "区别" in terms
+    for noise in ("有什", "什么", "么区"):
+        assert noise not in terms
+
+
+def test_comparison_query_ranks_course_passages(engine):
+    results = engine.search(COMPARISON_QUERY, engine.documents(), max_results=5)
+    assert results
+    for result in results:
+        text = f"{result['title']} {result['section']} {result['content']}".lower()
+        assert "code1" in text or "code2" in text, result["title"]
+
+
+def test_default_engine_is_legacy():
+    with open(BOT_DIR / "config.example.json", encoding="utf-8") as f:
+        assert json.load(f)["rank_engine"] == "legacy"
+
+
+class _Stage:
+    def __init__(self, name, delay):
+        self.name = name
+        self.delay = delay
+
+    def score(self, query, query_terms, chunk_ids=None):
+        time.sleep(self.delay)
+        return [(0, 1.0)]
+
+
+def test_stage_timeout_does_not_starve_the_next_query():
+    ranker = HybridRanker.__new__(HybridRanker)
+    ranker.index = SimpleNamespace(chunks=[{"title": "机械结构", "content": "齿轮"}])
+    ranker.stages = [_Stage("bm25", 0.5), _Stage("vector", 0)]
+    ranker.STAGE_BUDGET_MS = {"bm25": 50, "vector": 50}
+    ranker._executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        # 卡住的 bm25 占满线程池后，后来的查询仍在预算内用向量一路答完
+        for _ in range(6):
+            started = time.perf_counter()
+            hits, timings = ranker.fuse("齿轮", ["齿轮"])
+            assert time.perf_counter() - started < 0.2
+            assert timings["bm25"] is None and timings["vector"] is not None
+            assert [chunk_id for chunk_id, _, _ in hits] == [0]
+    finally:
+        ranker._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def test_long_passages_still_carry_lean_text():
+    content = "## 齿轮\n" + "齿轮传动可以改变转速和方向。" * 110  # 约1500字，超过两个片段窗口
+    index = KnowledgeIndex([{"title": "机械结构", "file": "a.json", "content": content}])
+    results, _ = search_chunks(index, get_ranker(index, "bm25"), "齿轮", ["齿轮"], None, 5)
+
+    assert len(results[0]["content"]) < len(index.chunks[0]["content"])  # 原文只保留片段
+    assert results[0]["lean"] == index.lean[0]
@@ -0,0 +1,70 @@
+"""热更新：检测到新快照后整体替换索引，加载失败时保留旧索引并在下次检查时重试"""
+
+import pytest
+
+from kb_engine import RetrievalEngine
+from kb_index import KnowledgeIndex
+from kb_reload import KnowledgeBaseWatcher
+from kb_snapshot import new_snapshot, publish
+from kb_store import save_index
+
+DOCUMENTS = [{"title": "机械结构", "file": "a.json", "source": "a.md", "content": "## 齿轮\n齿轮传动可以改变转速。"}]
+
+
+def publish_snapshot(kb_dir, documents) -> str:
+    version, out_dir = new_snapshot(kb_dir)
+    save_index(KnowledgeIndex(documents), out_dir)
+    publish(kb_dir, version)
+    return version
+
+
+@pytest.fixture
+def engine(tmp_path):
+    kb_dir = tmp_path / "knowledge_base"
+    publish_snapshot(kb_dir, DOCUMENTS)
+    engine = RetrievalEngine({"kb_path": str(kb_dir), "rank_engine": "bm25"})
+    engine.load()
+    return engine
+
+
+def test_watcher_swaps_in_new_snapshot(engine):
+    kb_dir = engine.config["kb_path"]
+    watcher = KnowledgeBaseWatcher(kb_dir, engine.load, release=engine.release_retired)
+    old = engine.index
+    assert watcher._check(None) is None and watcher.reloads == 0  # 没有新版本
+
+    version = publish_snapshot(kb_dir, DOCUMENTS + [dict(DOCUMENTS[0], title="杠杆", file="b.json")])
+    watcher._check(None)
+    assert watcher.reloads == 1 and watcher.loaded == ("snapshot", version)
+    assert engine.index.version == version and len(engine.index.documents) == 2
+    assert engine.retired == [old]
+    assert engine.release_retired() == 1 and old.mapped is None
+
+
+def test_failed_reload_keeps_old_index_and_retries(engine):
+    kb_dir = engine.config["kb_path"]
+    failures = [OSError("文件被占用")]
+
+    def reload():
+        if failures:
+            raise failures.pop()
+        return engine.load()
+
+    watcher = KnowledgeBaseWatcher(kb_dir, reload)
+    old, loaded = engine.index, watcher.loaded
+    version = publish_snapshot(kb_dir, DOCUMENTS)
+
+    watcher._check(None)
+    assert engine.index is old and watcher.loaded == loaded and watcher.reloads == 0
+    watcher._check(None)  # 下一次检查重试同一个版本
+    assert engine.index.version == version and watcher.loaded == ("snapshot", version) and watcher.reloads == 1
+
+
+def test_reload_without_documents_counts_as_failure(tmp_path):
+    kb_dir = tmp_path / "knowledge_base"
+    watcher = KnowledgeBaseWatcher(kb_dir, lambda: [])
+    loaded = watcher.loaded
+    publish_snapshot(kb_dir, DOCUMENTS)
+
+    watcher._check(None)
+    assert watcher.loaded == loaded and watcher.reloads == 0
@@ -0,0 +1,31 @@
+"""转换报告：正文未变的文档沿用上一版本报告中的统计"""
+
+from kb_index import KnowledgeIndex
+from kb_report import build_report, print_report
+
+DOCUMENTS = [
+    {"title": "机械结构", "file": "a.json", "content": "## 齿轮\n齿轮传动可以改变转速。"},
+    {"title": "编程概念", "file": "b.json", "content": "## 循环\n重复执行一段代码。"},
+]
+
+
+def test_unchanged_documents_reuse_previous_entries():
+    previous = build_report(KnowledgeIndex(DOCUMENTS), {}, {}, 0.0, "v1")
+    for entry in previous["documents"]:
+        entry["tokens"] = -1  # 沿用时会原样出现在新报告里
+
+    documents = [DOCUMENTS[0], dict(DOCUMENTS[1], content=DOCUMENTS[1]["content"] + "\n满足条件时继续。")]
+    report = build_report(KnowledgeIndex(documents), {}, {}, 0.0, "v2", previous)
+    reused, recomputed = report["documents"]
+    assert reused["tokens"] == -1
+    assert recomputed["tokens"] > 0
+
+
+def test_untimed_load_is_left_out_of_growth(capsys):
+    previous = build_report(KnowledgeIndex(DOCUMENTS), {}, {}, 0.05, "v1")
+    report = build_report(KnowledgeIndex(DOCUMENTS), {}, {}, None, "v2", previous)  # 增量转换默认不计时
+
+    assert report["totals"]["index_load_ms"] is None
+    assert "index_load_ms" not in report["growth"]["totals"]
+    print_report(report)
+    assert "未计时" in capsys.readouterr().out
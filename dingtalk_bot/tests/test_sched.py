@@ -0,0 +1,165 @@
+"""消息调度：MessageScheduler 的排队上限、排队位置与大模型并发，WorkerPool 的时限与停止"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from kb_engine import PendingAnswer
+from kb_sched import MessageScheduler, QueueFull, WorkerPool, wait_stats
+
+
+def wait_until(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "等待超时"
+        time.sleep(0.005)
+
+
+class GatedAnswer(PendingAnswer):
+    """大模型调用的替身：记录同时进行的调用数，放行前一直阻塞"""
+
+    gate = None
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+
+    def run(self) -> str:
+        cls = type(self)
+        with cls.lock:
+            cls.running += 1
+            cls.peak = max(cls.peak, cls.running)
+        try:
+            assert cls.gate.wait(5)
+            return f"答:{self.question}"
+        finally:
+            with cls.lock:
+                cls.running -= 1
+
+
+@pytest.fixture
+def gated():
+    answer = type("Answer", (GatedAnswer,), {"gate": threading.Event(), "lock": threading.Lock()})
+    return answer
+
+
+def prepare(answer_class):
+    return lambda question: answer_class({}, question, "上下文")
+
+
+def test_wait_stats():
+    assert wait_stats([]) == {"wait_avg": 0.0, "wait_p95": 0.0, "wait_max": 0.0}
+    assert wait_stats([i / 10 for i in range(20, 0, -1)]) == {"wait_avg": 1.05, "wait_p95": 2.0, "wait_max": 2.0}
+
+
+def test_llm_calls_never_exceed_concurrency(gated):
+    scheduler = MessageScheduler({"llm_concurrency": 2, "queue_limit": 10, "retrieval_workers": 2})
+
+    async def main():
+        tasks = [asyncio.create_task(scheduler.submit(prepare(gated), f"问题{i}")) for i in range(6)]
+        while gated.running < 2:
+            await asyncio.sleep(0.005)
+        gated.gate.set()
+        return await asyncio.gather(*tasks)
+
+    replies = asyncio.run(main())
+    assert replies == [f"答:问题{i}" for i in range(6)]
+    assert gated.peak == 2
+    assert scheduler.stats()["llm_calls"] == 6 and scheduler.running == 0 and scheduler.waiting == 0
+
+
+def test_queue_positions_limit_and_wait_stats(gated):
+    scheduler = MessageScheduler({"llm_concurrency": 1, "queue_limit": 2, "retrieval_workers": 1})
+    positions = []
+
+    async def main():
+        first = asyncio.create_task(scheduler.submit(prepare(gated), "问题0"))
+        while scheduler.running < 1:  # 唯一的大模型名额已被占用
+            await asyncio.sleep(0.005)
+        queued = [
+            asyncio.create_task(scheduler.submit(prepare(gated), f"问题{i}", on_queued=positions.append))
+            for i in (1, 2)
+        ]
+        await asyncio.sleep(0)  # 让两条消息都被接收
+        with pytest.raises(QueueFull):
+            await scheduler.submit(prepare(gated), "问题3")
+        await asyncio.sleep(0.1)
+        gated.gate.set()
+        return await asyncio.gather(first, *queued)
+
+    replies = asyncio.run(main())
+    assert replies == ["答:问题0", "答:问题1", "答:问题2"]
+    assert positions == [1, 2]
+    stats = scheduler.stats()
+    assert stats["accepted"] == 3 and stats["queued"] == 2 and stats["rejected"] == 1
+    assert stats["max_waiting"] == 2 and gated.peak == 1
+    assert stats["wait_max"] >= 0.1  # 排队的消息至少等到放行
+    assert 0 < stats["wait_avg"] <= stats["wait_p95"] <= stats["wait_max"]
+
+
+def test_identical_questions_share_one_llm_call(gated):
+    scheduler = MessageScheduler({"llm_concurrency": 2, "queue_limit": 10})
+
+    async def main():
+        tasks = [asyncio.create_task(scheduler.submit(prepare(gated), "升班规则")) for _ in range(3)]
+        while scheduler.flights.stats()["coalesced"] < 2:
+            await asyncio.sleep(0.005)
+        gated.gate.set()
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(main()) == ["答:升班规则"] * 3
+    assert scheduler.stats()["llm_calls"] == 1
+
+
+def test_worker_pool_rejects_when_queue_is_full():
+    gate = threading.Event()
+    pool = WorkerPool({"worker_threads": 1, "queue_limit": 1})
+    pool.submit(gate.wait, 5)
+    wait_until(lambda: pool.busy == 1)
+    pool.submit(lambda: None)
+
+    with pytest.raises(QueueFull):
+        pool.submit(lambda: None)
+    gate.set()
+    assert pool.shutdown(timeout=5)
+    assert pool.stats()["completed"] == 2 and pool.stats()["rejected"] == 1
+
+
+def test_worker_pool_expires_tasks_that_waited_past_timeout():
+    gate = threading.Event()
+    ran, expired = [], []
+    pool = WorkerPool({"worker_threads": 1, "queue_limit": 5, "task_timeout": 0.1})
+    pool.submit(gate.wait, 5)
+    pool.submit(ran.append, "过期任务", on_expired=lambda: expired.append("稍后再试"))
+    time.sleep(0.2)
+    gate.set()
+
+    assert pool.shutdown(timeout=5)
+    assert ran == [] and expired == ["稍后再试"]
+    stats = pool.stats()
+    assert stats["expired"] == 1 and stats["overdue"] == 1  # 阻塞的任务本身也超过了时限
+    assert stats["wait_max"] >= 0.1
+
+
+def test_worker_pool_shutdown_drains_accepted_tasks_and_rejects_new_ones():
+    gate = threading.Event()
+    done = []
+    pool = WorkerPool({"worker_threads": 1, "queue_limit": 5, "task_timeout": 5})
+    pool.submit(gate.wait, 5)
+    for i in range(2):
+        pool.submit(done.append, i)
+
+    result = {}
+    stopper = threading.Thread(target=lambda: result.update(drained=pool.shutdown()))
+    stopper.start()
+    wait_until(lambda: pool.closed)
+    with pytest.raises(QueueFull):
+        pool.submit(done.append, "停止后提交")
+    assert stopper.is_alive()  # 还在等已接收的任务
+    gate.set()
+    stopper.join(5)
+
+    assert result == {"drained": True}
+    assert done == [0, 1]
+    assert pool.stats()["completed"] == 3 and pool.stats()["rejected"] == 1
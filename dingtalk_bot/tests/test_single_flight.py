@@ -0,0 +1,74 @@
+"""相同问题合并回答（kb_sched.SingleFlight 与 bot.process_question 的合并键）"""
+
+import threading
+import time
+
+import pytest
+
+from kb_engine import question_key
+from kb_sched import SingleFlight
+
+
+def test_identical_calls_in_flight_run_once():
+    flights = SingleFlight()
+    calls = []
+
+    def slow(value):
+        calls.append(value)
+        time.sleep(0.2)
+        return value * 2
+
+    key = question_key("CODE1和CODE2有什么区别？")
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do(key, slow, 21))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [21]
+    assert results == [42] * 4
+    assert flights.stats() == {"in_flight": 0, "calls": 4, "coalesced": 3}
+
+
+def test_question_key_normalizes_case_width_and_punctuation():
+    assert question_key("CODE1和CODE2有什么区别？") == question_key("code1 和 ＣＯＤＥ2有什么区别")
+    assert question_key("区别", "v1", None) != question_key("区别", "v1", (("level", "CODE2"),))
+
+
+def test_scoped_and_unscoped_question_do_not_coalesce(monkeypatch):
+    bot = pytest.importorskip("bot")  # 需要 Flask
+
+    class FakeIndex:
+        version = "v1"
+
+    class FakeEngine:
+        index = FakeIndex()
+
+        def search(self, question, documents, max_results=5):
+            return documents
+
+    answered = []
+
+    def fake_answer(config, question, context, stream=None):
+        answered.append(context)
+        time.sleep(0.2)
+        return f"答:{context}"
+
+    monkeypatch.setattr(bot, "ENGINE", FakeEngine())
+    monkeypatch.setattr(bot, "FLIGHTS", SingleFlight())
+    monkeypatch.setattr(bot, "answer", fake_answer)
+    monkeypatch.setattr(bot, "build_context", lambda docs: ",".join(docs))
+
+    replies = {}
+    scoped = threading.Thread(target=lambda: replies.update(
+        scoped=bot.process_question("升班规则", ["CODE2文档"], scope={"level": "CODE2"})))
+    plain = threading.Thread(target=lambda: replies.update(plain=bot.process_question("升班规则", ["全部文档"])))
+    scoped.start()
+    plain.start()
+    scoped.join()
+    plain.join()
+
+    assert sorted(answered) == ["CODE2文档", "全部文档"]
+    assert replies == {"scoped": "答:CODE2文档", "plain": "答:全部文档"}
+    assert bot.FLIGHTS.stats()["coalesced"] == 0
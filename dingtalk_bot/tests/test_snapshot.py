@@ -0,0 +1,66 @@
+"""快照发布：原子切换 CURRENT、只保留最近几个版本、校验与回滚"""
+
+import pytest
+
+from kb_snapshot import (STAGING_PREFIX, current_version, list_snapshots, new_snapshot, prune, publish,
+                         resolve_snapshot, rollback, snapshot_root, verify)
+
+
+def publish_version(kb_dir, text: str, keep: int = 3) -> str:
+    version, out_dir = new_snapshot(kb_dir)
+    (out_dir / "doc.json").write_text(text, encoding="utf-8")
+    publish(kb_dir, version, {"documents": 1}, keep=keep)
+    return version
+
+
+def test_publish_switches_current_only_when_complete(tmp_path):
+    kb_dir = tmp_path / "knowledge_base"
+    assert resolve_snapshot(kb_dir) == (kb_dir, None)  # 还没有发布过快照
+
+    version, out_dir = new_snapshot(kb_dir)
+    (out_dir / "doc.json").write_text("v1", encoding="utf-8")
+    assert current_version(kb_dir) is None and list_snapshots(kb_dir) == []  # 暂存中的快照不可见
+    publish(kb_dir, version)
+
+    assert current_version(kb_dir) == version and list_snapshots(kb_dir) == [version]
+    assert resolve_snapshot(kb_dir) == (snapshot_root(kb_dir) / version / kb_dir.name, version)
+    assert verify(kb_dir, version) == []
+
+
+def test_prune_keeps_recent_and_current_and_removes_staging(tmp_path):
+    kb_dir = tmp_path / "knowledge_base"
+    versions = [publish_version(kb_dir, f"v{i}", keep=10) for i in range(4)]
+    rollback(kb_dir, versions[0])
+    leftover, _ = new_snapshot(kb_dir)  # 转换中断留下的暂存目录
+
+    assert prune(kb_dir, keep=2) == [versions[1], f"{STAGING_PREFIX}{leftover}"]
+    assert list_snapshots(kb_dir) == [versions[0], versions[2], versions[3]]  # 当前版本总是保留
+
+
+def test_verify_reports_tampered_missing_and_extra_files(tmp_path):
+    kb_dir = tmp_path / "knowledge_base"
+    version = publish_version(kb_dir, "原始内容")
+    out_dir = snapshot_root(kb_dir) / version / kb_dir.name
+
+    (out_dir / "doc.json").write_text("被改过的内容", encoding="utf-8")
+    (out_dir / "extra.json").write_text("{}", encoding="utf-8")
+    assert verify(kb_dir, version) == [f"文件已改动: {kb_dir.name}/doc.json", f"多出文件: {kb_dir.name}/extra.json"]
+    (out_dir / "doc.json").unlink()
+    assert f"缺少文件: {kb_dir.name}/doc.json" in verify(kb_dir, version)
+
+
+def test_rollback_to_previous_version_and_refuses_tampered_snapshot(tmp_path):
+    kb_dir = tmp_path / "knowledge_base"
+    first = publish_version(kb_dir, "v1")
+    second = publish_version(kb_dir, "v2")
+
+    assert rollback(kb_dir) == first and current_version(kb_dir) == first
+    with pytest.raises(ValueError, match="没有更早的快照"):
+        rollback(kb_dir)
+
+    (snapshot_root(kb_dir) / second / kb_dir.name / "doc.json").write_text("坏了", encoding="utf-8")
+    with pytest.raises(ValueError, match="校验失败"):
+        rollback(kb_dir, second)
+    assert current_version(kb_dir) == first
+    with pytest.raises(ValueError, match="快照不存在"):
+        rollback(kb_dir, "19990101-000000")
@@ -0,0 +1,156 @@
+"""预建索引文件：段落边界随索引保存，加载时不再重新切分；内存映射随旧索引关闭"""
+
+import json
+import sys
+import zlib
+
+import pytest
+
+import kb_index
+from kb_engine import RetrievalEngine
+from kb_index import KnowledgeIndex
+from kb_snapshot import CURRENT_NAME, MANIFEST_NAME, prune, snapshot_root
+from kb_store import HEADER_STRUCT, INDEX_MAGIC, index_path, load_index, patch_index, save_index
+
+DOCUMENTS = [
+    {"title": "机械结构", "file": "a.json", "source": "a.md",
+     "content": "## 齿轮\n齿轮传动可以改变转速。\n\n## 杠杆\n杠杆有支点、力点和阻力点。"},
+    {"title": "空文档", "file": "b.json", "source": "b.md", "content": "   "},
+    {"title": "编程概念", "file": "c.json", "source": "c.md",
+     "content": "## 循环\n重复执行一段代码。\n### 条件循环\n满足条件时继续。"},
+]
+
+
+def test_load_index_restores_chunks_without_rechunking(tmp_path, monkeypatch):
+    kb_dir = tmp_path / "knowledge_base"
+    expected = KnowledgeIndex(DOCUMENTS)
+    save_index(expected, kb_dir)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("加载预建索引时不应重新切分段落")
+
+    monkeypatch.setattr(kb_index, "split_chunks", fail)
+    index = load_index(kb_dir, check_source=False)
+    assert index.chunks == expected.chunks
+    assert index.doc_chunks == expected.doc_chunks
+
+
+def test_patch_index_keeps_chunks_of_unchanged_documents(tmp_path):
+    kb_dir = tmp_path / "knowledge_base"
+    save_index(KnowledgeIndex(DOCUMENTS), kb_dir)
+    documents = [dict(DOCUMENTS[2], content=DOCUMENTS[2]["content"] + "\n## 函数\n把代码打包复用。"), DOCUMENTS[0]]
+
+    index, retokenized = patch_index(load_index(kb_dir, check_source=False), documents)
+    expected = KnowledgeIndex(documents)
+    assert retokenized == 1
+    assert index.chunks == expected.chunks
+    assert index.doc_chunks == expected.doc_chunks
+
+
+def _postings(index):
+    return {
+        name: {key: [(doc_id, list(positions)) for doc_id, _, positions in posting]
+               for key, posting in getattr(index, name).postings.items()}
+        for name in ("title", "section_titles", "body")
+    }
+
+
+def test_patch_index_rebuilds_only_terms_of_changed_documents(tmp_path):
+    kb_dir = tmp_path / "knowledge_base"
+    save_index(KnowledgeIndex(DOCUMENTS), kb_dir)
+    old = load_index(kb_dir, check_source=False)
+    # 改动第一篇且段落变多：后面文档的块ID整体平移；删去的词项“杠杆”要从倒排表中消失
+    documents = [dict(DOCUMENTS[0], content="## 齿轮\n齿轮传动可以改变转速。\n\n## 滑轮\n定滑轮改变力的方向。\n\n## 斜面\n斜面省力。"),
+                 DOCUMENTS[2]]
+
+    index, _ = patch_index(old, documents)
+    expected = _postings(KnowledgeIndex(documents))
+    assert _postings(index) == expected
+    assert "杠杆" not in index.body.postings
+    patched_dir = tmp_path / "patched" / "knowledge_base"
+    patched_dir.parent.mkdir()
+    save_index(index, patched_dir)  # 沿用的倒排表仍引用旧文件的位置数组
+    assert _postings(load_index(patched_dir, check_source=False)) == expected
+
+    # 块ID不变时，没有出现在改动文档中的词项直接沿用旧倒排表
+    documents = [DOCUMENTS[0], dict(DOCUMENTS[2], content=DOCUMENTS[2]["content"] + "还有跳出循环。")]
+    index, _ = patch_index(old, documents)
+    assert _postings(index) == _postings(KnowledgeIndex(documents))
+    assert index.body.postings["齿轮"] is old.body.postings["齿轮"]
+
+
+def _publish(kb_dir, *versions):
+    root = snapshot_root(kb_dir)
+    for version in versions:
+        (root / version).mkdir(parents=True)
+        (root / version / MANIFEST_NAME).write_text("{}", encoding="utf-8")
+        save_index(KnowledgeIndex(DOCUMENTS), root / version / kb_dir.name)
+    (root / CURRENT_NAME).write_text(versions[-1], encoding="utf-8")
+    return root
+
+
+def test_close_fails_while_mapped_memory_is_still_referenced(tmp_path):
+    kb_dir = tmp_path / "knowledge_base"
+    save_index(KnowledgeIndex(DOCUMENTS), kb_dir)
+    index = load_index(kb_dir, check_source=False)
+    held = next(iter(index.body.postings.values())).doc_ids
+
+    assert not index.close()
+    assert not index.acquire()  # 关闭失败后不再发放租约，请求改取新索引
+    del held
+    assert index.close()
+    assert index.mapped is None
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="通过 /proc/self/maps 检查映射")
+def test_load_index_unmaps_file_when_restore_fails(tmp_path):
+    kb_dir = tmp_path / "knowledge_base"
+    save_index(KnowledgeIndex(DOCUMENTS), kb_dir)
+    path = index_path(kb_dir)
+    # 改写段落数并重算校验和：文件头通过校验，恢复到最后才发现不一致
+    data = path.read_bytes()
+    prefix = len(INDEX_MAGIC) + HEADER_STRUCT.size
+    header_len, _ = HEADER_STRUCT.unpack(data[len(INDEX_MAGIC):prefix])
+    header = json.loads(data[prefix:prefix + header_len])
+    header["chunk_count"] += 1
+    body = json.dumps(header).encode("utf-8")
+    body += b" " * (-(prefix + len(body)) % 8)  # 数据块偏移相对于头部末尾，补齐对齐即可照样读取
+    rest = body + data[prefix + header_len:]
+    path.write_bytes(INDEX_MAGIC + HEADER_STRUCT.pack(len(body), zlib.crc32(rest)) + rest)
+
+    with pytest.raises(ValueError, match="段落"):
+        load_index(kb_dir, check_source=False)
+    assert str(path) not in open("/proc/self/maps", encoding="utf-8").read()
+
+
+def test_prune_skips_snapshot_whose_index_is_still_mapped(tmp_path):
+    kb_dir = tmp_path / "knowledge_base"
+    root = _publish(kb_dir, "20260101-000000", "20260102-000000")
+    old = load_index(root / "20260101-000000" / kb_dir.name, check_source=False)
+
+    assert prune(kb_dir, keep=1) == []
+    assert old.close()
+    assert prune(kb_dir, keep=1) == ["20260101-000000"]
+
+
+def test_engine_closes_swapped_out_index_once_its_leases_are_returned(tmp_path):
+    kb_dir = tmp_path / "knowledge_base"
+    _publish(kb_dir, "20260101-000000")
+    engine = RetrievalEngine({"kb_path": str(kb_dir), "rank_engine": "bm25"})
+    engine.load()
+
+    with engine.lease() as old:
+        held = next(iter(old.body.postings.values())).doc_ids  # 请求正在用的映射内存
+        engine.load()
+        assert engine.release_retired() == 0  # 还在用，不关闭
+        assert old.mapped is not None and held
+        assert engine.search("齿轮", old.documents)
+        with engine.lease() as current:
+            assert current is engine.index
+        del held
+
+    assert engine.release_retired() == 1
+    assert old.mapped is None and engine.retired == []
+    assert engine.index.mapped is not None
+    with engine.lease() as current:
+        assert current is engine.index
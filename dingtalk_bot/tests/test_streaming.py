@@ -0,0 +1,125 @@
+"""流式回答：SSE 增量解析、分段断点、中途出错与卡片创建失败时的回退（大模型用 llm_standin 替身）"""
+
+import threading
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+import llm_standin
+from kb_engine import (LLM_UNAVAILABLE, STREAM_INTERRUPTED, ReplyStream, _chat_request, iter_llm_deltas,
+                       iter_segments, stream_llm)
+
+QUESTION = "齿轮怎么改变转速"
+CONTEXT = "### 齿轮传动\n齿轮传动可以改变转速。\n\n### 杠杆\n杠杆有支点。"
+
+
+@contextmanager
+def standin(**options):
+    """在后台线程运行替身，产出指向它的大模型配置"""
+    pytest.importorskip("requests")  # kb_http 的连接池
+    server = llm_standin.serve(0, delay=0, **options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield {"llm_api_key": "test", "llm_base_url": f"http://127.0.0.1:{server.server_port}/v4"}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def expected_answer(config):
+    _, payload, _ = _chat_request(config, QUESTION, CONTEXT, stream=True)
+    return llm_standin.compose_answer(payload["messages"])
+
+
+def test_deltas_skip_keepalive_comments_and_done():
+    with standin(chunk=5, keepalive=True) as config:
+        deltas = list(iter_llm_deltas(config, QUESTION, CONTEXT))
+        answer = expected_answer(config)
+
+    assert "".join(deltas) == answer
+    assert len(deltas) == -(-len(answer) // 5)  # 注释行与 [DONE] 不产出增量
+
+
+def test_segments_cut_at_last_newline_once_enough_text():
+    deltas = list("第一行文字\n第二行**加粗**文字\n第三行")  # 逐字到达
+    assert list(iter_segments(deltas, segment_chars=8)) == ["第一行文字", "第二行【加粗】文字", "第三行"]
+
+
+def test_long_line_without_newline_is_cut_at_sentence_end():
+    text = "这是很长的一句话。" * 3 + "还没说完"
+    segments = list(iter_segments(list(text), segment_chars=8))
+    assert segments[0].endswith("。") and "".join(segments) == text
+
+
+def test_segments_never_cut_inside_open_code_fence():
+    text = "示例如下：\n```python\nfor i in range(3):\n    print(i)\n```\n以上代码打印三行。\n"
+    segments = list(iter_segments(list(text), segment_chars=6))
+
+    assert segments == ["示例如下：", "python\nfor i in range(3):\n    print(i)", "以上代码打印三行。"]
+    assert not any("```" in segment for segment in segments)
+
+
+def test_stream_reports_interruption_after_partial_answer():
+    with standin(chunk=4, fail_after=12) as config:
+        segments = list(stream_llm(config, QUESTION, CONTEXT, segment_chars=10))
+
+    assert len(segments) >= 2
+    assert segments[-1] == STREAM_INTERRUPTED
+    assert STREAM_INTERRUPTED not in segments[:-1]
+
+
+def test_stream_failing_before_any_text_reports_unavailable():
+    with standin(fail_after=0) as config:
+        segments = list(stream_llm(config, QUESTION, CONTEXT, segment_chars=10))
+
+    assert len(segments) == 1 and segments[0].startswith(LLM_UNAVAILABLE)
+
+
+def test_reply_stream_requires_send():
+    with pytest.raises(TypeError):
+        ReplyStream()
+
+
+class FakeHandler:
+    """ChatbotHandler 的替身：记录回复的文本消息与卡片更新"""
+
+    def __init__(self, card_instance_id):
+        self.texts = []
+        self.card = SimpleNamespace(card_instance_id=card_instance_id, updates=[], final=None)
+        self.card.ai_streaming = lambda markdown, append: self.card.updates.append(markdown)
+        self.card.ai_finish = lambda markdown: setattr(self.card, "final", markdown)
+
+    def ai_markdown_card_start(self, message):
+        return self.card
+
+    def reply_text(self, text, message):
+        self.texts.append(text)
+
+
+def test_card_updates_in_place_and_finishes():
+    bot_stream = pytest.importorskip("bot_stream")  # 需要钉钉 SDK
+    handler = FakeHandler("card-1")
+    reply = bot_stream.DingTalkReply(handler, message=None, use_card=True)
+    for segment in ("第一段", "第二段"):
+        reply.deliver(segment)
+    reply.finish("第一段\n\n第二段")
+
+    assert handler.card.updates == ["第一段", "第一段\n\n第二段"]
+    assert handler.card.final == "第一段\n\n第二段"
+    assert handler.texts == []
+
+
+def test_card_creation_failure_falls_back_to_reply_text():
+    bot_stream = pytest.importorskip("bot_stream")
+    handler = FakeHandler("")  # 没有互动卡片权限时 SDK 返回空的卡片实例ID
+    reply = bot_stream.DingTalkReply(handler, message=None, use_card=True)
+    segments = ["卡" * 120, "片" * 120, "尾"]
+    for segment in segments:
+        reply.deliver(segment)
+    reply.finish("\n\n".join(segments))
+
+    assert handler.card.updates == []
+    # 卡片的片段较短，改发消息时攒到约200字再发
+    assert handler.texts == ["\n\n".join(segments[:2]), "尾"]
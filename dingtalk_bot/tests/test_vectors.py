@@ -0,0 +1,61 @@
+"""段落向量：生成、内存映射加载与增量补向量后，行号仍对应到正确的段落"""
+
+import json
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from kb_index import KnowledgeIndex
+from kb_vectors import build_vectors, load_vectors, patch_vectors, vector_paths
+
+DOCUMENTS = [
+    {"title": "机械结构", "file": "a.json", "source": "a.md",
+     "content": "## 齿轮\n齿轮传动可以改变转速和方向。\n\n## 杠杆\n杠杆有支点、力点和阻力点。"},
+    {"title": "家长沟通", "file": "b.json", "source": "b.md",
+     "content": "## 价格异议\n家长觉得学费太贵时，先了解预算再介绍课程价值。"},
+    {"title": "编程概念", "file": "c.json", "source": "c.md", "content": "## 循环\n循环让一段代码重复执行。"},
+]
+
+
+def top_section(vectors, query):
+    chunk_id, _ = vectors.search(query, top_k=1)[0]
+    return vectors.index.chunks[chunk_id]["section"]
+
+
+@pytest.mark.parametrize("quantize", [False, True])
+def test_build_and_load_round_trip(tmp_path, quantize):
+    kb_dir = tmp_path / "knowledge_base"
+    assert build_vectors(DOCUMENTS, kb_dir, components=8, quantize=quantize) == 4
+
+    vectors = load_vectors(kb_dir, KnowledgeIndex(DOCUMENTS))
+    assert vectors.coverage == 4
+    assert str(vectors.matrix.dtype) == ("int8" if quantize else "float32")
+    assert top_section(vectors, "学费太贵怎么办") == "价格异议"
+    assert top_section(vectors, "齿轮转速") == "齿轮"
+    assert [chunk_id for chunk_id, _ in vectors.search("齿轮和杠杆", chunk_ids={1})] == [1]  # 限定范围内检索
+
+
+def test_changed_chunks_lose_vectors_until_patched(tmp_path):
+    kb_dir = tmp_path / "knowledge_base"
+    build_vectors(DOCUMENTS, kb_dir, components=8)
+    documents = [DOCUMENTS[0], dict(DOCUMENTS[1], content="## 价格异议\n家长嫌贵时，先问清预算。"), DOCUMENTS[2]]
+
+    stale = load_vectors(kb_dir, KnowledgeIndex(documents))
+    assert stale.coverage == 3  # 改动的段落没有向量，其余段落的行号不错位
+    assert top_section(stale, "齿轮转速") == "齿轮"
+
+    assert patch_vectors(documents, kb_dir) == 1
+    assert load_vectors(kb_dir, KnowledgeIndex(documents)).coverage == 4
+
+
+def test_load_rejects_vectors_built_with_other_parameters(tmp_path):
+    kb_dir = tmp_path / "knowledge_base"
+    build_vectors(DOCUMENTS, kb_dir, components=8)
+    meta_path = vector_paths(kb_dir)[2]
+    meta = json.loads(meta_path.read_text(encoding="utf-8"))
+    meta_path.write_text(json.dumps(dict(meta, hash_dim=meta["hash_dim"] * 2)), encoding="utf-8")
+
+    with pytest.raises(ValueError):
+        load_vectors(kb_dir, KnowledgeIndex(DOCUMENTS))
+    assert patch_vectors(DOCUMENTS, kb_dir) is None